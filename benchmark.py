@@ -0,0 +1,272 @@
+"""
+Benchmark of uAnalyser and the plotters on synthetic power profiler captures. Every phase runs
+the tools as they are run from the command line, in a subprocess, and the wall time, samples
+per second and peak memory of every run are written to a JSON file so runs can be compared,
+along with the --profile-json timings of the phases within every run.
+"""
+
+import argparse
+from datetime import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import uAprofile
+
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HEADER = "Timestamp(ms),Current(uA),D0-D7\n"
+
+# Samples of a capture generated and written at a time
+GENERATE_CHUNK_SIZE = 1000000
+
+# Pin bits of the layout of DEFAULT_PIN_MAP in uAnalyser, bit n is pin n
+PIN_MODEM = 1 << 0
+PINS_RUNNING = 1 << 3 | 1 << 5
+PINS_FINISHED = 1 << 4
+# Bits of the state pins 6 and 7 for every section, pin 6 being the most significant
+STATE_PINS = {"setup": 0, "compute": 1 << 7, "send": 1 << 6, "sleep": 1 << 6 | 1 << 7}
+# The PPK pin string of every bitmask
+PIN_STRINGS = ["".join("1" if bitmask >> pin & 1 else "0" for pin in range(8)) for bitmask in range(256)]
+
+# Current (uA) of every section: mean and standard deviation
+SECTION_CURRENT = {"setup": (5000, 1000), "compute": (3800, 300), "send": (3800, 500), "sleep": (5, 2)}
+# Number of samples of every section in a cycle: lowest and highest
+SECTION_LENGTH = {"compute": (2000, 8000), "send": (1000, 5000), "sleep": (10000, 50000)}
+
+
+def util_segment_current(rng, section: str, length: int):
+    mean, deviation = SECTION_CURRENT[section]
+    current = rng.normal(mean, deviation, length)
+    if section == "send":
+        # Radio spikes
+        spikes = rng.random(length) < 0.02
+        current[spikes] = rng.uniform(20000, 30000, np.count_nonzero(spikes))
+    elif section == "sleep":
+        # Wake ups drawing a little more or less than SLEEP_THRESHOLD
+        wake_ups = rng.random(length) < 0.1
+        current[wake_ups] = rng.uniform(6, 20, np.count_nonzero(wake_ups))
+    return current
+
+
+def generate_segments(rng, rows: int):
+    """Yield (current, pin bitmasks) of consecutive segments of a capture, `rows` samples in total
+
+    A capture starts with an idle device and the setup of the application, followed by cycles of
+    compute, send and sleep, where sleep holds a modem burst every few cycles. The application
+    finishes during the last few samples.
+    """
+    idle = min(rows, 500)
+    yield rng.normal(2, 0.5, idle), np.zeros(idle, dtype=np.uint8)
+    remaining = rows - idle
+    finished = min(remaining, 500)
+    remaining -= finished
+
+    cycle = 0
+    for section in itertools.chain(["setup"], itertools.cycle(["compute", "send", "sleep"])):
+        if not remaining:
+            break
+        low, high = SECTION_LENGTH.get(section, (20000, 20001))
+        length = min(int(rng.integers(low, high)), remaining)
+        remaining -= length
+        current = util_segment_current(rng, section, length)
+        pins = np.full(length, PINS_RUNNING | STATE_PINS[section], dtype=np.uint8)
+        if section == "sleep":
+            cycle += 1
+            if cycle % 3 == 0:
+                burst = slice(length // 4, length // 4 + min(length // 2, 3000))
+                pins[burst] |= PIN_MODEM
+                current[burst] = rng.normal(10000, 2000, len(current[burst]))
+        yield current, pins
+
+    yield rng.normal(2, 0.5, finished), np.full(finished, PINS_FINISHED, dtype=np.uint8)
+
+
+def generate_capture(file_path: str, rows: int, seed: int):
+    """Write a synthetic capture of `rows` samples, 0.01 ms apart, to file_path"""
+    rng = np.random.default_rng(seed)
+    temporary_path = file_path + ".tmp"
+    with open(temporary_path, "w") as capture:
+        capture.write(HEADER)
+        sample = 0
+        for current, pins in generate_segments(rng, rows):
+            for start in range(0, len(current), GENERATE_CHUNK_SIZE):
+                chunk_current = current[start : start + GENERATE_CHUNK_SIZE].tolist()
+                chunk_pins = pins[start : start + GENERATE_CHUNK_SIZE].tolist()
+                capture.write("".join(
+                    f"{(sample + index) / 100:.2f},{value},{PIN_STRINGS[bitmask]}\n"
+                    for index, (value, bitmask) in enumerate(zip(chunk_current, chunk_pins))
+                ))
+                sample += len(chunk_current)
+    os.replace(temporary_path, file_path)
+
+
+def run(phase: str, command: list, rows: int, working_directory: str, **details) -> dict:
+    """Time a tool until it exits, and read its peak resident memory from the kernel
+
+    The tool writes the timings of its own phases with --profile-json, they are added to the
+    run as its phases.
+    """
+    profile_path = os.path.join(working_directory, "profile.json")
+    util_remove(profile_path)
+    command = command + ["--profile-json", profile_path]
+    print(f"{phase}: {' '.join(command)}")
+    environment = {**os.environ, "MPLBACKEND": "Agg"}
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command, cwd=working_directory, env=environment, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL
+    )
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    # The process is reaped already, Popen must not wait for it again
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    with open(profile_path) as profile_file:
+        profile = json.load(profile_file)
+    os.remove(profile_path)
+    return {
+        "phase": phase,
+        **details,
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds,
+        "peak_rss_bytes": uAprofile.util_maxrss_bytes(usage),
+        "cpu_seconds": profile["cpu_seconds"],
+        "phases": profile["phases"],
+    }
+
+
+def util_script(name: str) -> list:
+    return [sys.executable, os.path.join(SOURCE_DIRECTORY, name)]
+
+
+def util_remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def benchmark_capture(args, rows: int) -> list:
+    directory = os.path.join(args.directory, f"{rows}-{args.seed}")
+    os.makedirs(os.path.join(directory, "power_profile_plots"), exist_ok=True)
+    capture = os.path.join(directory, "tls_10_256B.csv")
+    runs = []
+
+    if not os.path.exists(capture):
+        print(f"Generating {capture}")
+        start = time.perf_counter()
+        generate_capture(capture, rows, args.seed)
+        seconds = time.perf_counter() - start
+        runs.append({"phase": "generate", "rows": rows, "seconds": seconds, "rows_per_second": rows / seconds})
+
+    for engine in args.engines:
+        output = os.path.join(directory, f"results_{engine}.csv")
+        util_remove(output, os.path.join(directory, f"results_{engine}.npy"))
+        runs.append(run(
+            "analyse",
+            util_script("uAnalyser.py") + ["analyse", "--path", capture, "--engine", engine, "--output", output, "--no-cache"],
+            rows, directory, engine=engine,
+        ))
+
+        output = os.path.join(directory, f"sleep_{engine}.csv")
+        util_remove(output, os.path.join(directory, f"sleep_{engine}_gaps.csv"))
+        runs.append(run(
+            "sleep",
+            util_script("uAnalyser.py") + ["sleep", "--path", capture, "--engine", engine, "--output", output],
+            rows, directory, engine=engine,
+        ))
+
+    runs.append(run("uAplotter profile", util_script("uAplotter.py") + ["--path", capture], rows, directory))
+    return runs
+
+
+def benchmark_plotter(args) -> dict:
+    """Render every figure of plotter from the results in source_files, they hold every configuration"""
+    results = os.path.join(SOURCE_DIRECTORY, "source_files", "distilled_results.csv")
+    with open(results) as results_file:
+        rows = sum(1 for _ in results_file) - 1
+    output = os.path.join(args.directory, "plots")
+    os.makedirs(output, exist_ok=True)
+    return run("plotter", util_script("plotter.py") + ["--path", results, "--output", output], rows, args.directory)
+
+
+def parse_arguments(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark uAnalyser, plotter and uAplotter on synthetic power profiler captures"
+    )
+    parser.add_argument(
+        "--rows",
+        nargs="+",
+        type=int,
+        default=[1000000],
+        help="number of samples of the synthetic captures, one capture per size, e.g. 1000000 10000000 100000000.",
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=["python", "numpy", "mmap", "pipeline"],
+        default=["python", "numpy", "mmap", "pipeline"],
+        help="engines 'analyse' and 'sleep' are timed with.",
+    )
+    parser.add_argument(
+        "--directory",
+        type=str,
+        default=os.path.join(tempfile.gettempdir(), "uAnalyser-benchmark"),
+        help="directory of the synthetic captures and the output of the tools. Captures already there are reused.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the synthetic captures, captures of the same size and seed are identical.",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        help="path to the JSON result file, defaults to benchmark_<date>-<time>.json.",
+    )
+    return parser.parse_args(argv)
+
+
+def MAIN(args):
+    runs = []
+    for rows in args.rows:
+        runs += benchmark_capture(args, rows)
+    runs.append(benchmark_plotter(args))
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "runs": runs,
+    }
+    output = args.output or f"benchmark_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+
+    for entry in runs:
+        engine = f" ({entry['engine']})" if "engine" in entry else ""
+        memory = f", {entry['peak_rss_bytes'] / 2**20:.0f} MiB" if "peak_rss_bytes" in entry else ""
+        print(f"{entry['phase']}{engine}: {entry['rows']} rows in {entry['seconds']:.2f} s, {entry['rows_per_second']:.0f} rows/s{memory}")
+        for phase in entry.get("phases", []):
+            file = f" {os.path.basename(phase['file'])}" if phase["file"] else ""
+            print(f"    {phase['phase']}{file}: {phase['seconds']:.2f} s in {phase['calls']} calls")
+    print(f"Benchmark written to {output}")
+
+
+def main(argv: list = None):
+    MAIN(parse_arguments(argv))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,11 @@
 import argparse
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
 from itertools import chain, product
-
-parser = argparse.ArgumentParser(
-    description="Command line tool for plotting results from uAnalyser tool, authored by Ådne Karstad @aadnekar"
-)
-
-parser.add_argument(
-    "--path",
-    "-p",
-    help="Relative path to source file",
-)
-
-parser.add_argument(
-    "--output",
-    "-o",
-    help="Relative path to output directory",
-)
-
-args = parser.parse_args()
+from uAresults import load_results
+import uAprofile
 
 COLORS = [
     "#39918c",
@@ -38,17 +22,8 @@ MILLI_VOLTAGE = 3.7 * 1000
 
 SOURCE_DIRECTORY = "/home/aadneka/ntnu/uAnalyser"
 
-if args.path:
-    SOURCE_FILE = args.path
-else:
-    SOURCE_FILE = f"/{SOURCE_DIRECTORY}/results.csv"
-
-if args.output:
-    if not os.path.isdir(args.output):
-        os.mkdir(args.output)
-    RESULTS_DIR = args.output
-else:
-    RESULTS_DIR = f"/{SOURCE_DIRECTORY}/plots"
+DEFAULT_SOURCE_FILE = f"/{SOURCE_DIRECTORY}/results.csv"
+DEFAULT_RESULTS_DIR = f"/{SOURCE_DIRECTORY}/plots"
 
 TOTAL = "TOTAL"
 SETUP = "SETUP"
@@ -75,9 +50,6 @@ PROTOCOLS = [
     "no_tls_e2e",
 ]
 
-""" Defines sorting order for sorting values and labels by protocol"""
-PROTOCOL_SORTING_ORDER = {"no_tls": 1, "no_tls_e2e": 2, "tls": 3, "tls_e2e": 4}
-
 OPERATIONS = ["10", "15", "20", "25"]
 
 PAYLOAD_SIZE = [
@@ -93,6 +65,12 @@ ALL_CONFIGURATION_LABELS = [
     for config_product in product(PROTOCOLS, OPERATIONS, PAYLOAD_SIZE)
 ]
 
+""" Payload labels of every number of operations, e.g. '10' -> ['10 256B', '10 708B', ...]"""
+CONFIGURATION_LABELS = {
+    operations: [" ".join(config_product) for config_product in product([operations], PAYLOAD_SIZE)]
+    for operations in OPERATIONS
+}
+
 COUNT = "COUNT"
 AVERAGE_CURRENT = "AVERAGE_CURRENT"
 TOTAL_CURRENT = "TOTAL_CURRENT"
@@ -112,56 +90,17 @@ def util_find_corresponding_protocol_label(label: str):
     return "_".join(label.split("_")[:-2])
 
 
-def parse_file_data_to_dictionary():
-    file = open(SOURCE_FILE, "r")
-    print("Reading file containing fields:")
-    print(file.readline())
-
-    data_dictionary = {}
-
-    for data_line in file.readlines():
-        if len(data_line) < 5:
-            print(data_line)
-            continue
-        label, section, count, average_current, total_current, time, joules = data_line.split(
-            ","
-        )
-
-        if data_dictionary.get(label) == None:
-            data_dictionary[label] = {}
-
-        data_dictionary[label][section] = [
-            float(count),
-            float(average_current),
-            float(total_current),
-            float(time),
-            float(joules),
-        ]
-
-    return data_dictionary
+def parse_file_data(source_file: str):
+    """Load the results in source_file, a result file of uAnalyser or its .npy column store"""
+    print(f"Reading results from {source_file}")
+    with uAprofile.phase("read", source_file, bytes=os.path.getsize(source_file)):
+        return load_results(source_file)
 
 
 def util_from_uA_to_mA(uA: float):
     return uA / 1000
 
 
-def util_from_ms_to_s(ms: float):
-    return round(ms / 1000, 4)
-
-
-def util_is_tls_label(label_snippet):
-    return label_snippet == "tls"
-
-
-def util_sorter(label_list):
-    protocol_value = (
-        PROTOCOL_SORTING_ORDER["_".join(label_list[:-2])] if len(label_list) > 2 else 0
-    )
-    operations = int(label_list[-2])
-    payload = int(label_list[-1][:-1])
-    return (operations, payload, protocol_value)
-
-
 def util_get_joules(average_I: float, duration: float):
     """Calculate joules based of average current drawn and the duration
 
@@ -177,426 +116,467 @@ def util_get_joules(average_I: float, duration: float):
     return Joules
 
 
-def sort_labels(labels):
-    sorter = lambda label: util_sorter(label.split(" "))
-    return sorted(labels, key=sorter)
+class LabelIndex:
+    """The labels of a result array parsed once, with lookup tables for selecting and ordering
 
-
-def sort_values_by_label(labels, to_sort):
-    """
-    Sorting order (most significant to least significant):
-        1. PROTOCOL
-        2. Operations
-        3. Payload size
+    Every distinct label gets a position in the order of sort_results, by operations, payload
+    size and protocol. Values are kept in a (label, section) table per field and every part a
+    filter can name, e.g. '25', '256B' or 'e2e', has a precomputed mask over the labels, so the
+    values of a section for some filters are looked up with a single indexing operation.
     """
-    sorter = lambda label: util_sorter(label[0].split("_"))
-    return [value for (_, value) in sorted(zip(labels, to_sort), key=sorter)]
 
-
-def get_labels(data_dictionary):
+    FIELDS = ("count", "average_current", "total_current", "time", "joules")
+
+    def __init__(self, results):
+        labels, first_row, row_label = np.unique(results["label"], return_index=True, return_inverse=True)
+        # Rows are sorted already, so the first row of a label gives its position
+        order = np.argsort(first_row)
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        rows = first_row[order]
+
+        self.labels = labels[order]
+        self.protocol = results["protocol"][rows]
+        self.operations = results["operations"][rows]
+        self.payload = results["payload"][rows]
+        self.position = {str(label): index for index, label in enumerate(self.labels)}
+
+        self.sections = list(dict.fromkeys(str(section) for section in results["section"]))
+        self.section_column = {section: column for column, section in enumerate(self.sections)}
+        row_position = position[row_label.ravel()]
+        row_column = np.array([self.section_column[str(section)] for section in results["section"]], dtype=np.int64)
+
+        self.values = {}
+        for field in self.FIELDS:
+            table = np.full((len(self.labels), len(self.sections)), np.nan)
+            table[row_position, row_column] = results[field]
+            self.values[field] = table
+
+        parts = {}
+        for index, (protocol, operations, payload) in enumerate(zip(self.protocol, self.operations, self.payload)):
+            for part in [*str(protocol).split("_"), str(operations), f"{payload}B"]:
+                parts.setdefault(part, []).append(index)
+        self.part_masks = {}
+        for part, indices in parts.items():
+            mask = np.zeros(len(self.labels), dtype=bool)
+            mask[indices] = True
+            self.part_masks[part] = mask
+        self._selections = {}
+
+    def select(self, filters: list = None) -> np.ndarray:
+        """Positions of the labels that have every filter as one of their '_' separated parts"""
+        key = tuple(filters or ())
+        if key not in self._selections:
+            mask = np.ones(len(self.labels), dtype=bool)
+            for _filter in key:
+                mask &= self.part_masks.get(_filter, False)
+            self._selections[key] = np.flatnonzero(mask)
+        return self._selections[key]
+
+    def get(self, field: str, section: str, filters: list = None) -> np.ndarray:
+        """Values of a field in a section for the labels matching the filters, in label order"""
+        return self.values[field][self.select(filters), self.section_column[section]]
+
+
+def get_labels(index: LabelIndex):
     """
-    Extracts all keys, which are taken from the file_names of the csv files their data are
-    retrieved from.
+    Extracts all labels, which are taken from the file_names of the csv files their data are
+    retrieved from. The labels are sorted by operations, payload size and protocol already.
     Typically: 'no tls 10 256B' or 'tls 25 1024B'
     """
-    return sort_labels([" ".join(label.split("_")) for label in data_dictionary.keys()])
-
+    return [" ".join(label.split("_")) for label in index.labels]
 
-def get_payload_labels(data_dictionary):
-    return [label.split("_")[-1] for label in get_labels(data_dictionary)]
 
+def get_time_of_section(index: LabelIndex, section, filters: list = None):
+    """Time of a section in seconds, for every label matching the filters"""
+    return np.round(index.get("time", section, filters) / 1000, 4)
 
-def get_time_of_section(data_dictionary, section, filters: list = None):
-    data = []
-    labels = []
-    for label, label_values in data_dictionary.items():
-        if filters and not all([_filter in label.split("_") for _filter in filters]):
-            continue
-        labels.append(label)
-        data.append(util_from_ms_to_s(label_values[section][DATA_INDEX[TIME]]))
-    return sort_values_by_label(labels, data)
 
-
-def get_joules_of_section(data_dictionary, section: str, filters: list = None):
-    """Get a list of joule values
+def get_joules_of_section(index: LabelIndex, section: str, filters: list = None):
+    """Get an array of joule values
 
     Args:
-        data_dictionary (dict): _description_
-        section (str): _description_
+        index (LabelIndex): label index of the results
+        section (str): section to get the energy of
         filter (list, optional): Part of label to filter on. Defaults to None. E.g. ['25', '256B'] or simply ['256B'].
 
     Returns:
-        list: joule values
+        np.ndarray: joule values, ordered by operations, payload size and protocol
     """
+    return index.get("joules", section, filters)
 
-    data = []
-    labels = []
-    for label, label_values in data_dictionary.items():
-        if filters and not all([_filter in label.split("_") for _filter in filters]):
-            continue
 
-        labels.append(label)
-        joules = label_values[section][4]
-        data.append(joules)
-        # print(f"Label={label} used {joules} joules")
+def util_render_figures(plot_figure, label_index: LabelIndex, get_section_values, results_dir: str, executor=None):
+    """Render the figure of every number of operations, in the executor if one is given
 
-    return sort_values_by_label(labels, data)
+    A figure only gets the values of its own number of operations, section -> values, so
+    workers of the executor are sent a small slice of the results. Returns the futures of
+    the figures submitted to the executor.
+    """
+    futures = []
+    for number_of_operations in OPERATIONS:
+        section_values = {
+            section: get_section_values(label_index, section, filters=[number_of_operations])
+            for section in SECTIONS.values()
+            if not GET_SECTION_FILTER(section)
+        }
+        if executor is None:
+            util_render_figure(plot_figure, number_of_operations, section_values, results_dir)
+        else:
+            futures.append(executor.submit(
+                uAprofile.in_worker(util_render_figure), plot_figure, number_of_operations, section_values, results_dir
+            ))
+    return futures
 
 
-def util_filter_labels(labels, filters: list):
-    return [
-        label
-        for label in labels
-        if all([_filter in label.split(" ") for _filter in filters])
-    ]
+def util_render_figure(plot_figure, number_of_operations: str, section_values: dict, results_dir: str):
+    with uAprofile.phase(plot_figure.__name__, f"{number_of_operations} operations"):
+        plot_figure(number_of_operations, section_values, results_dir)
 
 
-def plot_joules(data_dictionary):
-    all_labels = [
-        " ".join(label.split(" ")[1:])
-        for label in util_filter_labels(ALL_CONFIGURATION_LABELS, ["tls"])
-    ]
+def plot_joules(label_index: LabelIndex, results_dir: str, executor=None):
+    return util_render_figures(plot_joules_figure, label_index, get_joules_of_section, results_dir, executor)
 
-    for number_of_operations in OPERATIONS:
-        labels = util_filter_labels(all_labels, filters=[number_of_operations])
-        x_labels = list(
-            chain.from_iterable(
-                [
-                    (
-                        "none",
-                        "e2e",
-                        f"\n\n{label.split(' ')[-1]}",
-                        "tls",
-                        "tls+",
-                    )
-                    for label in labels
-                ]
-            )
+
+def plot_time(label_index: LabelIndex, results_dir: str, executor=None):
+    return util_render_figures(plot_time_figure, label_index, get_time_of_section, results_dir, executor)
+
+
+def plot_joules_figure(number_of_operations: str, section_joules: dict, results_dir: str):
+    import matplotlib.pyplot as plt
+
+    labels = CONFIGURATION_LABELS[number_of_operations]
+    x_labels = list(
+        chain.from_iterable(
+            [
+                (
+                    "none",
+                    "e2e",
+                    f"\n\n{label.split(' ')[-1]}",
+                    "tls",
+                    "tls+",
+                )
+                for label in labels
+            ]
         )
+    )
 
-        width = 0.4
-        x = np.arange(len(labels)) * 2
-        xticks = list(
-            chain.from_iterable(
-                [
-                    (
-                        i - width - width / 2,
-                        i - width / 2,
-                        i,
-                        i + width / 2,
-                        i + width + width / 2,
-                    )
-                    for i in x
-                ]
-            )
+    width = 0.4
+    x = np.arange(len(labels)) * 2
+    xticks = list(
+        chain.from_iterable(
+            [
+                (
+                    i - width - width / 2,
+                    i - width / 2,
+                    i,
+                    i + width / 2,
+                    i + width + width / 2,
+                )
+                for i in x
+            ]
         )
-        fig, ax = plt.subplots(figsize=(5, 3), constrained_layout=True)
+    )
+    fig, ax = plt.subplots(figsize=(5, 3), constrained_layout=True)
         
-        y = np.linspace(start=0, stop=6, num=7)
-        plt.yticks(y)
-
-        no_tls_accumulated = [0] * len(labels)
-        tls_accumulated = [0] * len(labels)
-        no_tls_e2e_accumulated = [0] * len(labels)
-        tls_e2e_accumulated = [0] * len(labels)
-        for index, section in enumerate(SECTIONS.values()):
-            if GET_SECTION_FILTER(section):
-                continue
-
-            joules = get_joules_of_section(
-                data_dictionary, section, filters=[number_of_operations]
-            )
+    y = np.linspace(start=0, stop=6, num=7)
+    plt.yticks(y)
+
+    no_tls_accumulated = [0] * len(labels)
+    tls_accumulated = [0] * len(labels)
+    no_tls_e2e_accumulated = [0] * len(labels)
+    tls_e2e_accumulated = [0] * len(labels)
+    for index, section in enumerate(SECTIONS.values()):
+        if GET_SECTION_FILTER(section):
+            continue
+
+        joules = section_joules[section]
             
-            # print(f"joules: {joules}")
+        # print(f"joules: {joules}")
 
-            no_tls_joules = [value for value in joules[0::4]]
-            tls_joules = [value for value in joules[1::4]]
-            no_tls_e2e_joules = [value for value in joules[2::4]]
-            tls_e2e_joules = [value for value in joules[3::4]]
+        no_tls_joules = [value for value in joules[0::4]]
+        tls_joules = [value for value in joules[1::4]]
+        no_tls_e2e_joules = [value for value in joules[2::4]]
+        tls_e2e_joules = [value for value in joules[3::4]]
 
-            # print(f"Joules for {section} section no_tls protocol: no_tls_joules")
-            # print(no_tls_joules)
+        # print(f"Joules for {section} section no_tls protocol: no_tls_joules")
+        # print(no_tls_joules)
             
-            ax.bar(
-                x - width - width / 2,
-                no_tls_joules,
-                width,
-                bottom=no_tls_accumulated,
-                color=COLORS[index],
-                label=section,
-                zorder=3,
-            )
-            ax.bar(
-                x - width / 2,
-                tls_joules,
-                width,
-                bottom=tls_accumulated,
-                color=COLORS[index],
-                zorder=3,
-            )
-
-            ax.bar(
-                x + width / 2,
-                no_tls_e2e_joules,
-                width,
-                bottom=no_tls_e2e_accumulated,
-                color=COLORS[index],
-                zorder=3,
-            )
-
-            ax.bar(
-                x + width + width / 2,
-                tls_e2e_joules,
-                width,
-                bottom=tls_e2e_accumulated,
-                color=COLORS[index],
-                zorder=3,
-            )
-
-            no_tls_accumulated = [
-                accumulated + value
-                for accumulated, value in zip(no_tls_accumulated, no_tls_joules)
-            ]
-            tls_accumulated = [
-                accumulated + value
-                for accumulated, value in zip(tls_accumulated, tls_joules)
-            ]
-            no_tls_e2e_accumulated = [
-                accumulated + value
-                for accumulated, value in zip(no_tls_e2e_accumulated, no_tls_e2e_joules)
-            ]
-            tls_e2e_accumulated = [
-                accumulated + value
-                for accumulated, value in zip(tls_e2e_accumulated, tls_e2e_joules)
-            ]
-
         ax.bar(
             x - width - width / 2,
-            no_tls_accumulated,
+            no_tls_joules,
             width,
-            fill = False,
-            edgecolor="black",
+            bottom=no_tls_accumulated,
+            color=COLORS[index],
+            label=section,
             zorder=3,
         )
         ax.bar(
             x - width / 2,
-            tls_accumulated,
+            tls_joules,
             width,
-            fill = False,
-            edgecolor="black",
+            bottom=tls_accumulated,
+            color=COLORS[index],
             zorder=3,
         )
 
         ax.bar(
             x + width / 2,
-            no_tls_e2e_accumulated,
+            no_tls_e2e_joules,
             width,
-            fill = False,
-            edgecolor="black",
+            bottom=no_tls_e2e_accumulated,
+            color=COLORS[index],
             zorder=3,
         )
 
         ax.bar(
             x + width + width / 2,
-            tls_e2e_accumulated,
+            tls_e2e_joules,
             width,
-            fill = False,
-            edgecolor="black",
+            bottom=tls_e2e_accumulated,
+            color=COLORS[index],
             zorder=3,
         )
 
-        ax.set_ylabel("Energy consumption (Joule)")
-        plt.xticks(xticks, x_labels)
-        
-        ax_labels = ax.get_xticklabels()
-        for index in range(2, len(ax_labels), 5):
-            ax_labels[index-2].set_rotation(-45)
-            ax_labels[index-1].set_rotation(-45)
-            ax_labels[index+1].set_rotation(-45)
-            ax_labels[index+2].set_rotation(-45)
+        no_tls_accumulated = [
+            accumulated + value
+            for accumulated, value in zip(no_tls_accumulated, no_tls_joules)
+        ]
+        tls_accumulated = [
+            accumulated + value
+            for accumulated, value in zip(tls_accumulated, tls_joules)
+        ]
+        no_tls_e2e_accumulated = [
+            accumulated + value
+            for accumulated, value in zip(no_tls_e2e_accumulated, no_tls_e2e_joules)
+        ]
+        tls_e2e_accumulated = [
+            accumulated + value
+            for accumulated, value in zip(tls_e2e_accumulated, tls_e2e_joules)
+        ]
 
+    ax.bar(
+        x - width - width / 2,
+        no_tls_accumulated,
+        width,
+        fill = False,
+        edgecolor="black",
+        zorder=3,
+    )
+    ax.bar(
+        x - width / 2,
+        tls_accumulated,
+        width,
+        fill = False,
+        edgecolor="black",
+        zorder=3,
+    )
 
-        ax.legend(
-            bbox_to_anchor=(0, 1, 1, 0), loc="lower left", mode="expand", ncol=len(x_labels)
-        )
+    ax.bar(
+        x + width / 2,
+        no_tls_e2e_accumulated,
+        width,
+        fill = False,
+        edgecolor="black",
+        zorder=3,
+    )
 
-        plt.savefig(
-            f"{RESULTS_DIR}/energy_stacked_{number_of_operations}-operations.png",
-            transparent=False,
-            orientation="portrait",
-        )
+    ax.bar(
+        x + width + width / 2,
+        tls_e2e_accumulated,
+        width,
+        fill = False,
+        edgecolor="black",
+        zorder=3,
+    )
 
+    ax.set_ylabel("Energy consumption (Joule)")
+    plt.xticks(xticks, x_labels)
+        
+    ax_labels = ax.get_xticklabels()
+    for index in range(2, len(ax_labels), 5):
+        ax_labels[index-2].set_rotation(-45)
+        ax_labels[index-1].set_rotation(-45)
+        ax_labels[index+1].set_rotation(-45)
+        ax_labels[index+2].set_rotation(-45)
 
-def plot_time(data_dictionary):
-    all_labels = [
-        " ".join(label.split(" ")[1:])
-        for label in util_filter_labels(ALL_CONFIGURATION_LABELS, ["tls"])
-    ]
 
-    for number_of_operations in OPERATIONS:
+    ax.legend(
+        bbox_to_anchor=(0, 1, 1, 0), loc="lower left", mode="expand", ncol=len(x_labels)
+    )
+
+    plt.savefig(
+        f"{results_dir}/energy_stacked_{number_of_operations}-operations.png",
+        transparent=False,
+        orientation="portrait",
+    )
+    plt.close(fig)
+
 
-        labels = util_filter_labels(all_labels, filters=[number_of_operations])
-        x_labels = list(
-            chain.from_iterable(
-                [
-                    (
-                        "none",
-                        "e2e",
-                        f"\n\n{label.split(' ')[-1]}",
-                        "tls",
-                        "tls+",
-                    )
-                    for label in labels
-                ]
-            )
+def plot_time_figure(number_of_operations: str, section_times: dict, results_dir: str):
+    import matplotlib.pyplot as plt
+
+    labels = CONFIGURATION_LABELS[number_of_operations]
+    x_labels = list(
+        chain.from_iterable(
+            [
+                (
+                    "none",
+                    "e2e",
+                    f"\n\n{label.split(' ')[-1]}",
+                    "tls",
+                    "tls+",
+                )
+                for label in labels
+            ]
         )
+    )
 
-        width = 0.4
-        x = np.arange(len(labels)) * 2
-        xticks = list(
-            chain.from_iterable(
-                [
-                    (
-                        i - width - width / 2,
-                        i - width / 2,
-                        i,
-                        i + width / 2,
-                        i + width + width / 2,
-                    )
-                    for i in x
-                ]
-            )
+    width = 0.4
+    x = np.arange(len(labels)) * 2
+    xticks = list(
+        chain.from_iterable(
+            [
+                (
+                    i - width - width / 2,
+                    i - width / 2,
+                    i,
+                    i + width / 2,
+                    i + width + width / 2,
+                )
+                for i in x
+            ]
         )
-        fig, ax = plt.subplots(figsize=(5, 3), constrained_layout=True)
+    )
+    fig, ax = plt.subplots(figsize=(5, 3), constrained_layout=True)
         
-        y = np.linspace(start=0, stop=400, num=5)
-        plt.yticks(y)
-        for ytick in y:
-            plt.axhline(y=ytick, color='black', linestyle='-', linewidth=0.5)
-
-        no_tls_accumulated = [0] * len(labels)
-        tls_accumulated = [0] * len(labels)
-        no_tls_e2e_accumulated = [0] * len(labels)
-        tls_e2e_accumulated = [0] * len(labels)
-        for index, section in enumerate(SECTIONS.values()):
-            if GET_SECTION_FILTER(section):
-                continue
-
-            times = get_time_of_section(
-                data_dictionary, section, filters=[number_of_operations]
-            )
-
-            no_tls_times = [value for value in times[0::4]]
-            tls_times = [value for value in times[1::4]]
-            no_tls_e2e_times = [value for value in times[2::4]]
-            tls_e2e_times = [value for value in times[3::4]]
-
-            ax.bar(
-                x - width - width / 2,
-                no_tls_times,
-                width,
-                bottom=no_tls_accumulated,
-                color=COLORS[index],
-                label=section,
-                zorder=3,
-            )
-            ax.bar(
-                x - width / 2,
-                tls_times,
-                width,
-                bottom=tls_accumulated,
-                color=COLORS[index],
-                zorder=3,
-            )
-            ax.bar(
-                x + width / 2,
-                no_tls_e2e_times,
-                width,
-                bottom=no_tls_e2e_accumulated,
-                color=COLORS[index],
-                zorder=3,
-            )
-            ax.bar(
-                x + width + width / 2,
-                tls_e2e_times,
-                width,
-                bottom=tls_e2e_accumulated,
-                color=COLORS[index],
-                zorder=3,
-            )
-
-            no_tls_accumulated = [
-                accumulated + value
-                for accumulated, value in zip(no_tls_accumulated, no_tls_times)
-            ]
-            tls_accumulated = [
-                accumulated + value
-                for accumulated, value in zip(tls_accumulated, tls_times)
-            ]
-            no_tls_e2e_accumulated = [
-                accumulated + value
-                for accumulated, value in zip(no_tls_e2e_accumulated, no_tls_e2e_times)
-            ]
-            tls_e2e_accumulated = [
-                accumulated + value
-                for accumulated, value in zip(tls_e2e_accumulated, tls_e2e_times)
-            ]
-            
+    y = np.linspace(start=0, stop=400, num=5)
+    plt.yticks(y)
+    for ytick in y:
+        plt.axhline(y=ytick, color='black', linestyle='-', linewidth=0.5)
+
+    no_tls_accumulated = [0] * len(labels)
+    tls_accumulated = [0] * len(labels)
+    no_tls_e2e_accumulated = [0] * len(labels)
+    tls_e2e_accumulated = [0] * len(labels)
+    for index, section in enumerate(SECTIONS.values()):
+        if GET_SECTION_FILTER(section):
+            continue
+
+        times = section_times[section]
+
+        no_tls_times = [value for value in times[0::4]]
+        tls_times = [value for value in times[1::4]]
+        no_tls_e2e_times = [value for value in times[2::4]]
+        tls_e2e_times = [value for value in times[3::4]]
+
         ax.bar(
             x - width - width / 2,
-            no_tls_accumulated,
+            no_tls_times,
             width,
-            fill = False,
-            edgecolor="black",
+            bottom=no_tls_accumulated,
+            color=COLORS[index],
+            label=section,
             zorder=3,
         )
         ax.bar(
             x - width / 2,
-            tls_accumulated,
+            tls_times,
             width,
-            fill = False,
-            edgecolor="black",
+            bottom=tls_accumulated,
+            color=COLORS[index],
             zorder=3,
         )
-
         ax.bar(
             x + width / 2,
-            no_tls_e2e_accumulated,
+            no_tls_e2e_times,
             width,
-            fill = False,
-            edgecolor="black",
+            bottom=no_tls_e2e_accumulated,
+            color=COLORS[index],
             zorder=3,
         )
-
         ax.bar(
             x + width + width / 2,
-            tls_e2e_accumulated,
+            tls_e2e_times,
             width,
-            fill = False,
-            edgecolor="black",
+            bottom=tls_e2e_accumulated,
+            color=COLORS[index],
             zorder=3,
         )
+
+        no_tls_accumulated = [
+            accumulated + value
+            for accumulated, value in zip(no_tls_accumulated, no_tls_times)
+        ]
+        tls_accumulated = [
+            accumulated + value
+            for accumulated, value in zip(tls_accumulated, tls_times)
+        ]
+        no_tls_e2e_accumulated = [
+            accumulated + value
+            for accumulated, value in zip(no_tls_e2e_accumulated, no_tls_e2e_times)
+        ]
+        tls_e2e_accumulated = [
+            accumulated + value
+            for accumulated, value in zip(tls_e2e_accumulated, tls_e2e_times)
+        ]
+            
+    ax.bar(
+        x - width - width / 2,
+        no_tls_accumulated,
+        width,
+        fill = False,
+        edgecolor="black",
+        zorder=3,
+    )
+    ax.bar(
+        x - width / 2,
+        tls_accumulated,
+        width,
+        fill = False,
+        edgecolor="black",
+        zorder=3,
+    )
+
+    ax.bar(
+        x + width / 2,
+        no_tls_e2e_accumulated,
+        width,
+        fill = False,
+        edgecolor="black",
+        zorder=3,
+    )
+
+    ax.bar(
+        x + width + width / 2,
+        tls_e2e_accumulated,
+        width,
+        fill = False,
+        edgecolor="black",
+        zorder=3,
+    )
         
-        ax.set_ylabel("Time consumption (Seconds)")
+    ax.set_ylabel("Time consumption (Seconds)")
         
-        plt.xticks(xticks, x_labels)
+    plt.xticks(xticks, x_labels)
         
-        ax_labels = ax.get_xticklabels()
-        for index in range(2, len(ax_labels), 5):
-            ax_labels[index-2].set_rotation(-45)
-            ax_labels[index-1].set_rotation(-45)
-            ax_labels[index+1].set_rotation(-45)
-            ax_labels[index+2].set_rotation(-45)
-
-        ax.legend(
-            bbox_to_anchor=(0, 1, 1, 0), loc="lower left", mode="expand", ncol=len(x_labels)
-        )
+    ax_labels = ax.get_xticklabels()
+    for index in range(2, len(ax_labels), 5):
+        ax_labels[index-2].set_rotation(-45)
+        ax_labels[index-1].set_rotation(-45)
+        ax_labels[index+1].set_rotation(-45)
+        ax_labels[index+2].set_rotation(-45)
+
+    ax.legend(
+        bbox_to_anchor=(0, 1, 1, 0), loc="lower left", mode="expand", ncol=len(x_labels)
+    )
 
-        plt.savefig(
-            f"{RESULTS_DIR}/time_stacked_{number_of_operations}-operations.png",
-            transparent=False,
-            orientation="portrait",
-        )
+    plt.savefig(
+        f"{results_dir}/time_stacked_{number_of_operations}-operations.png",
+        transparent=False,
+        orientation="portrait",
+    )
+    plt.close(fig)
 
 
 def log_theoretical_and_real_value_differences(data_dictionary):
@@ -629,6 +609,8 @@ def detailed_analytics(data_dictionary):
     def get_percent(fraction, total):
         return f"{round((fraction/total) * 100, 2)}\%"
 
+    # The labels of data_dictionary are sorted by operations and payload size already, so the
+    # rows of every protocol are appended in order
     times_grouped_by_protocol_dict = {}
     joules_grouped_by_protocol_dict = {}
 
@@ -705,17 +687,6 @@ def detailed_analytics(data_dictionary):
             + "\n"
         )
 
-    for output_time_string_list, output_power_string_list in zip(
-        times_grouped_by_protocol_dict.values(),
-        joules_grouped_by_protocol_dict.values(),
-    ):
-        output_time_string_list.sort(
-            key=lambda o_string: util_sorter(o_string.split(",")[0].split(" "))
-        )
-        output_power_string_list.sort(
-            key=lambda o_string: util_sorter(o_string.split(",")[0].split(" "))
-        )
-
     for protocol, output_string in joules_grouped_by_protocol_dict.items():
         file_path = f"time_distribution_{protocol}.csv"
         file = open(file_path, "x")
@@ -729,32 +700,100 @@ def detailed_analytics(data_dictionary):
     return
 
 
-def MAIN():
+def util_set_plot_style():
+    import matplotlib.pyplot as plt
+
+    plt.rc('font', size=9) #controls default text size
+    plt.rc('axes', titlesize=9) #fontsize of the title
+    plt.rc('axes', labelsize=9) #fontsize of the x and y labels
+    plt.rc('xtick', labelsize=9) #fontsize of the x tick labels
+    plt.rc('ytick', labelsize=9) #fontsize of the y tick labels
+    plt.rc('legend', fontsize=9) #fontsize of the legend
+
+
+def util_init_plot_worker():
+    import matplotlib.pyplot as plt
+
+    # Workers never show figures, and need the style of the main process to render identical files
+    plt.switch_backend("Agg")
+    util_set_plot_style()
+
+
+def parse_arguments(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Command line tool for plotting results from uAnalyser tool, authored by Ådne Karstad @aadnekar"
+    )
+
+    parser.add_argument(
+        "--path",
+        "-p",
+        default=DEFAULT_SOURCE_FILE,
+        help="Relative path to source file",
+    )
+
+    parser.add_argument(
+        "--output",
+        "-o",
+        default=DEFAULT_RESULTS_DIR,
+        help="Relative path to output directory",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="number of worker processes rendering figures in parallel.",
+    )
+
+    uAprofile.add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def MAIN(args):
     """
-    Dictionary outline:
+    Results are a structured array of uAresults, one row per label and section, sorted by
+    operations, payload size and protocol.
+
+    Dictionary outline, used by the analytics below:
     label -> section -> [
         index 0: count,
         index 1: average_current,
         index 2: total_current,
-        index 3: time
+        index 3: time,
+        index 4: joules
     ]
     """
-    data_dictionary = parse_file_data_to_dictionary()
-    
-    plt.rc('font', size=9) #controls default text size
-    plt.rc('axes', titlesize=9) #fontsize of the title
-    plt.rc('axes', labelsize=9) #fontsize of the x and y labels
-    plt.rc('xtick', labelsize=9) #fontsize of the x tick labels
-    plt.rc('ytick', labelsize=9) #fontsize of the y tick labels
-    plt.rc('legend', fontsize=9) #fontsize of the legend
+    if not os.path.isdir(args.output):
+        os.mkdir(args.output)
+
+    results = parse_file_data(args.path)
+    with uAprofile.phase("index", args.path, rows=len(results)):
+        label_index = LabelIndex(results)
+
+    util_set_plot_style()
+    if args.jobs > 1:
+        # Figures are independent, every worker renders whole figures to file with Agg
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=util_init_plot_worker) as executor:
+            futures = plot_joules(label_index, args.output, executor) + plot_time(label_index, args.output, executor)
+            for future in futures:
+                uAprofile.collect(future.result())
+    else:
+        plot_joules(label_index, args.output)
+        plot_time(label_index, args.output)
+
+    # The analytics take the results as a dictionary, from uAresults import to_dictionary
+    # log_theoretical_and_real_value_differences(to_dictionary(results))
 
-    plot_joules(data_dictionary)
-    plot_time(data_dictionary)
+    # detailed_analytics(to_dictionary(results))
 
-    # log_theoretical_and_real_value_differences(data_dictionary)
 
-    # detailed_analytics(data_dictionary)
+def main(argv: list = None):
+    args = parse_arguments(argv)
+    with uAprofile.profile_run(args, "plotter"):
+        MAIN(args)
 
 
 if __name__ == "__main__":
-    MAIN()
+    main()
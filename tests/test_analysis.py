@@ -0,0 +1,87 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import benchmark  # noqa: E402
+import uAnalyser  # noqa: E402
+
+# Enough samples for a few compute, send and sleep cycles with modem bursts
+ROWS = 150000
+SLEEP_THRESHOLDS = (5, 9, 15)
+
+
+@pytest.fixture(scope="module")
+def capture(tmp_path_factory):
+    capture = tmp_path_factory.mktemp("captures") / "tls_10_256B.csv"
+    benchmark.generate_capture(str(capture), ROWS, seed=0)
+    return str(capture)
+
+
+def util_result_lines(capture: str, **options) -> str:
+    return uAnalyser.format_section_results("capture", uAnalyser.analyse_file_with_engine(capture, uAnalyser.AnalysisOptions(**options)))
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"engine": "numpy"},
+        {"engine": "mmap"},
+        {"engine": "pipeline"},
+        # Buffers far smaller than the capture, so lines are carried over between them
+        {"engine": "pipeline", "buffer_size": 64 * 1024, "queue_depth": 2},
+    ],
+)
+def test_engines_match_python_engine(capture, options):
+    assert util_result_lines(capture, **options) == util_result_lines(capture, engine="python")
+
+
+@pytest.mark.parametrize("engine", ["numpy", "mmap"])
+def test_sweep_matches_single_threshold_runs(capture, monkeypatch, engine):
+    sweep = uAnalyser.analyse_file_with_engine(
+        capture, uAnalyser.AnalysisOptions(engine, statistics=True, sleep_thresholds=SLEEP_THRESHOLDS)
+    )
+    assert len(sweep) == len(SLEEP_THRESHOLDS)
+    for threshold, section_results in zip(SLEEP_THRESHOLDS, sweep):
+        monkeypatch.setattr(uAnalyser, "SLEEP_THRESHOLD", threshold)
+        expected = util_result_lines(capture, engine=engine, statistics=True)
+        assert uAnalyser.format_section_results("capture", section_results) == expected
+
+
+def test_chunks_match_sequential_pass(capture, tmp_path):
+    sequential = uAnalyser.analyse_file_with_engine(
+        capture, uAnalyser.AnalysisOptions("numpy", segment_directory=str(tmp_path / "sequential"))
+    )
+    chunked = uAnalyser.analyse_file_with_engine(
+        capture, uAnalyser.AnalysisOptions("numpy", chunks=3, segment_directory=str(tmp_path / "chunked"))
+    )
+
+    # Counts are exact, sums are rounded per chunk, see analyse_file_chunked
+    for section in uAnalyser.SECTION_NAMES:
+        counter, current, time, joules = chunked[section]
+        assert counter == sequential[section][0]
+        assert [current, time, joules] == pytest.approx(sequential[section][1:4], rel=1e-12)
+
+    sequential_segments = np.load(tmp_path / "sequential" / "tls_10_256B.npy")
+    chunked_segments = np.load(tmp_path / "chunked" / "tls_10_256B.npy")
+    assert len(chunked_segments) == len(sequential_segments)
+    for field in ("start", "length", "section", "system_length"):
+        assert np.array_equal(chunked_segments[field], sequential_segments[field])
+    for field in ("current", "system_current"):
+        assert np.allclose(chunked_segments[field], sequential_segments[field], rtol=1e-12, atol=0)
+
+
+def test_segments_add_up_to_section_results(capture, tmp_path):
+    section_results = uAnalyser.analyse_file_with_engine(
+        capture, uAnalyser.AnalysisOptions("numpy", segment_directory=str(tmp_path))
+    )
+    segments = np.load(tmp_path / "tls_10_256B.npy")
+    sleep = segments[segments["section"] == uAnalyser.SECTION.SLEEP.value]
+
+    assert segments["length"].sum() == section_results["total"][0]
+    assert sleep["length"].sum() - sleep["system_length"].sum() == section_results["sleep"][0]
+    assert segments["system_length"].sum() == section_results["system"][0]
+    assert segments["current"].sum() == pytest.approx(section_results["total"][1], rel=1e-12)
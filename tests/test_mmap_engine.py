@@ -0,0 +1,30 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import uAnalyser  # noqa: E402
+
+HEADER = "Timestamp(ms),Current(uA),D0-D7\n"
+
+
+def test_malformed_capture_raises_value_error(tmp_path):
+    capture = tmp_path / "malformed.csv"
+    capture.write_text(HEADER + "0.00,1.5,00000000\nnot a sample\n0.02,1.5,00000000\n")
+    # The mmap must close cleanly, without a BufferError chained to the ValueError
+    with pytest.raises(ValueError, match="timestamp,current,pins") as raised:
+        list(uAnalyser.read_samples(str(capture), "mmap"))
+    assert raised.value.__context__ is None
+
+
+def test_mmap_engine_matches_numpy_engine(tmp_path):
+    capture = tmp_path / "capture.csv"
+    capture.write_text(HEADER + "".join(f"{index / 100:.2f},{index * 0.37 - 5:.15g},{index % 256:08b}\n" for index in range(1000)))
+    numpy_samples = list(uAnalyser.read_samples(str(capture), "numpy"))
+    mmap_samples = list(uAnalyser.read_samples(str(capture), "mmap"))
+    assert len(numpy_samples) == len(mmap_samples)
+    for numpy_arrays, mmap_arrays in zip(numpy_samples, mmap_samples):
+        for numpy_array, mmap_array in zip(numpy_arrays, mmap_arrays):
+            assert numpy_array.tolist() == mmap_array.tolist()
@@ -4,34 +4,257 @@ Used in collaboration with Nordic Semiconductor and NTNU
 """
 
 import argparse
-from math import sqrt
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import lzma
+import mmap
 import os
+import queue
+import shutil
+import struct
 import sys
-from colored import fg
+import tempfile
+import threading
+import time
+import numpy as np
+try:
+    import tomllib
+except ModuleNotFoundError:
+    # Python < 3.11, pin maps are then read with the tomli package if it is installed
+    try:
+        import tomli as tomllib
+    except ModuleNotFoundError:
+        tomllib = None
+try:
+    import zstandard
+except ModuleNotFoundError:
+    # Only needed to read .csv.zst captures
+    zstandard = None
 from enum import Enum
+from uApyramid import PYRAMID_NOT_RUNNING, PyramidBuilder, util_pyramid_path
+from uAresults import (
+    REPEAT_STATISTICS,
+    SUPPLY_VOLTAGE,
+    aggregate_repeats,
+    label_order,
+    label_sort_key,
+    make_results,
+    save_results,
+)
+from uAstats import QuantileSketch, RunningMoments
+import uAprofile
+
+# Terminal colors of the colored package, which is only imported once something is printed in color
+SUCCESS_COLOR = 'green'
+ERROR_COLOR = 'red'
+INFO_COLOR = 'blue'
+
+
+def util_color(color: str) -> str:
+    from colored import fg
+    return fg(color)
 
-SUCCESS_COLOR = fg('green')
-ERROR_COLOR = fg('red')
-INFO_COLOR = fg('blue')
 
 parser = argparse.ArgumentParser(
     description="Command line tool for analysing power profile data, authored by Ådne Karstad @aadnekar"
 )
+parser.add_argument(
+    "command",
+    nargs="?",
+    choices=["analyse", "sleep", "convert", "pyramid", "aggregate"],
+    default="analyse",
+    help="'analyse' splits the current of every file into sections, 'sleep' computes current statistics of the first file given to --path, "
+    "'convert' writes a binary capture cache next to every file, which is used instead of the file by later analyses, "
+    "'pyramid' writes a memory-mappable pyramid of the current per 10, 100, 1k and 10k samples next to every file for uAplotter, "
+    "and 'aggregate' analyses repeated captures, files with the same label in different directories, and writes the mean, median, "
+    "min, max and a bootstrap confidence interval of the mean of every section across the repeats, one result file per statistic.",
+)
 parser.add_argument(
     "--path",
     nargs="+",
     required=True,
-    help="relative path to source file to analyse. Provide several path's to compare results or a directory to analyse all files in that directory.",
+    help="relative path to source file to analyse. Provide several path's to compare results or a directory to analyse all files in that directory. "
+    "Captures compressed to .csv.gz, .csv.xz or .csv.zst (with the zstandard package) are decompressed while they are analysed.",
 )
 
 parser.add_argument(
     "--output",
     "-o",
     type=str,
-    required=True,
-    help="path to result file. The file must not exist from before.",
+    help="path to result file. The file must not exist from before. Required by 'analyse', 'sleep' and 'aggregate', "
+    "which adds the statistic to the name of every result file, e.g. results_median.csv.",
+)
+
+parser.add_argument(
+    "--engine",
+    choices=["python", "numpy", "mmap", "pipeline"],
+    default="python",
+    help="classification engine. 'python' handles one sample at a time, 'numpy' classifies chunks of samples as arrays "
+    "and 'mmap' parses the samples straight out of a memory-mapped file into arrays. 'pipeline' parses like 'mmap' "
+    "while a separate thread reads the next buffers of the file, for captures on slow or network storage. "
+    "All produce identical results.",
+)
+
+parser.add_argument(
+    "--buffer-size",
+    type=int,
+    default=None,
+    help="number of MiB the pipeline engine reads into each buffer, defaults to 32.",
+)
+
+parser.add_argument(
+    "--queue-depth",
+    type=int,
+    default=None,
+    help="number of read buffers the pipeline engine keeps waiting to be parsed, defaults to 4.",
+)
+
+parser.add_argument(
+    "--resamples",
+    type=int,
+    default=1000,
+    help="number of bootstrap resamples of the confidence interval of 'aggregate'.",
+)
+
+parser.add_argument(
+    "--confidence",
+    type=float,
+    default=0.95,
+    help="confidence level of the bootstrap confidence interval of 'aggregate', between 0 and 1.",
+)
+
+parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="number of worker processes analysing files in parallel.",
+)
+
+parser.add_argument(
+    "--chunks",
+    type=int,
+    default=1,
+    help="split each file into this many chunks and classify them in parallel with the numpy, mmap or pipeline engine. "
+    "Sums of current and time may differ from a sequential pass by rounding, see analyse_file_chunked.",
+)
+
+parser.add_argument(
+    "--statistics",
+    action="store_true",
+    help="add the variance, standard deviation, peak and p50/p95/p99 current of each section to the result file. "
+    "Computed in the same single pass by the numpy engine, also when --engine python is given.",
+)
+
+parser.add_argument(
+    "--sleep-threshold-sweep",
+    type=lambda value: tuple(float(threshold) for threshold in value.split(",")),
+    default=(),
+    metavar="THRESHOLDS",
+    help="comma separated SLEEP_THRESHOLD values, e.g. 5,9,15,20. Every file is read once and the result file "
+    "is written once per threshold, with the threshold added to its name. Computed by the numpy engine.",
+)
+
+parser.add_argument(
+    "--timing",
+    choices=["accumulate", "samples", "timestamps"],
+    help="how the time of a section is calculated. 'accumulate' adds TIME_DELTA once per sample, the default of 'analyse'. "
+    "'samples' multiplies the number of samples by TIME_DELTA. 'timestamps' integrates the time between the timestamps of "
+    "consecutive samples, the default of 'sleep', and writes dropped and out of order samples to <output>_gaps.csv. "
+    "'analyse' computes anything but 'accumulate' with the numpy engine.",
 )
-args = parser.parse_args()
+
+parser.add_argument(
+    "--voltage",
+    type=float,
+    help="supply voltage (V) of the device, used to integrate the energy of every section. Defaults to SUPPLY_VOLTAGE, 3.7 V.",
+)
+
+parser.add_argument(
+    "--follow",
+    action="store_true",
+    help="keep reading the file given to --path while it is being captured and print the running results of every section. "
+    "Stop with Ctrl+C, the results so far are then written to the result file.",
+)
+
+parser.add_argument(
+    "--interval",
+    type=float,
+    default=1.0,
+    help="seconds between the running results printed by --follow.",
+)
+
+parser.add_argument(
+    "--segments",
+    action="store_true",
+    help="save a run-length index of the section segments of every file, e.g. each send burst or sleep period, to "
+    "<output>_segments/<label>.npy. Sleep samples above the sleep threshold are counted in the system_length and "
+    "system_current of their segment. Built in the same single pass by the numpy engine. Files are then always analysed, without the result cache.",
+)
+
+parser.add_argument(
+    "--pin-map",
+    type=str,
+    help="TOML file describing which pins carry the application health, main, state and modem signals and the section of every "
+    "state code, see pin_map.toml for the layout this tool defaults to. Lets captures of other firmware be analysed without code edits.",
+)
+
+parser.add_argument(
+    "--cache",
+    type=str,
+    default=os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser(os.path.join("~", ".cache"))), "uAnalyser", "results.json"),
+    help="path to the result cache. Files that are unchanged since their last analysis with the same parameters are not analysed again.",
+)
+
+parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="analyse every file, without reading or updating the result cache.",
+)
+
+uAprofile.add_arguments(parser)
+
+
+def parse_arguments(argv: list = None):
+    """Parse and check the command line, and apply its --pin-map to this process"""
+    args = parser.parse_args(argv)
+
+    if args.command not in ("convert", "pyramid") and not args.output:
+        parser.error(f"the following arguments are required for '{args.command}': --output/-o")
+
+    if args.jobs > 1 and args.chunks > 1:
+        parser.error("--jobs and --chunks can not be combined, pick one level of parallelism")
+
+    if args.follow and (len(args.path) > 1 or args.sleep_threshold_sweep):
+        parser.error("--follow reads a single file and can not be combined with --sleep-threshold-sweep")
+
+    if args.segments and (args.follow or args.sleep_threshold_sweep):
+        parser.error("--segments can not be combined with --follow or --sleep-threshold-sweep")
+
+    if args.command == "aggregate" and (args.follow or args.sleep_threshold_sweep):
+        parser.error("'aggregate' can not be combined with --follow or --sleep-threshold-sweep")
+
+    if args.resamples < 1 or not 0 < args.confidence < 1:
+        parser.error("--resamples must be at least 1 and --confidence between 0 and 1")
+
+    if (args.buffer_size is not None or args.queue_depth is not None) and args.engine != "pipeline":
+        parser.error("--buffer-size and --queue-depth are options of --engine pipeline")
+
+    if (args.buffer_size is not None and args.buffer_size < 1) or (args.queue_depth is not None and args.queue_depth < 1):
+        parser.error("--buffer-size and --queue-depth must be at least 1")
+
+    if args.pin_map:
+        try:
+            set_pin_map(load_pin_map(args.pin_map))
+        except (OSError, ValueError) as error:
+            parser.error(f"invalid pin map {args.pin_map}: {error}")
+    return args
 
 # Intuitive choice, not generic in other cases
 MAX_SLEEP_CURRENT = 20000
@@ -41,11 +264,65 @@ TIME_DELTA = 0.01
 
 SLEEP_THRESHOLD = 9
 
-PIN_MODEM       = 0
-APP_STATE_PINS  = [1, 5]
-PIN_MAIN        = 5
-PIN_GENERAL_1   = 6
-PIN_GENERAL_2   = 7
+PIN_COUNT       = 8
+
+# Pin layout of the firmware, replaced by the file given to --pin-map. Pin n is character n of the
+# D0-D7 column. The application runs while its health pins hold the running code and the main pin
+# is high, its state pins (first pin first) then give the section, and samples of the modem
+# sections are in the modem section while the modem pin is high.
+DEFAULT_PIN_MAP = {
+    "application": {"pins": [1, 2, 3, 4], "running": "0010", "main": 5},
+    "state": {"pins": [6, 7], "sections": {"00": "setup", "01": "compute", "10": "send", "11": "sleep"}},
+    "modem": {"pin": 0, "sections": ["sleep"]},
+}
+
+# Number of samples the numpy engine parses and classifies at a time
+NUMPY_CHUNK_SIZE = 1000000
+
+# Number of bytes the mmap and pipeline engines parse and classify at a time. Parsing takes
+# about seven times the size of a block in temporary arrays
+MMAP_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Compressed captures are decompressed on a separate thread in blocks of this many bytes, while
+# earlier blocks are parsed. At most DECOMPRESS_QUEUE_DEPTH blocks wait to be parsed
+DECOMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+DECOMPRESS_QUEUE_DEPTH = 4
+
+# The pipeline engine reads captures on a separate thread in buffers of this many bytes, while
+# earlier buffers are parsed. At most PIPELINE_QUEUE_DEPTH buffers wait to be parsed
+PIPELINE_BUFFER_SIZE = 32 * 1024 * 1024
+PIPELINE_QUEUE_DEPTH = 4
+COMPRESSED_EXTENSIONS = (".gz", ".xz", ".zst")
+CAPTURE_EXTENSIONS = (".csv",) + tuple(".csv" + extension for extension in COMPRESSED_EXTENSIONS)
+
+# Longest number the mmap engine parses without falling back to numpy's string conversion
+FIELD_WIDTH = 24
+
+# Binary capture cache: a header followed by a float64 timestamp column, a float32 current column
+# and a uint8 pin bitmask column
+CAPTURE_CACHE_EXTENSION = ".uacap"
+CAPTURE_CACHE_MAGIC = b"uACAP002"
+# magic, number of samples
+CAPTURE_CACHE_HEADER = struct.Struct("<8sQ")
+# Size reserved for the header, keeps the columns aligned
+CAPTURE_CACHE_HEADER_SIZE = 64
+
+# Samples further apart than this many TIME_DELTA are reported as a gap with dropped samples
+GAP_TOLERANCE = 1.5
+GAP_HEADER = "Label, Sample, Previous Timestamp (ms), Timestamp (ms), Kind"
+
+# Seconds --follow waits before looking for new samples again
+FOLLOW_POLL_INTERVAL = 0.05
+# Largest number of new bytes --follow parses at a time
+FOLLOW_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Result cache entries kept, the least recently used are evicted first
+RESULT_CACHE_MAX_ENTRIES = 4096
+# Bumped whenever the classification changes in a way the analysis parameters do not show
+RESULT_CACHE_VERSION = 2
+
+# Exact powers of ten, a decimal with at most 15 digits divided by one of these is correctly rounded
+POWERS_OF_TEN = 10.0 ** np.arange(23)
 
 
 class SECTION(Enum):
@@ -57,259 +334,2028 @@ class SECTION(Enum):
     MODEM   = 5
 
 
-RUNNING    = 'RUNNING'
-FINISHED   = 'FINISHED'
-SETUP      = 'SETUP'
-COMPUTE    = 'COMPUTE'
-SEND       = 'SEND'
-SLEEP      = 'SLEEP'
-
-APP_STATE = {
-    RUNNING:  '0010',
-    FINISHED: '0001',
-    SETUP:    '00',
-    COMPUTE:  '01',
-    SEND:     '10',
-    SLEEP:    '11',
-    
-}
+# Order of the sections in the result file
+SECTION_NAMES = ["total", "setup", "compute", "send", "sleep", "modem", "system"]
+
+RESULT_HEADER = "Label, Section, Number of samples, Average Current (uA), Total Current (uA) ,Total time(ms), Energy consumption (joules)"
+STATISTICS_HEADER = ", Variance (uA^2), Standard Deviation (uA), Peak Current (uA), p50 Current (uA), p95 Current (uA), p99 Current (uA)"
 
-def application_is_running(pins):
-    """returns boolean True if pins indicate the app is stilling running healthy"""
-    return pins == APP_STATE[RUNNING]
+# Quantiles reported by --statistics, estimated within 1% of the true current
+STATISTICS_QUANTILES = [0.5, 0.95, 0.99]
+
+# Section value of the pin lookup table for samples outside the running application, the same as in pyramids
+PIN_MAP_NOT_RUNNING = PYRAMID_NOT_RUNNING
+
+SAMPLE_DTYPE = np.dtype([("timestamp", np.float64), ("current", np.float64), ("pins", f"S{PIN_COUNT}")])
+
+# One run of consecutive running samples in the same section. start is the index of the first
+# sample among all samples of the file, section a SECTION value of the pins and current the summed
+# current (uA). Sleep samples drawing more than the sleep threshold are counted in system_length
+# and system_current rather than ending the segment
+SEGMENT_DTYPE = np.dtype([
+    ("start", np.int64),
+    ("length", np.int64),
+    ("section", np.uint8),
+    ("current", np.float64),
+    ("system_length", np.int64),
+    ("system_current", np.float64),
+])
+
+def util_pin_code(bitmasks, pins: list):
+    """The code held by pins in every pin bitmask, the first pin being the most significant bit"""
+    code = np.zeros_like(bitmasks)
+    for pin in pins:
+        code = code << 1 | (bitmasks >> pin) & 1
+    return code
+
+
+def compile_pin_map(pin_map: dict):
+    """Compile a pin map, laid out like DEFAULT_PIN_MAP, into lookup tables indexed by the pin bitmask of a sample
+
+    Raises:
+        ValueError: when the pin map is incomplete, uses pins that do not exist or names an unknown section
+
+    Returns:
+        (np.ndarray, np.ndarray): the SECTION value of every bitmask, PIN_MAP_NOT_RUNNING outside
+        the running application, and whether the application is running by its health pins alone
+    """
+    bitmasks = np.arange(1 << PIN_COUNT)
+    try:
+        application, state, modem = pin_map["application"], pin_map["state"], pin_map["modem"]
+        pins = [*application["pins"], application["main"], *state["pins"], modem["pin"]]
+        if any(not 0 <= pin < PIN_COUNT for pin in pins):
+            raise ValueError(f"pins are numbered 0 to {PIN_COUNT - 1}")
+        if len(application["running"]) != len(application["pins"]):
+            raise ValueError("the running code needs one digit per application pin")
+
+        application_running = util_pin_code(bitmasks, application["pins"]) == int(application["running"], 2)
+        running = application_running & ((bitmasks >> application["main"]) & 1 == 1)
+
+        section_of_code = np.full(1 << len(state["pins"]), -1)
+        for code, section in state["sections"].items():
+            if len(code) != len(state["pins"]):
+                raise ValueError(f"state code {code} needs one digit per state pin")
+            section_of_code[int(code, 2)] = SECTION[section.upper()].value
+        if np.any(section_of_code < 0):
+            missing = [format(code, f"0{len(state['pins'])}b") for code in np.flatnonzero(section_of_code < 0)]
+            raise ValueError(f"state codes {', '.join(missing)} have no section")
+        sections = section_of_code[util_pin_code(bitmasks, state["pins"])]
+
+        modem_sections = [SECTION[section.upper()].value for section in modem["sections"]]
+    except KeyError as error:
+        raise ValueError(f"missing setting or unknown section {error}") from None
+    sections[np.isin(sections, modem_sections) & ((bitmasks >> modem["pin"]) & 1 == 1)] = SECTION.MODEM.value
+    sections[~running] = PIN_MAP_NOT_RUNNING
+    return sections.astype(np.uint8), application_running
+
+
+def load_pin_map(file_path: str) -> dict:
+    if tomllib is None:
+        raise ValueError("reading a pin map needs Python 3.11 or the tomli package")
+    with open(file_path, "rb") as pin_map_file:
+        return tomllib.load(pin_map_file)
+
+
+def util_pin_string_table(table) -> dict:
+    """A lookup table keyed by the PPK pin string of every bitmask, e.g. '00010011' for 0b11001000"""
+    return {
+        "".join("1" if bitmask >> pin & 1 else "0" for pin in range(PIN_COUNT)): value
+        for bitmask, value in enumerate(table.tolist())
+    }
+
+
+PIN_SECTIONS, PIN_APPLICATION_RUNNING = compile_pin_map(DEFAULT_PIN_MAP)
+
+
+def set_pin_tables(pin_sections, application_running):
+    """Classify the samples of this process with compiled pin tables, also the initializer of worker processes"""
+    global PIN_SECTIONS, PIN_APPLICATION_RUNNING
+    PIN_SECTIONS, PIN_APPLICATION_RUNNING = pin_sections, application_running
+
+
+def set_pin_map(pin_map: dict):
+    """Classify the samples of this process, and of the worker processes it starts, with a pin map"""
+    set_pin_tables(*compile_pin_map(pin_map))
+
+
+def util_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """A pool of worker processes classifying with the pin tables of this process, whatever the start method"""
+    return ProcessPoolExecutor(
+        max_workers=max_workers, initializer=set_pin_tables, initargs=(PIN_SECTIONS, PIN_APPLICATION_RUNNING)
+    )
 
-def application_is_finished(pins):
-    """returns boolean True if pins indicate the app has finished in a  healthy mannor"""
-    return pins == APP_STATE[FINISHED]
 
 def get_label_from_file_path(file_path: str) -> str:
     return file_path.split('/')[-1].split('.')[0]
 
-def MAIN():
-    print(INFO_COLOR + "Starting uAnalyser script")
-    if os.path.isfile(args.output):
+def analyse_file(file_path: str, voltage: float = SUPPLY_VOLTAGE) -> dict:
+    """Classify every sample of a power profiler file, one sample at a time
+
+    Returns:
+        dict: section name -> [number of samples, total current, total time, energy]
+    """
+    file = open_capture(file_path, "r")
+
+    # Track the total current drawn for each section
+    current_total   = 0
+    current_setup   = 0
+    current_compute = 0
+    current_send    = 0
+    current_sleep   = 0
+    current_modem   = 0
+    current_system  = 0
+
+    # Track the number of measurements for each section
+    counter_total   = 0
+    counter_setup   = 0
+    counter_compute = 0
+    counter_send    = 0
+    counter_sleep   = 0
+    counter_modem   = 0
+    counter_system  = 0
+
+    # Track the total time of each section
+    time_total      = 0
+    time_setup      = 0
+    time_compute    = 0
+    time_send       = 0
+    time_sleep      = 0
+    time_modem      = 0
+    time_system     = 0
+
+    # Track the charge (uA*ms) of each section, integrated over the timestamps with the trapezoidal rule
+    charge_total    = 0
+    charge_setup    = 0
+    charge_compute  = 0
+    charge_send     = 0
+    charge_sleep    = 0
+    charge_modem    = 0
+    charge_system   = 0
+    previous_sample_timestamp = None
+    previous_sample_current = None
+    previous_sample_parsed = True
+    # Looking the pin string up in a dict is faster than decoding it one sample at a time, and
+    # local section values are faster than the attributes of SECTION
+    pin_sections = util_pin_string_table(PIN_SECTIONS)
+    setup, compute, send, sleep, modem = (
+        SECTION.SETUP.value, SECTION.COMPUTE.value, SECTION.SEND.value, SECTION.SLEEP.value, SECTION.MODEM.value
+    )
+    
+    # [current, counter, time]
+    
+    # SYSTEM_INDEX_CURRENT = 0
+    # SYSTEM_INDEX_COUNT   = 1
+    # SYSTEM_INDEX_TIME    = 0
+    
+    # system_values = {
+    #     10:     [0]*3,
+    #     20:     [0]*3,
+    #     40:     [0]*3,
+    #     80:     [0]*3,
+    #     160:    [0]*3,
+    # }
+
+    # Header line, printed by the command line
+    file.readline()
+
+    # Initial measure
+    # previous_section = None
+    # previous_timestamp = None
+    # previous_current = None
+    # previous_pins = None
+    for line_data in file:
+        timestamp, current, pins = line_data.split(',')[:3]
+        section = pin_sections[pins[:PIN_COUNT]]
+
+        if section == PIN_MAP_NOT_RUNNING:
+            # Not counted, its timestamp and current are only parsed if the next sample is integrated from them
+            previous_sample_timestamp = timestamp
+            previous_sample_current = current
+            previous_sample_parsed = False
+            continue
+
+        # Every sample is integrated, the area since the previous sample belongs to this sample
+        timestamp       = float(timestamp)
+        current         = float(current)
+        current         = current if current > 0 else 0
+        if previous_sample_timestamp is None:
+            charge      = current * TIME_DELTA
+        else:
+            if not previous_sample_parsed:
+                previous_sample_timestamp = float(previous_sample_timestamp)
+                previous_sample_current = float(previous_sample_current)
+                previous_sample_current = previous_sample_current if previous_sample_current > 0 else 0
+            charge      = (current + previous_sample_current) / 2 * max(timestamp - previous_sample_timestamp, 0)
+        previous_sample_timestamp = timestamp
+        previous_sample_current = current
+        previous_sample_parsed = True
+
+        counter_total   += 1
+        current_total   += current
+        time_total      += TIME_DELTA
+        charge_total    += charge
+        
+        ###### One of the coming to count ######
+        if section == setup:
+            current_setup   += current
+            counter_setup   += 1
+            time_setup      += TIME_DELTA
+            charge_setup    += charge
+        
+        elif section == send:
+            current_send   += current
+            counter_send   += 1
+            time_send      += TIME_DELTA
+            charge_send    += charge
+
+        elif section == compute:
+            current_compute   += current
+            counter_compute   += 1
+            time_compute += TIME_DELTA
+            charge_compute += charge
+        
+        elif section == modem:
+            current_modem   += current
+            counter_modem   += 1
+            time_modem += TIME_DELTA
+            charge_modem += charge
+
+        elif section == sleep and current <= SLEEP_THRESHOLD:
+            current_sleep   += current
+            counter_sleep   += 1
+            time_sleep += TIME_DELTA
+            charge_sleep += charge
+
+        else:
+            # The system section, and sleep samples drawing more than SLEEP_THRESHOLD
+            current_system += current
+            counter_system += 1
+            time_system += TIME_DELTA
+            charge_system += charge
+                
+        # previous_timestamp = timestamp
+        # previous_current = current
+        # previous_pins = pins
+    
         """
-            If output file exists from before, ask user to overwrite or exit exec
+        REMEMBER TO CHECK STATE OF LAST SAMPLE TO SEE IF STATE IS DIFFERENT OR EQUAL
+        ONLY ADD TO TOTAL TIME OF STATE IF STATE IS EQUAL TO LAST STATE...
         """
-        print(f'The provided result file "{args.output}" already exist.')
-        answer = None
-        while answer not in ['yes', 'no']:
-            answer = input("Do you want to overwrite it? [yes/no]")
-        if answer == 'no':
-            os.exit(f"Please provide a different output file.")
-        os.remove(args.output)
     
+    # Close the read file
+    file.close()
+
+    return {
+        "total":   [counter_total, current_total, time_total, util_charge_to_joules(charge_total, voltage)],
+        "setup":   [counter_setup, current_setup, time_setup, util_charge_to_joules(charge_setup, voltage)],
+        "compute": [counter_compute, current_compute, time_compute, util_charge_to_joules(charge_compute, voltage)],
+        "send":    [counter_send, current_send, time_send, util_charge_to_joules(charge_send, voltage)],
+        "sleep":   [counter_sleep, current_sleep, time_sleep, util_charge_to_joules(charge_sleep, voltage)],
+        "modem":   [counter_modem, current_modem, time_modem, util_charge_to_joules(charge_modem, voltage)],
+        "system":  [counter_system, current_system, time_system, util_charge_to_joules(charge_system, voltage)],
+    }
+
+
+def util_pack_pins(characters):
+    """Pack an (n, 8) array of pin characters into one bitmask byte per row
+
+    The rows are read as little-endian 64-bit integers with one 0/1 byte per pin, and the
+    multiplication moves bit 8*n of every row to bit 56+n without any carries in between.
+    """
+    pin_bytes = np.ascontiguousarray(characters == ord('1')).view("<u8")[:, 0]
+    return ((pin_bytes * np.uint64(0x0102040810204080)) >> np.uint64(56)).astype(np.uint8)
+
+
+def decode_pins(pins):
+    """Decode an array of PPK pin strings, e.g. b'00010011', into integer bitmasks
+
+    Bit n of the mask is set when character n of the pin string is '1'.
+    """
+    characters = np.ascontiguousarray(pins, dtype=f"S{PIN_COUNT}").view(np.uint8).reshape(-1, PIN_COUNT)
+    return util_pack_pins(characters)
+
+
+def util_is_compressed(file_path: str) -> bool:
+    return file_path.endswith(COMPRESSED_EXTENSIONS)
+
+
+def util_open_decompressor(file_path: str):
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, "rb")
+    if file_path.endswith(".xz"):
+        return lzma.open(file_path, "rb")
+    if zstandard is None:
+        raise ValueError(f"Reading {file_path} needs the zstandard package")
+    return zstandard.ZstdDecompressor().stream_reader(open(file_path, "rb"), closefd=True)
+
+
+class PrefetchingReader(io.RawIOBase):
+    """Binary stream of a source file read ahead by a separate thread
+
+    The thread reads `block_size` bytes at a time into a queue of at most `queue_depth` blocks,
+    up to `size` bytes or the end of the source. Reading files, and decompressing, releases the
+    GIL, so the next blocks are read while the current one is parsed and classified. The reader
+    owns the source and closes it.
+    """
+
+    def __init__(self, source, block_size: int, queue_depth: int, size: int = None):
+        self.source = source
+        self.block_size = block_size
+        self.remaining = size
+        self.blocks = queue.Queue(queue_depth)
+        self.block = memoryview(b"")
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # Gives up once the reader is closed, nobody takes blocks from the queue any more
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _read_ahead(self):
+        try:
+            while not self.stopped.is_set():
+                block_size = self.block_size if self.remaining is None else min(self.block_size, self.remaining)
+                block = self.source.read(block_size) if block_size else b""
+                if self.remaining is not None:
+                    self.remaining -= len(block)
+                # An empty block marks the end of the capture
+                self._put(block)
+                if not block:
+                    return
+        except Exception as error:
+            self._put(error)
+
+    def read_block(self) -> bytes:
+        """The next block read by the thread, without copying it, b"" at the end of the source"""
+        if len(self.block):
+            block, self.block = self.block.tobytes(), memoryview(b"")
+            return block
+        if self.finished:
+            return b""
+        item = self.blocks.get()
+        if isinstance(item, Exception):
+            raise item
+        if not item:
+            self.finished = True
+        return item
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not len(self.block):
+            block = self.read_block()
+            if not block:
+                return 0
+            self.block = memoryview(block)
+        size = min(len(buffer), len(self.block))
+        buffer[:size] = self.block[:size]
+        self.block = self.block[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.source.close()
+        super().close()
+
+
+class DecompressingReader(PrefetchingReader):
+    """Binary stream of the decompressed bytes of a .gz, .xz or .zst capture
+
+    zlib, lzma and zstandard release the GIL while decompressing, so the next
+    DECOMPRESS_BLOCK_SIZE blocks are decompressed while the current one is parsed.
+    """
+
+    def __init__(self, file_path: str, block_size: int = DECOMPRESS_BLOCK_SIZE, queue_depth: int = DECOMPRESS_QUEUE_DEPTH):
+        super().__init__(util_open_decompressor(file_path), block_size, queue_depth)
+
+
+def open_capture(file_path: str, mode: str = "rb"):
+    """Open a capture for reading, 'rb' or 'r', decompressing .gz, .xz and .zst captures on the fly"""
+    if not util_is_compressed(file_path):
+        return open(file_path, mode)
+    file = io.BufferedReader(DecompressingReader(file_path), DECOMPRESS_BLOCK_SIZE)
+    return file if "b" in mode else io.TextIOWrapper(file)
+
+
+def util_read_header(file_path: str) -> str:
+    """The header line of a capture. Readers skip it, only the command line prints it"""
+    with open_capture(file_path, "r") as file:
+        return file.readline()
+
+
+def read_samples_numpy(file, chunk_size: int = NUMPY_CHUNK_SIZE):
+    """Yield (timestamp, current, pins) arrays for every `chunk_size` samples of an open file"""
+    while True:
+        lines = list(itertools.islice(file, chunk_size))
+        if not lines:
+            return
+        samples = np.loadtxt(lines, delimiter=",", usecols=(0, 1, 2), dtype=SAMPLE_DTYPE, ndmin=1)
+        yield samples["timestamp"], samples["current"], decode_pins(samples["pins"])
+
+
+def util_parse_decimal_fields(buffer, starts, ends, non_digits, first_non_digit, non_digit_count):
+    """Parse the ASCII decimal numbers buffer[starts[i]:ends[i]] into a float64 array
+
+    Fields are grouped by their shape (length, position of the decimal point and sign), the bytes
+    of every group are copied into a matrix and its mantissa is built one digit column at a time
+    with an int64 multiply-add. With at most 15 digits the mantissa is exact, and dividing it by
+    an exact power of ten rounds correctly, exactly like float(). Any other field, e.g. with an
+    exponent, is converted by numpy instead.
+
+    Args:
+        buffer (np.ndarray): uint8 view of the file
+        starts (np.ndarray): offset of the first byte of each field
+        ends (np.ndarray): offset one past the last byte of each field
+        non_digits (np.ndarray): sorted offsets of every byte in buffer that is not a digit
+        first_non_digit (np.ndarray): index in non_digits of the first non-digit of each field
+        non_digit_count (np.ndarray): number of non-digits in each field
+    """
+    lengths = ends - starts
+    first_character = buffer[np.minimum(starts, len(buffer) - 1)]
+    negative = (first_character == ord('-')) & (lengths > 0)
+    signed = negative | ((first_character == ord('+')) & (lengths > 0))
+
+    # A regular field contains digits and at most one non-digit after the sign, the decimal point
+    non_digit_count = non_digit_count - signed
+    point = non_digits[np.minimum(first_non_digit + signed, len(non_digits) - 1)]
+    has_point = (non_digit_count == 1) & (buffer[np.minimum(point, len(buffer) - 1)] == ord('.'))
+    point_offset = np.where(has_point, point - starts, lengths)
+    digit_count = lengths - signed - has_point
+    irregular = (
+        (non_digit_count != has_point) | (digit_count <= 0) | (digit_count > 15) | (lengths > FIELD_WIDTH)
+    )
+
+    shapes = (lengths * (FIELD_WIDTH + 1) + point_offset) * 3 + signed + negative
+    # Irregular fields are only grouped by their length
+    shapes[irregular] = -1 - lengths[irregular]
+    order = np.argsort(shapes, kind="stable")
+    values = np.empty(len(starts))
+    for group in np.split(order, np.flatnonzero(np.diff(shapes[order])) + 1):
+        if not len(group):
+            continue
+        # The fields of a group have the same length, their bytes are copied into a (fields, length) matrix
+        length = int(lengths[group[0]])
+        if length:
+            characters = np.lib.stride_tricks.sliding_window_view(buffer, length)[starts[group]]
+        if shapes[group[0]] < 0:
+            if not length:
+                # An empty field, a NUL string that numpy rejects
+                characters = np.zeros((len(group), 1), dtype=np.uint8)
+            values[group] = characters.view(f"S{max(length, 1)}")[:, 0].astype(np.float64)
+            continue
+
+        offset = int(point_offset[group[0]])
+        digit_columns = [column for column in range(int(signed[group[0]]), length) if column != offset]
+        mantissa = np.zeros(len(group), dtype=np.int64)
+        for column in digit_columns:
+            mantissa *= 10
+            mantissa += characters[:, column]
+        # The characters were added instead of the digits, ord('0') too much at every place
+        mantissa -= ord('0') * int("1" * len(digit_columns))
+        values[group] = mantissa / POWERS_OF_TEN[max(length - offset - 1, 0)]
+        if negative[group[0]]:
+            values[group] = -values[group]
+    return values
+
+
+def parse_sample_block(buffer):
+    """Parse a block of complete PPK lines, 'timestamp,current,pins', into arrays
+
+    No python object is created per sample. Separators, decimal points and signs are located
+    with a single scan for bytes that are not digits, and all fields are parsed with array
+    operations directly on the bytes in buffer.
+
+    Args:
+        buffer (np.ndarray): uint8 array of whole lines
+
+    Returns:
+        tuple: timestamp, current and decoded pins arrays
+    """
+    non_digits = np.flatnonzero((buffer - np.uint8(ord('0'))) > 9)
+    if not len(buffer) or buffer[-1] != ord('\n'):
+        # Let the last line end at the end of the buffer
+        non_digits = np.append(non_digits, len(buffer))
+        non_digit_characters = np.append(buffer[non_digits[:-1]], np.uint8(ord('\n')))
+    else:
+        non_digit_characters = buffer[non_digits]
+
+    newlines = np.flatnonzero(non_digit_characters == ord('\n'))
+    is_comma = non_digit_characters == ord(',')
+    commas = np.flatnonzero(is_comma)
+    # Number of commas before each line, and in each line
+    commas_before = np.concatenate(([0], np.cumsum(is_comma)[newlines]))
+    comma_count = np.diff(commas_before)
+    commas_before = commas_before[:-1]
+
+    line_first_non_digit = np.concatenate(([0], newlines[:-1] + 1))
+    line_starts = np.concatenate(([0], non_digits[newlines[:-1]] + 1))
+    line_ends = non_digits[newlines]
+
+    malformed = comma_count < 2
+    if np.any(malformed):
+        # Empty lines, e.g. at the end of the file, are skipped
+        empty = line_ends - line_starts <= (buffer[np.maximum(line_ends - 1, 0)] == ord('\r'))
+        if np.any(malformed & ~empty):
+            line = line_starts[np.argmax(malformed & ~empty)]
+            raise ValueError(f"Line at byte {line} does not contain the fields timestamp,current,pins")
+        keep = ~malformed
+        commas_before, line_first_non_digit = commas_before[keep], line_first_non_digit[keep]
+        line_starts, line_ends = line_starts[keep], line_ends[keep]
+        if not len(line_starts):
+            return np.empty(0), np.empty(0), np.empty(0, dtype=np.uint8)
+
+    first_comma = commas[commas_before]
+    second_comma = commas[commas_before + 1]
+    timestamp_ends = non_digits[first_comma]
+    current_ends = non_digits[second_comma]
+    if np.any(current_ends + PIN_COUNT >= line_ends):
+        line = line_starts[np.argmax(current_ends + PIN_COUNT >= line_ends)]
+        raise ValueError(f"Line at byte {line} does not contain {PIN_COUNT} pins")
+
+    timestamp = util_parse_decimal_fields(
+        buffer, line_starts, timestamp_ends, non_digits, line_first_non_digit, first_comma - line_first_non_digit
+    )
+    current = util_parse_decimal_fields(
+        buffer, timestamp_ends + 1, current_ends, non_digits, first_comma + 1, second_comma - first_comma - 1
+    )
+    characters = np.lib.stride_tricks.sliding_window_view(buffer, PIN_COUNT)[current_ends + 1]
+    return timestamp, current, util_pack_pins(characters)
+
+
+def scan_samples_mmap(file_path: str, start: int = None, size: int = None, block_size: int = MMAP_BLOCK_SIZE):
+    """Yield (timestamp, current, pins) arrays for newline aligned blocks of a memory-mapped file
+
+    Args:
+        start (int, optional): offset of the first line to parse. Defaults to the line after the header.
+        size (int, optional): number of bytes to parse from start. Defaults to the rest of the file.
+    """
+    with open(file_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if start is None:
+                # After the header line
+                start = buffer.find(b'\n') + 1 or len(buffer)
+            end = len(buffer) if size is None else start + size
+            for block_start, block_end in util_line_blocks(buffer, start, end, block_size):
+                yield util_parse_mapped_block(buffer, block_start, block_end)
+
+
+def util_line_blocks(buffer, start: int, end: int, block_size: int):
+    """Yield the (start, end) offsets of consecutive blocks of whole lines of buffer[start:end], of about block_size bytes"""
+    while start < end:
+        block_end = min(start + block_size, end)
+        if block_end < end:
+            # End the block after its last complete line, a line longer than the block is a block of its own
+            block_end = (
+                buffer.rfind(b'\n', start, block_end) + 1
+                or buffer.find(b'\n', block_end, end) + 1
+                or end
+            )
+        yield start, block_end
+        start = block_end
+
+
+def util_parse_blocks(blocks, block_size: int = MMAP_BLOCK_SIZE):
+    """Yield (timestamp, current, pins) arrays of consecutive blocks of bytes, carrying partial lines over to the next block
+
+    Blocks larger than block_size are parsed in parts, so the temporary arrays of parsing stay bounded.
+    """
+    remainder = b""
+    for block in blocks:
+        block = remainder + block
+        end = block.rfind(b'\n') + 1
+        remainder = block[end:]
+        for part_start, part_end in util_line_blocks(block, 0, end, block_size):
+            yield parse_sample_block(np.frombuffer(block, dtype=np.uint8, count=part_end - part_start, offset=part_start))
+    if remainder:
+        yield parse_sample_block(np.frombuffer(remainder, dtype=np.uint8))
+
+
+def scan_samples_stream(file_path: str, block_size: int = MMAP_BLOCK_SIZE):
+    """Same as scan_samples_mmap for a compressed capture, parsing newline aligned blocks of its decompressed bytes"""
+    with open_capture(file_path) as file:
+        # Header line
+        file.readline()
+        yield from util_parse_blocks(iter(lambda: file.read(block_size), b""))
+
+
+def scan_samples_pipeline(
+    file_path: str,
+    start: int = None,
+    size: int = None,
+    buffer_size: int = PIPELINE_BUFFER_SIZE,
+    queue_depth: int = PIPELINE_QUEUE_DEPTH,
+):
+    """Same as scan_samples_mmap, parsing buffers of the file read ahead by a PrefetchingReader
+
+    While a buffer is parsed and classified the thread of the reader waits on the disk for the
+    next ones, so a capture that is not in the page cache is read at close to the bandwidth of
+    its storage. Memory is bounded by queue_depth + 2 buffers.
+    """
+    with open(file_path, "rb") as source:
+        if start is None:
+            # Header line
+            source.readline()
+        else:
+            source.seek(start)
+        with PrefetchingReader(source, buffer_size, queue_depth, size) as reader:
+            yield from util_parse_blocks(iter(reader.read_block, b""))
+
+
+def util_parse_mapped_block(buffer: mmap.mmap, start: int, end: int):
+    # The array view must be released before the mmap can be closed, so it only lives in this frame
+    block = np.frombuffer(buffer, dtype=np.uint8, count=end - start, offset=start)
+    try:
+        return parse_sample_block(block)
+    except ValueError as error:
+        message = str(error)
+    # Raised outside of the except clause, without the traceback whose frames still view the mmap
+    del block
+    raise ValueError(message)
+
+
+def read_samples(
+    file_path: str,
+    engine: str,
+    start: int = None,
+    size: int = None,
+    buffer_size: int = PIPELINE_BUFFER_SIZE,
+    queue_depth: int = PIPELINE_QUEUE_DEPTH,
+):
+    """Yield (timestamp, current, pins) arrays of a file with the numpy, mmap or pipeline engine
+
+    Compressed captures are read from start to end, their samples can not be seeked to. They are
+    already decompressed ahead on a separate thread, so the pipeline engine reads them like mmap.
+
+    Args:
+        start (int, optional): offset of the first line to read. Defaults to the line after the header.
+        size (int, optional): number of bytes to read from start. Defaults to the rest of the file.
+        buffer_size (int, optional): bytes per buffer of the pipeline engine.
+        queue_depth (int, optional): buffers of the pipeline engine waiting to be parsed.
+    """
+    if engine in ("mmap", "pipeline"):
+        if util_is_compressed(file_path):
+            yield from scan_samples_stream(file_path)
+        elif engine == "pipeline":
+            yield from scan_samples_pipeline(file_path, start, size, buffer_size, queue_depth)
+        else:
+            yield from scan_samples_mmap(file_path, start, size)
+        return
+
+    with open_capture(file_path) as file:
+        if start is None:
+            # Header line
+            file.readline()
+        else:
+            file.seek(start)
+        lines = file if size is None else util_read_lines(file, size)
+        yield from read_samples_numpy(lines)
+
+
+def util_capture_cache_path(file_path: str) -> str:
+    if util_is_compressed(file_path):
+        file_path = os.path.splitext(file_path)[0]
+    return os.path.splitext(file_path)[0] + CAPTURE_CACHE_EXTENSION
+
+
+def util_capture_cache_is_fresh(file_path: str) -> bool:
+    """returns boolean True if the file has a capture cache of this version written after the file was last modified"""
+    cache_path = util_capture_cache_path(file_path)
+    if not (os.path.isfile(cache_path) and os.stat(cache_path).st_mtime_ns > os.stat(file_path).st_mtime_ns):
+        return False
+    with open(cache_path, "rb") as cache_file:
+        return cache_file.read(len(CAPTURE_CACHE_MAGIC)) == CAPTURE_CACHE_MAGIC
+
+
+def convert_capture(file_path: str) -> str:
+    """Write the samples of a power profiler file to a compact binary capture cache
+
+    The cache holds the timestamp as float64, the current as float32 and the pins as a uint8
+    bitmask per sample, so gaps in the timestamps are integrated like in the file. float32 keeps
+    7 significant digits of the current, so sums computed from the cache differ slightly from
+    sums computed from the file.
+
+    Returns:
+        str: path of the capture cache
+    """
+    cache_path = util_capture_cache_path(file_path)
+    temporary_path = cache_path + ".tmp"
+    number_of_samples = 0
+
+    try:
+        with open(temporary_path, "wb") as cache_file, tempfile.TemporaryFile() as current_file, tempfile.TemporaryFile() as pins_file:
+            cache_file.write(bytes(CAPTURE_CACHE_HEADER_SIZE))
+            for timestamp, current, pins in uAprofile.timed_samples(read_samples(file_path, "mmap"), file_path):
+                number_of_samples += len(timestamp)
+                cache_file.write(timestamp.astype("<f8"))
+                current_file.write(current.astype("<f4"))
+                pins_file.write(pins)
+
+            # Currents and pins are stored as one column each after all timestamps
+            for column_file in (current_file, pins_file):
+                column_file.seek(0)
+                shutil.copyfileobj(column_file, cache_file)
+
+            cache_file.seek(0)
+            cache_file.write(CAPTURE_CACHE_HEADER.pack(CAPTURE_CACHE_MAGIC, number_of_samples))
+    except BaseException:
+        # E.g. a malformed line, no half written cache is left next to the capture
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    os.replace(temporary_path, cache_path)
+    return cache_path
+
+
+def read_capture_cache(cache_path: str, chunk_size: int = NUMPY_CHUNK_SIZE):
+    """Yield (timestamp, current, pins) arrays for every `chunk_size` samples of a capture cache"""
+    with open(cache_path, "rb") as file:
+        magic, number_of_samples = CAPTURE_CACHE_HEADER.unpack(file.read(CAPTURE_CACHE_HEADER.size))
+    if magic != CAPTURE_CACHE_MAGIC:
+        raise ValueError(f"Not a capture cache: {cache_path}")
+    if not number_of_samples:
+        return
+
+    timestamp = np.memmap(cache_path, dtype="<f8", mode="r", offset=CAPTURE_CACHE_HEADER_SIZE, shape=(number_of_samples,))
+    current = np.memmap(
+        cache_path, dtype="<f4", mode="r", offset=CAPTURE_CACHE_HEADER_SIZE + 8 * number_of_samples, shape=(number_of_samples,)
+    )
+    pins = np.memmap(
+        cache_path, dtype=np.uint8, mode="r", offset=CAPTURE_CACHE_HEADER_SIZE + 12 * number_of_samples, shape=(number_of_samples,)
+    )
+    for start in range(0, number_of_samples, chunk_size):
+        end = min(start + chunk_size, number_of_samples)
+        yield (
+            np.array(timestamp[start:end]),
+            current[start:end].astype(np.float64),
+            np.array(pins[start:end]),
+        )
+
+
+def read_capture(
+    file_path: str,
+    engine: str,
+    buffer_size: int = PIPELINE_BUFFER_SIZE,
+    queue_depth: int = PIPELINE_QUEUE_DEPTH,
+):
+    """Yield (timestamp, current, pins) arrays of a file, from its capture cache when it is fresh"""
+    if util_capture_cache_is_fresh(file_path):
+        cache_path = util_capture_cache_path(file_path)
+        print(util_color(INFO_COLOR) + f"Reading capture cache {cache_path}")
+        yield from read_capture_cache(cache_path)
+    else:
+        yield from read_samples(file_path, engine, buffer_size=buffer_size, queue_depth=queue_depth)
+
+
+def util_charge_to_joules(charge, voltage: float) -> float:
+    """Energy (J) of a charge (uA*ms) drawn at a supply voltage (V)"""
+    return charge * voltage / 1e9
+
+
+def util_sequential_sum(start, values):
+    """Sum values from left to right onto start
 
+    np.sum uses pairwise summation, which rounds differently than accumulating one sample
+    at a time with `+=`. np.cumsum accumulates strictly in order, so the last element is
+    bit-identical to the result of the python engine.
+    """
+    if not len(values):
+        return start
+    return float(np.cumsum(np.concatenate(([start], values)))[-1])
+
+
+@dataclass
+class AnalysisOptions:
+    """Options for the analysis of a file, passed on to worker processes"""
+    engine: str = "python"
+    chunks: int = 1
+    statistics: bool = False
+    # Empty for a single analysis with SLEEP_THRESHOLD
+    sleep_thresholds: tuple = ()
+    # Directory the segment index of every file is saved to, None to not build one
+    segment_directory: str = None
+    timing: str = "accumulate"
+    voltage: float = SUPPLY_VOLTAGE
+    # Buffers of the pipeline engine, see scan_samples_pipeline
+    buffer_size: int = PIPELINE_BUFFER_SIZE
+    queue_depth: int = PIPELINE_QUEUE_DEPTH
+
+    @property
+    def vectorized_engine(self) -> str:
+        """The engine reading arrays of samples, numpy stands in for the python engine"""
+        return "numpy" if self.engine == "python" else self.engine
+
+    def accumulator(self):
+        if self.sleep_thresholds:
+            return ThresholdSweepAccumulator(self.sleep_thresholds, self.statistics, self.timing, self.voltage)
+        return SectionAccumulator(self.statistics, self.segment_directory is not None, self.timing, self.voltage)
+
+
+def classify_samples(current, pins):
+    """Keep the samples of a running application and find their sections
+
+    Sleep state samples with the modem pin high are in the modem section. The other sleep
+    state samples are all left in the sleep section, see util_split_sleep. The pin map
+    decides which pins carry these signals, see compile_pin_map.
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): current and SECTION value of each running sample,
+        and the mask of the running samples among all samples
+    """
+    # One gather from the table compiled from the pin map
+    sections = PIN_SECTIONS[pins]
+    running = sections != PIN_MAP_NOT_RUNNING
+    return current[running], sections[running], running
+
+
+def util_split_sleep(current, sections, sleep_threshold: float):
+    """Move the sleep section samples drawing more than sleep_threshold to the system section"""
+    sections = sections.copy()
+    sections[(sections == SECTION.SLEEP.value) & (current > sleep_threshold)] = SECTION.SYSTEM.value
+    return sections
+
+
+class SampleClock:
+    """Duration and charge of every sample from the timestamps, and the gaps between samples
+
+    A sample lasts from the timestamp of the sample before it to its own timestamp, the first
+    sample of a file lasts TIME_DELTA. So the time of samples dropped by the profiler is added to
+    the sample after them. A sample with a timestamp not after the one before it lasts 0.
+    Both are reported as gaps: (index of the sample, previous timestamp, timestamp).
+
+    The charge of a sample (uA*ms) is the current integrated over its duration with the
+    trapezoidal rule, from the current of the sample before it to its own current.
+    """
+
+    def __init__(self, previous_timestamp: float = None, previous_current: float = None):
+        # Number of samples seen, running or not
+        self.samples = 0
+        self.previous_timestamp = previous_timestamp
+        self.previous_current = previous_current
+        self.gaps = []
+
+    def integrate(self, timestamp, current):
+        """Returns the duration and charge of every sample, non-positive currents count as 0"""
+        if not len(timestamp):
+            return np.empty(0), np.empty(0)
+        current = np.where(current > 0, current, 0.0)
+        previous = np.concatenate(([np.nan if self.previous_timestamp is None else self.previous_timestamp], timestamp[:-1]))
+        previous_current = np.concatenate(([self.previous_current or 0.0], current[:-1]))
+        deltas = timestamp - previous
+        for sample in np.flatnonzero((deltas > GAP_TOLERANCE * TIME_DELTA) | (deltas <= 0)):
+            self.gaps.append((self.samples + int(sample), float(previous[sample]), float(timestamp[sample])))
+        self.samples += len(timestamp)
+        self.previous_timestamp = float(timestamp[-1])
+        self.previous_current = float(current[-1])
+
+        first_sample = np.isnan(deltas)
+        durations = np.where(first_sample, TIME_DELTA, np.maximum(deltas, 0.0))
+        charges = np.where(first_sample, current * TIME_DELTA, (current + previous_current) / 2 * durations)
+        return durations, charges
+
+    def merge(self, other: "SampleClock"):
+        """Add the gaps of a clock covering the samples directly after this one"""
+        self.gaps += [(self.samples + sample, previous, timestamp) for sample, previous, timestamp in other.gaps]
+        self.samples += other.samples
+        if other.previous_timestamp is not None:
+            self.previous_timestamp = other.previous_timestamp
+            self.previous_current = other.previous_current
+
+
+class SegmentIndex:
+    """Run-length index of the section segments of a file, built one chunk of samples at a time
+
+    A segment ends where the section of the pins changes or where the application stops running,
+    so a sleep period is a single segment whatever its current. A segment running over the end
+    of a chunk is joined with its continuation in the next chunk, and
+    indexes of consecutive parts of a file are joined the same way by merge.
+    """
+
+    def __init__(self):
+        # Number of samples seen, running or not
+        self.samples = 0
+        self.parts = []
+
+    def _append(self, segments):
+        if not len(segments):
+            return
+        if self.parts:
+            last = self.parts[-1][-1:]
+            if last["start"][0] + last["length"][0] == segments["start"][0] and last["section"][0] == segments["section"][0]:
+                for field in ("length", "current", "system_length", "system_current"):
+                    last[field] += segments[field][0]
+                segments = segments[1:]
+        self.parts.append(segments)
+
+    def add_samples(self, current, sections, running, system):
+        """Add the sections of the running samples of a chunk, see classify_samples
+
+        system marks the running samples moved from the sleep to the system section by util_split_sleep.
+        """
+        positions = self.samples + np.flatnonzero(running)
+        self.samples += len(running)
+        if not len(positions):
+            return
+        boundaries = np.flatnonzero((np.diff(sections) != 0) | (np.diff(positions) != 1)) + 1
+        starts = np.concatenate(([0], boundaries))
+        segments = np.empty(len(starts), dtype=SEGMENT_DTYPE)
+        segments["start"] = positions[starts]
+        segments["length"] = np.diff(np.append(starts, len(positions)))
+        segments["section"] = sections[starts]
+        current = np.where(current > 0, current, 0.0)
+        segments["current"] = np.add.reduceat(current, starts)
+        segments["system_length"] = np.add.reduceat(system.astype(np.int64), starts)
+        segments["system_current"] = np.add.reduceat(np.where(system, current, 0.0), starts)
+        self._append(segments)
+
+    def merge(self, other: "SegmentIndex"):
+        """Add the segments of an index covering the samples directly after this one"""
+        for segments in other.parts:
+            segments = segments.copy()
+            segments["start"] += self.samples
+            self._append(segments)
+        self.samples += other.samples
+
+    def segments(self):
+        return np.concatenate(self.parts) if self.parts else np.empty(0, dtype=SEGMENT_DTYPE)
+
+
+class SectionAccumulator:
+    """Per-section number of samples, total current, total time and energy for the numpy and mmap engines
+
+    With statistics, the current of every section is also streamed into RunningMoments and a
+    QuantileSketch, which both use constant memory. With segments, a SegmentIndex of the
+    samples is built alongside.
+
+    The time of a section depends on timing: 'accumulate' adds TIME_DELTA per sample like the
+    python engine, 'samples' multiplies the number of samples by TIME_DELTA once and
+    'timestamps' adds the durations of the samples given by the SampleClock. The energy is
+    always integrated from the timestamps by the SampleClock, at the given supply voltage.
+    """
+
+    def __init__(
+        self,
+        statistics: bool = False,
+        segments: bool = False,
+        timing: str = "accumulate",
+        voltage: float = SUPPLY_VOLTAGE,
+    ):
+        self.counters = dict.fromkeys(SECTION_NAMES, 0)
+        self.currents = dict.fromkeys(SECTION_NAMES, 0)
+        self.times = dict.fromkeys(SECTION_NAMES, 0)
+        self.charges = dict.fromkeys(SECTION_NAMES, 0)
+        self.statistics = statistics
+        if statistics:
+            self.moments = {section: RunningMoments() for section in SECTION_NAMES}
+            self.sketches = {section: QuantileSketch() for section in SECTION_NAMES}
+        self.segment_index = SegmentIndex() if segments else None
+        self.timing = timing
+        self.voltage = voltage
+        self.clock = SampleClock()
+
+    def _add(self, section: str, current, durations, charges):
+        self.counters[section] += len(current)
+        # Non-positive currents are counted as 0 and leave the sum untouched
+        self.currents[section] = util_sequential_sum(self.currents[section], current[current > 0])
+        if self.timing == "accumulate":
+            self.times[section] = util_sequential_sum(self.times[section], np.full(len(current), TIME_DELTA))
+        elif self.timing == "timestamps":
+            self.times[section] += float(np.sum(durations))
+        self.charges[section] = util_sequential_sum(self.charges[section], charges)
+        if self.statistics:
+            current = np.where(current > 0, current, 0.0)
+            self.moments[section].add_array(current)
+            self.sketches[section].add_array(current)
+
+    def add_samples(self, timestamp, current, pins):
+        """Classify a chunk of samples and add them to their sections
+
+        Args:
+            timestamp (np.ndarray): timestamp of each sample (ms)
+            current (np.ndarray): current of each sample (uA)
+            pins (np.ndarray): decoded pin bitmask of each sample
+        """
+        durations, charges = self.clock.integrate(timestamp, current)
+        current, sections, running = classify_samples(current, pins)
+        split_sections = util_split_sleep(current, sections, SLEEP_THRESHOLD)
+        self.add_sections(current, split_sections, durations[running], charges[running])
+        if self.segment_index is not None:
+            # Segments follow the sections of the pins, the samples split off sleep are counted per segment
+            self.segment_index.add_samples(current, sections, running, split_sections != sections)
+
+    def add_sections(self, current, sections, durations, charges):
+        """Add running samples to the total and to the SECTION given for each of them"""
+        self._add("total", current, durations, charges)
+        section_counts = np.bincount(sections, minlength=len(SECTION))
+        for section in SECTION:
+            if section_counts[section.value]:
+                in_section = sections == section.value
+                self._add(section.name.lower(), current[in_section], durations[in_section], charges[in_section])
+
+    def merge(self, other: "SectionAccumulator"):
+        """Add the samples of an accumulator covering the samples directly after this one"""
+        for section in SECTION_NAMES:
+            self.counters[section] += other.counters[section]
+            self.currents[section] += other.currents[section]
+            self.times[section] += other.times[section]
+            self.charges[section] += other.charges[section]
+            if self.statistics:
+                self.moments[section].merge(other.moments[section])
+                self.sketches[section].merge(other.sketches[section])
+        if self.segment_index is not None:
+            self.segment_index.merge(other.segment_index)
+        self.clock.merge(other.clock)
+
+    def results(self) -> dict:
+        """Returns section name -> [number of samples, total current, total time, energy]
+
+        With statistics, each list continues with the variance, standard deviation, peak and
+        STATISTICS_QUANTILES of the current.
+        """
+        if self.timing == "samples":
+            self.times = {section: self.counters[section] * TIME_DELTA for section in SECTION_NAMES}
+        results = {
+            section: [
+                self.counters[section],
+                self.currents[section],
+                self.times[section],
+                util_charge_to_joules(self.charges[section], self.voltage),
+            ]
+            for section in SECTION_NAMES
+        }
+        if self.timing == "timestamps":
+            # Not a section, ignored by format_section_results
+            results["gaps"] = [list(gap) for gap in self.clock.gaps]
+        if self.statistics:
+            for section in SECTION_NAMES:
+                moments = self.moments[section]
+                peak = moments.maximum if moments.count else 0.0
+                results[section] += [moments.variance, moments.standard_deviation, peak] + [
+                    min(self.sketches[section].quantile(q), peak) for q in STATISTICS_QUANTILES
+                ]
+        return results
+
+
+class ThresholdSweepAccumulator:
+    """Section results for several SLEEP_THRESHOLD values from a single pass over the samples
+
+    Only the split between the sleep and system sections depends on the threshold. Every sample
+    is classified once into a shared accumulator, and the current of the sleep state samples
+    without modem activity is split once per threshold. The results for a threshold are
+    identical to an analysis with SLEEP_THRESHOLD set to it.
+    """
+
+    def __init__(
+        self,
+        sleep_thresholds: tuple,
+        statistics: bool = False,
+        timing: str = "accumulate",
+        voltage: float = SUPPLY_VOLTAGE,
+    ):
+        self.sleep_thresholds = sleep_thresholds
+        self.shared = SectionAccumulator(statistics, timing=timing, voltage=voltage)
+        self.split = [
+            SectionAccumulator(statistics, timing=timing, voltage=voltage) for threshold in sleep_thresholds
+        ]
+        # The durations and charges are calculated once, by the clock of the shared accumulator
+        self.clock = self.shared.clock
+
+    def add_samples(self, timestamp, current, pins):
+        durations, charges = self.clock.integrate(timestamp, current)
+        current, sections, running = classify_samples(current, pins)
+        durations, charges = durations[running], charges[running]
+        self.shared.add_sections(current, sections, durations, charges)
+
+        is_sleep = sections == SECTION.SLEEP.value
+        sleep_current, sleep_durations, sleep_charges = current[is_sleep], durations[is_sleep], charges[is_sleep]
+        if not len(sleep_current):
+            return
+        for threshold, accumulator in zip(self.sleep_thresholds, self.split):
+            system = sleep_current > threshold
+            accumulator._add("sleep", sleep_current[~system], sleep_durations[~system], sleep_charges[~system])
+            accumulator._add("system", sleep_current[system], sleep_durations[system], sleep_charges[system])
+
+    def merge(self, other: "ThresholdSweepAccumulator"):
+        self.shared.merge(other.shared)
+        for accumulator, other_accumulator in zip(self.split, other.split):
+            accumulator.merge(other_accumulator)
+
+    def results(self) -> list:
+        """Returns the section results of every threshold, in the order of sleep_thresholds"""
+        shared_results = self.shared.results()
+        results = []
+        for accumulator in self.split:
+            split_results = accumulator.results()
+            results.append({
+                **shared_results,
+                "sleep": split_results["sleep"],
+                "system": split_results["system"],
+            })
+        return results
+
+
+def analyse_file_vectorized(file_path: str, options: AnalysisOptions) -> dict:
+    """Classify the samples of a power profiler file in chunks with the numpy or mmap engine
+
+    Returns:
+        dict: section name -> [number of samples, total current, total time]
+    """
+    accumulator = options.accumulator()
+    samples = read_capture(
+        file_path, options.vectorized_engine, buffer_size=options.buffer_size, queue_depth=options.queue_depth
+    )
+    for timestamp, current, pins in uAprofile.timed_samples(samples, file_path):
+        with uAprofile.phase("classify", file_path, len(current)):
+            accumulator.add_samples(timestamp, current, pins)
+    util_save_segment_index(file_path, options, accumulator)
+    return accumulator.results()
+
+
+def analyse_stream(file, options: AnalysisOptions) -> dict:
+    """Classify the samples of an open capture, binary or text, read from its header line to its end
+
+    The samples are parsed by the numpy engine whatever the engine of the options, and segment
+    indexes are not saved as the stream has no file name.
+    """
+    accumulator = options.accumulator()
+    # Header line
+    file.readline()
+    for timestamp, current, pins in read_samples_numpy(file):
+        accumulator.add_samples(timestamp, current, pins)
+    return accumulator.results()
+
+
+def util_save_segment_index(file_path: str, options: AnalysisOptions, accumulator: SectionAccumulator):
+    if options.segment_directory is None:
+        return
+    os.makedirs(options.segment_directory, exist_ok=True)
+    np.save(
+        os.path.join(options.segment_directory, get_label_from_file_path(file_path) + ".npy"),
+        accumulator.segment_index.segments(),
+    )
+
+
+def util_chunk_offsets(file_path: str, chunks: int) -> list:
+    """Split the samples of a file into byte ranges starting at the beginning of a line
+
+    Returns:
+        list: (start offset, size) of every non-empty chunk, in file order
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as file:
+        # Header line
+        file.readline()
+        boundaries = [file.tell()]
+        for index in range(1, chunks):
+            offset = boundaries[0] + (file_size - boundaries[0]) * index // chunks
+            if offset <= boundaries[-1]:
+                continue
+            # Move to the start of the first line at or after offset
+            file.seek(offset - 1)
+            file.readline()
+            boundaries.append(file.tell())
+    boundaries.append(file_size)
+    return [(start, end - start) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def util_read_lines(file, size: int):
+    """Yield lines of an open binary file until `size` bytes have been consumed"""
+    while size > 0:
+        line = file.readline()
+        if not line:
+            return
+        size -= len(line)
+        yield line
+
+
+def analyse_file_chunk(file_path: str, options: AnalysisOptions, start: int, size: int) -> SectionAccumulator:
+    """Classify the samples in one byte range of a file, see util_chunk_offsets"""
+    accumulator = options.accumulator()
+    accumulator.clock.previous_timestamp, accumulator.clock.previous_current = util_previous_sample(file_path, start)
+    samples = read_samples(file_path, options.vectorized_engine, start, size, options.buffer_size, options.queue_depth)
+    for timestamp, current, pins in uAprofile.timed_samples(samples, file_path):
+        with uAprofile.phase("classify", file_path, len(current)):
+            accumulator.add_samples(timestamp, current, pins)
+    return accumulator
+
+
+def util_previous_sample(file_path: str, offset: int, search_size: int = 4096):
+    """Timestamp and current of the line ending right before the line aligned offset, None for the header"""
+    with open(file_path, "rb") as file:
+        file.seek(max(0, offset - search_size))
+        line = file.read(offset - max(0, offset - search_size))[:-1].rsplit(b"\n", 1)[-1]
+    try:
+        timestamp, current = line.split(b",")[:2]
+        return float(timestamp), max(float(current), 0.0)
+    except ValueError:
+        return None, None
+
+
+def analyse_file_chunked(file_path: str, options: AnalysisOptions) -> dict:
+    """Classify a file split into newline aligned chunks in a pool of worker processes
+
+    Every chunk is accumulated on its own and the partial accumulators are merged in file order.
+    Sample counts are exact. The sums of current and time are rounded at each chunk boundary
+    instead of once per sample, so compared to a sequential pass they may differ by a relative
+    error of at most (number of samples) * 2**-52, as both are within half that bound of the
+    exact sum. In practice the relative difference is around 1e-12 or smaller.
+
+    Returns:
+        dict: section name -> [number of samples, total current, total time]
+    """
+    offsets = util_chunk_offsets(file_path, options.chunks)
+    accumulator = options.accumulator()
+    with util_process_pool(options.chunks) as executor:
+        for partial_accumulator in executor.map(
+            uAprofile.in_worker(analyse_file_chunk), *zip(*[(file_path, options, start, size) for start, size in offsets])
+        ):
+            accumulator.merge(uAprofile.collect(partial_accumulator))
+    util_save_segment_index(file_path, options, accumulator)
+    return accumulator.results()
+
+
+def analyse_file_with_engine(file_path: str, options: AnalysisOptions) -> dict:
+    """A fresh capture cache is always read by the numpy engine, in one process
+
+    With sleep_thresholds in the options a list of section results is returned, one per threshold.
+    """
+    with uAprofile.phase("analyse", file_path, bytes=os.path.getsize(file_path)):
+        return util_analyse_file_with_engine(file_path, options)
+
+
+def util_analyse_file_with_engine(file_path: str, options: AnalysisOptions) -> dict:
+    if util_capture_cache_is_fresh(file_path):
+        return analyse_file_vectorized(
+            file_path,
+            AnalysisOptions(
+                "numpy",
+                statistics=options.statistics,
+                sleep_thresholds=options.sleep_thresholds,
+                segment_directory=options.segment_directory,
+                timing=options.timing,
+                voltage=options.voltage,
+            ),
+        )
+    # Compressed captures can not be split without decompressing them first
+    if options.chunks > 1 and not util_is_compressed(file_path):
+        return analyse_file_chunked(file_path, options)
+    if options.engine == "python" and options.timing == "accumulate" and not (
+        options.statistics or options.sleep_thresholds or options.segment_directory
+    ):
+        return analyse_file(file_path, options.voltage)
+    return analyse_file_vectorized(file_path, options)
+
+
+def util_result_source(file_path: str) -> list:
+    """Path, size and modification time of the file the results of `file_path` are calculated from"""
+    source_path = util_capture_cache_path(file_path) if util_capture_cache_is_fresh(file_path) else file_path
+    stat = os.stat(source_path)
+    return [source_path, stat.st_size, stat.st_mtime_ns]
+
+
+class ResultCache:
+    """Section results of analysed files, stored as JSON between runs
+
+    An entry is keyed on the absolute path of a file and a hash of the analysis parameters, and
+    is only valid while the size and modification time of the file it was analysed from are
+    unchanged. That file is the capture cache when a fresh one exists, as it is read instead of
+    the CSV file. JSON keeps ints apart from floats and round-trips floats exactly, so cached
+    results are written to the result file exactly as they were calculated.
+
+    Entries of files that no longer exist are dropped on save, and beyond max_entries the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, max_entries: int = RESULT_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        try:
+            with open(path) as cache_file:
+                content = json.load(cache_file)
+            if content.get("version") == RESULT_CACHE_VERSION:
+                self.entries = content["entries"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            # A missing or unreadable cache is the same as an empty one
+            pass
+
+    @staticmethod
+    def _parameters_hash(options: AnalysisOptions) -> str:
+        parameters = {
+            "SLEEP_THRESHOLD": SLEEP_THRESHOLD,
+            "TIME_DELTA": TIME_DELTA,
+            "PIN_SECTIONS": PIN_SECTIONS.tolist(),
+            "statistics": options.statistics,
+            "sleep_thresholds": list(options.sleep_thresholds),
+            "timing": options.timing,
+            "GAP_TOLERANCE": GAP_TOLERANCE,
+            "voltage": options.voltage,
+            # Chunked files merge their statistics per chunk, which rounds differently
+            "chunks": options.chunks,
+        }
+        return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+    def key(self, file_path: str, options: AnalysisOptions) -> str:
+        return f"{os.path.abspath(file_path)}|{self._parameters_hash(options)}"
+
+    def get(self, file_path: str, options: AnalysisOptions, source: list):
+        """Cached section results of the file, or None when it has to be analysed"""
+        entry = self.entries.get(self.key(file_path, options))
+        if entry is None or entry["source"] != source:
+            return None
+        entry["used"] = time.time()
+        return entry["results"]
+
+    def put(self, file_path: str, options: AnalysisOptions, source: list, section_results: dict):
+        self.entries[self.key(file_path, options)] = {
+            "source": source,
+            "results": section_results,
+            "used": time.time(),
+        }
+
+    def save(self):
+        entries = {
+            key: entry for key, entry in self.entries.items() if os.path.exists(key.rsplit("|", 1)[0])
+        }
+        entries = dict(
+            sorted(entries.items(), key=lambda item: item[1]["used"], reverse=True)[:self.max_entries]
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Written next to the cache and renamed, so an interrupted run never leaves half a cache
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(file_descriptor, "w") as cache_file:
+            json.dump({"version": RESULT_CACHE_VERSION, "entries": entries}, cache_file, default=float)
+        os.replace(temporary_path, self.path)
+        self.entries = entries
+
+
+def analyse_files(files: list, options: AnalysisOptions, jobs: int = 1, cache: ResultCache = None):
+    """Yield (file_path, section results) for every file, in the order of `files`
+
+    Files with an entry in the cache are not analysed, the cache is updated with the results of
+    the others once all files are done.
+    """
+    sources = {}
+    cached = {}
+    if cache is not None:
+        for file_path in files:
+            sources[file_path] = util_result_source(file_path)
+            section_results = cache.get(file_path, options, sources[file_path])
+            if section_results is not None:
+                cached[file_path] = section_results
+
+    analysed = util_analyse_uncached_files([file_path for file_path in files if file_path not in cached], options, jobs)
+    for file_path in files:
+        if file_path in cached:
+            print(f"Cached {file_path}")
+            yield file_path, cached[file_path]
+            continue
+        file_path, section_results = next(analysed)
+        if cache is not None:
+            cache.put(file_path, options, sources[file_path], section_results)
+        yield file_path, section_results
+
+    if cache is not None:
+        cache.save()
+
+
+def util_analyse_uncached_files(files: list, options: AnalysisOptions, jobs: int = 1):
+    """Yield (file_path, section results) for every file, in the order of `files`
+
+    With more than one job the files are analysed in a pool of worker processes. Results are
+    still yielded in the order of `files`, while progress is reported as the workers complete.
+    """
+    if jobs <= 1:
+        for file_index, file_path in enumerate(files):
+            section_results = analyse_file_with_engine(file_path, options)
+            # Reported before the results are yielded, the generator is not resumed after the last file
+            print(
+                f"Completed {file_path}: {round((file_index+1)/len(files), 2) * 100}% complete"
+            )
+            yield file_path, section_results
+        return
+
+    completed = itertools.count(1)
+
+    with util_process_pool(jobs) as executor:
+        futures = [executor.submit(uAprofile.in_worker(analyse_file_with_engine), file_path, options) for file_path in files]
+        for file_path, future in zip(files, futures):
+            # Callbacks are run one at a time by the thread collecting the worker results
+            future.add_done_callback(
+                lambda future, file_path=file_path: print(
+                    f"Completed {file_path}: {round(next(completed)/len(files), 2) * 100}% complete"
+                )
+            )
+        for file_path, future in zip(files, futures):
+            yield file_path, uAprofile.collect(future.result())
+
+
+def format_section_results(label: str, section_results: dict) -> str:
+    output_line = ""
+    for section in SECTION_NAMES:
+        counter, current, time, joules, *statistics = section_results[section]
+        output_line += f"{label},{section},{counter},{current/counter if counter else 0},{current},{time},{joules}"
+        output_line += "".join(f",{value}" for value in statistics) + "\n"
+    return output_line
+
+
+def util_find_files(paths: list) -> list:
+    """Returns the csv files, compressed or not, in or pointed to by paths sorted by label"""
     files = []
-    for path in args.path:
+    for path in paths:
         if os.path.isdir(path):
-            files += [p.path for p in os.scandir(path) if os.path.isfile(p) and p.path.split('.')[-1] == 'csv']
+            files += [p.path for p in os.scandir(path) if os.path.isfile(p) and p.name.endswith(CAPTURE_EXTENSIONS)]
         elif os.path.isfile(path):
             files.append(path)
+    files.sort(key=lambda file_path: (label_sort_key(get_label_from_file_path(file_path)), file_path))
+    return files
+
+
+def convert(paths: list, jobs: int = 1):
+    files = util_find_files(paths)
+    with util_process_pool(max(jobs, 1)) as executor:
+        for file_index, (file_path, cache_path) in enumerate(zip(files, map(uAprofile.collect, executor.map(uAprofile.in_worker(convert_capture), files)))):
+            print(
+                f"Converted {file_path} to {cache_path}: {round((file_index+1)/len(files), 2) * 100}% complete"
+            )
+
+
+def build_pyramid(file_path: str) -> str:
+    """Write the aggregate pyramid of a power profiler file next to it, see uApyramid
+
+    Every sample is aggregated, the section of samples outside the running application is
+    PIN_MAP_NOT_RUNNING.
+
+    Returns:
+        str: path of the pyramid
+    """
+    builder = PyramidBuilder()
+    for timestamp, current, pins in uAprofile.timed_samples(read_samples(file_path, "mmap"), file_path):
+        with uAprofile.phase("classify", file_path, len(current)):
+            running_current, sections, running = classify_samples(current, pins)
+            sample_sections = np.full(len(current), PIN_MAP_NOT_RUNNING, dtype=np.int64)
+            sample_sections[running] = util_split_sleep(running_current, sections, SLEEP_THRESHOLD)
+        with uAprofile.phase("aggregate", file_path, len(current)):
+            builder.add_samples(timestamp, current, sample_sections)
+
+    pyramid_path = util_pyramid_path(file_path)
+    with uAprofile.phase("write", pyramid_path):
+        builder.save(pyramid_path)
+    return pyramid_path
+
+
+def pyramid(paths: list, jobs: int = 1):
+    files = util_find_files(paths)
+    with util_process_pool(max(jobs, 1)) as executor:
+        for file_index, (file_path, pyramid_path) in enumerate(zip(files, map(uAprofile.collect, executor.map(uAprofile.in_worker(build_pyramid), files)))):
+            print(
+                f"Built {pyramid_path} of {file_path}: {round((file_index+1)/len(files), 2) * 100}% complete"
+            )
+
+
+def follow_file(file_path: str, options: AnalysisOptions, interval: float):
+    """Analyse a file while it is still being written, until interrupted
+
+    The file is read from the byte offset where the previous read ended, and only complete lines
+    are parsed, so every sample is read once. Running results are printed every `interval`
+    seconds. A file that shrinks is taken to be a new capture and the analysis starts over.
+
+    Returns:
+        dict: section name -> [number of samples, total current, total time] of the samples read
+    """
+    label = get_label_from_file_path(file_path)
+    accumulator = options.accumulator()
+    pending = b""
+    header_read = False
+    next_report = time.monotonic() + interval
+
+    with open(file_path, "rb") as file:
+        try:
+            while True:
+                if os.fstat(file.fileno()).st_size < file.tell():
+                    print(util_color(INFO_COLOR) + f"{file_path} was truncated, starting over")
+                    file.seek(0)
+                    accumulator = options.accumulator()
+                    pending = b""
+                    header_read = False
+
+                data = file.read(FOLLOW_BLOCK_SIZE)
+                if data:
+                    pending += data
+                    if not header_read and b"\n" in pending:
+                        header, pending = pending.split(b"\n", 1)
+                        # Header line
+                        print(header.decode())
+                        header_read = True
+                    last_newline = pending.rfind(b"\n") + 1
+                    if header_read and last_newline:
+                        timestamp, current, pins = parse_sample_block(np.frombuffer(pending, dtype=np.uint8, count=last_newline))
+                        accumulator.add_samples(timestamp, current, pins)
+                        pending = pending[last_newline:]
+
+                if time.monotonic() >= next_report:
+                    print(util_color(INFO_COLOR) + f"Running results of {file_path}")
+                    print(format_section_results(label, accumulator.results()))
+                    next_report = time.monotonic() + interval
+
+                if len(data) < FOLLOW_BLOCK_SIZE:
+                    time.sleep(FOLLOW_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            print(util_color(INFO_COLOR) + f"Stopped following {file_path}")
+    return accumulator.results()
+
+
+def util_remove_existing_outputs(outputs: list):
+    for output in outputs:
+        if os.path.isfile(output):
+            """
+                If output file exists from before, ask user to overwrite or exit exec
+            """
+            print(f'The provided result file "{output}" already exist.')
+            answer = None
+            while answer not in ['yes', 'no']:
+                answer = input("Do you want to overwrite it? [yes/no]")
+            if answer == 'no':
+                os.exit(f"Please provide a different output file.")
+            os.remove(output)
+
+
+def util_analysis_options(args) -> AnalysisOptions:
+    output_root, _ = os.path.splitext(args.output)
+    return AnalysisOptions(
+        args.engine,
+        args.chunks,
+        args.statistics,
+        args.sleep_threshold_sweep,
+        f"{output_root}_segments" if args.segments else None,
+        args.timing or "accumulate",
+        SUPPLY_VOLTAGE if args.voltage is None else args.voltage,
+        util_pipeline_buffer_size(args),
+        args.queue_depth or PIPELINE_QUEUE_DEPTH,
+    )
+
+
+def util_pipeline_buffer_size(args) -> int:
+    # --buffer-size is given in MiB
+    return args.buffer_size * 1024 * 1024 if args.buffer_size else PIPELINE_BUFFER_SIZE
+
+
+def MAIN(args):
+    print(util_color(INFO_COLOR) + "Starting uAnalyser script")
+    output_root, output_extension = os.path.splitext(args.output)
+    options = util_analysis_options(args)
+    if options.sleep_thresholds:
+        outputs = [f"{output_root}_threshold-{threshold:g}{output_extension}" for threshold in options.sleep_thresholds]
+    else:
+        outputs = [args.output]
+    gap_output = f"{output_root}_gaps{output_extension}" if options.timing == "timestamps" else None
+
+    util_remove_existing_outputs(outputs + ([gap_output] if gap_output else []))
+
+    if args.follow:
+        if not os.path.isfile(args.path[0]):
+            sys.exit(f"Path does not point to file: {args.path[0]}")
+        if util_is_compressed(args.path[0]):
+            sys.exit(f"A compressed capture can not be followed: {args.path[0]}")
+        section_results = follow_file(args.path[0], options, args.interval)
+        with open(args.output, "x") as out_file:
+            out_file.write(RESULT_HEADER + (STATISTICS_HEADER if options.statistics else "") + "\n")
+            out_file.write(format_section_results(get_label_from_file_path(args.path[0]), section_results))
+        if gap_output:
+            with open(gap_output, "x") as gap_file:
+                gap_file.write(GAP_HEADER + "\n")
+                gap_file.write(format_gaps(get_label_from_file_path(args.path[0]), section_results["gaps"]))
+        return
+
+    files = util_find_files(args.path)
     print(files)
-    for file_index, file_path in enumerate(files):
+    for file_path in files:
         if not os.path.exists(file_path):
             sys.exit(f"Path does not exist: {file_path}")
 
         if not os.path.isfile(file_path):
             sys.exit(f"Path does not point to file: {file_path}")
 
-        file = open(file_path, "r")
-
-        # Track the total current drawn for each section
-        current_total   = 0
-        current_setup   = 0
-        current_compute = 0
-        current_send    = 0
-        current_sleep   = 0
-        current_modem   = 0
-        current_system  = 0
-
-        # Track the number of measurements for each section
-        counter_total   = 0
-        counter_setup   = 0
-        counter_compute = 0
-        counter_send    = 0
-        counter_sleep   = 0
-        counter_modem   = 0
-        counter_system  = 0
-
-        # Track the total time of each section
-        time_total      = 0
-        time_setup      = 0
-        time_compute    = 0
-        time_send       = 0
-        time_sleep      = 0
-        time_modem      = 0
-        time_system     = 0
-        
-        # [current, counter, time]
-        
-        # SYSTEM_INDEX_CURRENT = 0
-        # SYSTEM_INDEX_COUNT   = 1
-        # SYSTEM_INDEX_TIME    = 0
-        
-        # system_values = {
-        #     10:     [0]*3,
-        #     20:     [0]*3,
-        #     40:     [0]*3,
-        #     80:     [0]*3,
-        #     160:    [0]*3,
-        # }
+    cache = None if args.no_cache or args.segments else ResultCache(args.cache)
+    # (label, section results) of every file, per result file
+    stores = {output: [] for output in outputs}
+    for file_index, (file_path, results) in enumerate(analyse_files(files, options, args.jobs, cache)):
+        print(util_read_header(file_path))
+        for output, section_results in zip(outputs, results if options.sleep_thresholds else [results]):
+            stores[output].append((get_label_from_file_path(file_path), section_results))
+            print(format_section_results(get_label_from_file_path(file_path), section_results))
 
-        # Header line
-        print(file.readline())
-
-        # Initial measure
-        # previous_section = None
-        # previous_timestamp = None
-        # previous_current = None
-        # previous_pins = None
-        for line_index, line_data in enumerate(file):
-            timestamp, current, pins = [elem for elem in line_data.split(',')[:3]]
-            app_health = pins[APP_STATE_PINS[0]:APP_STATE_PINS[1]]
-
-            if application_is_running(app_health) and pins[PIN_MAIN] == '1':
-                timestamp       = float(timestamp)
-                current         = float(current) if float(current) > 0 else 0
-                state           = pins[PIN_GENERAL_1: PIN_GENERAL_2 + 1]
-                counter_total   += 1
-                current_total   += current
-                time_total      += TIME_DELTA
-                
-                ###### One of the coming to count ######
-                if state == APP_STATE[SETUP]:
-                    current_setup   += current
-                    counter_setup   += 1
-                    time_setup      += TIME_DELTA
-                
-                elif state == APP_STATE[SEND]:
-                    current_send   += current
-                    counter_send   += 1
-                    time_send      += TIME_DELTA
-
-                elif state == APP_STATE[COMPUTE]:
-                    current_compute   += current
-                    counter_compute   += 1
-                    time_compute += TIME_DELTA
-                
-                elif state == APP_STATE[SLEEP]:
-                    if pins[PIN_MODEM] == '1':
-                        current_modem   += current
-                        counter_modem   += 1
-                        time_modem += TIME_DELTA
-                    
-                    elif current > SLEEP_THRESHOLD:
-                        current_system += current
-                        counter_system += 1
-                        time_system += TIME_DELTA
-
-                    else:
-                        current_sleep   += current
-                        counter_sleep   += 1
-                        time_sleep += TIME_DELTA
-                                      
-                else:
-                    print(ERROR_COLOR + f"No state matching the current state in running: state={state}, does not match any of {APP_STATE}")
-                        
-                # previous_timestamp = timestamp
-                # previous_current = current
-                # previous_pins = pins
-        
-                """
-                REMEMBER TO CHECK STATE OF LAST SAMPLE TO SEE IF STATE IS DIFFERENT OR EQUAL
-                ONLY ADD TO TOTAL TIME OF STATE IF STATE IS EQUAL TO LAST STATE...
-                """
-        
-        # Close the read file
-        file.close()
+        if gap_output:
+            gaps = (results[0] if options.sleep_thresholds else results)["gaps"]
+            with open(gap_output, "x" if file_index == 0 else "a") as gap_file:
+                if file_index == 0:
+                    gap_file.write(GAP_HEADER + "\n")
+                gap_file.write(format_gaps(get_label_from_file_path(file_path), gaps))
+            if gaps:
+                print(util_color(INFO_COLOR) + f"{len(gaps)} gaps in the timestamps of {file_path}, see {gap_output}")
 
-        if file_index == 0:
-            out_file = open(args.output, "x")
-            out_file.write("Label, Section, Number of samples, Average Current (uA), Total Current (uA) ,Total time(ms)\n")
-        else:
-            out_file = open(args.output, "a")
-
-        output_line = (
-            f"{get_label_from_file_path(file_path)},total,{counter_total},{current_total/counter_total if counter_total else 0},{current_total},{time_total}\n"
-            f"{get_label_from_file_path(file_path)},setup,{counter_setup},{current_setup/counter_setup if counter_setup else 0},{current_setup},{time_setup}\n"
-            f"{get_label_from_file_path(file_path)},compute,{counter_compute},{current_compute/counter_compute if counter_compute else 0},{current_compute},{time_compute}\n"
-            f"{get_label_from_file_path(file_path)},send,{counter_send},{current_send/counter_send if counter_send else 0},{current_send},{time_send}\n"
-            f"{get_label_from_file_path(file_path)},sleep,{counter_sleep},{current_sleep/counter_sleep if counter_sleep else 0},{current_sleep},{time_sleep}\n"
-            f"{get_label_from_file_path(file_path)},modem,{counter_modem},{current_modem/counter_modem if counter_modem else 0},{current_modem},{time_modem}\n"
-            f"{get_label_from_file_path(file_path)},system,{counter_system},{current_system/counter_system if counter_system else 0},{current_system},{time_system}\n"
-        )
-        print(output_line)
-        if args.output:
-            out_file.write(output_line)
+    # The results are also stored as a typed array next to every result file, see uAresults. Both
+    # list the files in the order of the array
+    for output, file_results in stores.items():
+        with uAprofile.phase("write", output):
+            file_results = [file_results[index] for index in label_order([label for label, _ in file_results])]
+            with open(output, "x") as out_file:
+                out_file.write(RESULT_HEADER + (STATISTICS_HEADER if options.statistics else "") + "\n")
+                for label, section_results in file_results:
+                    out_file.write(format_section_results(label, section_results))
+            save_results(os.path.splitext(output)[0] + ".npy", util_result_store(file_results))
 
-        if args.output and out_file:
-            out_file.close()
 
-        print(
-            f"Completed {file_path}: {round((file_index+1)/len(files), 2) * 100}% complete"
-        )
+def aggregate(
+    paths: list,
+    output: str,
+    options: AnalysisOptions,
+    jobs: int = 1,
+    cache: ResultCache = None,
+    resamples: int = 1000,
+    confidence: float = 0.95,
+) -> dict:
+    """Analyse repeated captures and write the statistics of the repeats of every label
+
+    Captures with the same label, e.g. run_1/tls_10_256B.csv and run_2/tls_10_256B.csv, are
+    repeats of one configuration. Every capture is analysed once, with the result cache, and
+    the statistics are computed from the results of all captures at once, see
+    aggregate_repeats. Writes <output>_<statistic> for every statistic, with its result array
+    next to it.
+
+    Returns:
+        dict: statistic -> result array
+    """
+    output_root, output_extension = os.path.splitext(output)
+    outputs = {statistic: f"{output_root}_{statistic}{output_extension}" for statistic in REPEAT_STATISTICS}
+    util_remove_existing_outputs(list(outputs.values()))
+
+    files = util_find_files(paths)
+    file_results = [
+        (get_label_from_file_path(file_path), section_results)
+        for file_path, section_results in analyse_files(files, options, jobs, cache)
+    ]
+    repeats = collections.Counter(label for label, _ in file_results)
+    for label, count in repeats.items():
+        print(f"{label}: {count} repeats")
+
+    with uAprofile.phase("aggregate", rows=len(file_results)):
+        aggregated = aggregate_repeats(util_result_store(file_results), resamples, confidence)
+    for statistic, output in outputs.items():
+        with uAprofile.phase("write", output), open(output, "x") as out_file:
+            out_file.write(RESULT_HEADER + "\n")
+            out_file.write(format_result_rows(aggregated[statistic]))
+            save_results(os.path.splitext(output)[0] + ".npy", aggregated[statistic])
+        print(util_color(SUCCESS_COLOR) + f"Wrote the {statistic} of the repeats to {output}")
+    return aggregated
+
+
+def format_result_rows(results) -> str:
+    """Lines of a result file from a result array of uAresults"""
+    return "".join(
+        f"{label},{section},{count},{average_current},{total_current},{time},{joules}\n"
+        for label, _, _, _, section, count, average_current, total_current, time, joules in results.tolist()
+    )
+
+
+def util_result_store(file_results: list):
+    """Result array of uAresults from the (label, section results) of analysed files"""
+    rows = [
+        (label, section, *section_results[section][:4])
+        for label, section_results in file_results
+        for section in SECTION_NAMES
+    ]
+    labels, sections, counters, currents, times, joules = zip(*rows) if rows else [[]] * 6
+    counters = np.array(counters, dtype=np.int64)
+    currents = np.array(currents, dtype=np.float64)
+    average_currents = np.divide(currents, counters, out=np.zeros(len(counters)), where=counters > 0)
+    return make_results(labels, sections, counters, average_currents, currents, times, joules)
+
+
+def format_gaps(label: str, gaps: list) -> str:
+    """One line per gap found by a SampleClock"""
+    return "".join(
+        f"{label},{sample},{previous},{timestamp},{'out of order' if timestamp <= previous else 'dropped'}\n"
+        for sample, previous, timestamp in gaps
+    )
+
         
-def sleep_analysis():
-    if not os.path.isfile(args.path[0]):
-        sys.exit(f"Path is not a file: {args.path[0]}")
+def sleep_analysis(
+    file_path: str,
+    output: str,
+    engine: str = "python",
+    timing: str = "timestamps",
+    buffer_size: int = PIPELINE_BUFFER_SIZE,
+    queue_depth: int = PIPELINE_QUEUE_DEPTH,
+):
+    """Current statistics of every sample taken while the application is running
+
+    The file is read once with constant memory, so files larger than RAM can be analysed.
+    With timing 'timestamps' the gaps in the timestamps are written next to the output.
+    """
+    if not os.path.isfile(file_path):
+        sys.exit(f"Path is not a file: {file_path}")
+    print(util_read_header(file_path))
     
-    file = open(args.path[0], "r")
-    print(file.readline())
+    use_capture_cache = util_capture_cache_is_fresh(file_path)
+    with uAprofile.phase("sleep", file_path, bytes=os.path.getsize(file_path)):
+        if engine == "python" and not use_capture_cache:
+            total_current, time, moments, gaps = sleep_analysis_python(file_path, timing)
+        else:
+            total_current, time, moments, gaps = sleep_analysis_vectorized(file_path, engine, timing, buffer_size, queue_depth)
+
+    number_of_samples = moments.count
+    average_current = total_current / number_of_samples
+    variance = moments.variance
+    standard_deviation = moments.standard_deviation
+    
+    out_file = open(output, "x")
+    
+    out_string = f"Runtime, Number of samples, Total Current, Average Current, Variance, Standard Deviation, 'x + 3*σ, Minimum, Maximum, Skewness, Kurtosis\n"
+    out_string += f"{time},{number_of_samples},{total_current},{average_current},{variance},{standard_deviation}, {average_current + 3*standard_deviation},{moments.minimum},{moments.maximum},{moments.skewness},{moments.kurtosis}\n"
+    
+    out_file.write(out_string)
+    out_file.close()
+
+    if timing == "timestamps":
+        output_root, output_extension = os.path.splitext(output)
+        with open(f"{output_root}_gaps{output_extension}", "x") as gap_file:
+            gap_file.write(GAP_HEADER + "\n")
+            gap_file.write(format_gaps(get_label_from_file_path(file_path), gaps))
+        if gaps:
+            print(util_color(INFO_COLOR) + f"{len(gaps)} gaps in the timestamps of {file_path}, see {output_root}_gaps{output_extension}")
+
+
+def sleep_analysis_python(file_path: str, timing: str = "timestamps"):
+    """Returns total current, runtime, the RunningMoments of the current of running samples and the gaps
+
+    With timing 'timestamps' the runtime is the time between consecutive running samples, see
+    SectionAccumulator for the others. Gaps are only looked for with 'timestamps'.
+    """
+    file = open_capture(file_path, "r")
+    # Header line, printed by the command line
+    file.readline()
     
     total_current = 0
-    number_of_samples = 0
     time = 0
+    previous_timestamp = None
+    previous_sample_timestamp = None
+    gaps = []
+    moments = RunningMoments()
+    application_running = util_pin_string_table(PIN_APPLICATION_RUNNING)
     
-    for line_index, line_data in enumerate(file.readlines()):
+    for line_index, line_data in enumerate(file):
         timestamp, current, pins = [elem for elem in line_data.split(',')[:3]]
-        app_health = pins[APP_STATE_PINS[0]:APP_STATE_PINS[1]]
+
+        if timing == "timestamps":
+            timestamp = float(timestamp)
+            if previous_sample_timestamp is not None and not (
+                0 < timestamp - previous_sample_timestamp <= GAP_TOLERANCE * TIME_DELTA
+            ):
+                gaps.append((line_index, previous_sample_timestamp, timestamp))
+            previous_sample_timestamp = timestamp
         
-        if application_is_running(app_health):
+        if application_running[pins[:PIN_COUNT]]:
             current = float(current) if float(current) > 0 else 0
-            timestamp = float(timestamp)
             total_current += current
+            moments.add(current)
             
-            if previous_timestamp is not None:
-                time += timestamp - previous_timestamp
-            
-            number_of_samples += 1
-            
-            previous_timestamp = timestamp
-            previous_current = current
-            previous_pins = pins
+            if timing == "accumulate":
+                time += TIME_DELTA
+            elif timing == "timestamps":
+                if previous_timestamp is not None:
+                    time += timestamp - previous_timestamp
+                previous_timestamp = timestamp
         else:
             previous_timestamp = None
-            previous_current = None
-    
-    average_current = total_current / number_of_samples
     
     file.close()
-    file = open(args.path[0], "r")
-    print(file.readline())
-    
-    sum_of_absolute_difference = 0
-    
-    for line_index, line_data in enumerate(file.readlines()):
-        timestamp, current, pins = [elem for elem in line_data.split(',')[:3]]
-        app_health = pins[APP_STATE_PINS[0]:APP_STATE_PINS[1]]
-        
-        if application_is_running(app_health):
-            current = float(current) if float(current) > 0 else 0
-            sum_of_absolute_difference += (current - average_current)**2
-            
-    
-    variance = sum_of_absolute_difference / number_of_samples
-    standard_deviation = sqrt(variance)
-    
-    out_file = open(args.output, "x")
-    
-    out_string = f"Runtime, Number of samples, Total Current, Average Current, Variance, Standard Deviation, 'x + 3*σ\n"
-    out_string += f"{time},{number_of_samples},{total_current},{average_current},{variance},{standard_deviation}, {average_current + 3*standard_deviation}\n"
-    
-    out_file.write(out_string)
-    
+    if timing == "samples":
+        time = moments.count * TIME_DELTA
+    return total_current, time, moments, gaps
+
+
+def sleep_analysis_vectorized(
+    file_path: str,
+    engine: str,
+    timing: str = "timestamps",
+    buffer_size: int = PIPELINE_BUFFER_SIZE,
+    queue_depth: int = PIPELINE_QUEUE_DEPTH,
+):
+    """Same as sleep_analysis_python, reading the samples with the numpy, mmap or pipeline engine"""
+    total_current = 0
+    time = 0
+    previous_timestamp = None
+    clock = SampleClock()
+    moments = RunningMoments()
+
+    samples = read_capture(file_path, engine, buffer_size=buffer_size, queue_depth=queue_depth)
+    for timestamp, current, pins in uAprofile.timed_samples(samples, file_path):
+        if not len(timestamp):
+            continue
+        if timing == "timestamps":
+            # Only the gaps are used, time is measured between running samples below
+            clock.integrate(timestamp, current)
+        running = PIN_APPLICATION_RUNNING[pins]
+        current = current[running]
+        total_current = util_sequential_sum(total_current, current[current > 0])
+        moments.add_array(np.where(current > 0, current, 0.0))
+
+        if timing == "accumulate":
+            time = util_sequential_sum(time, np.full(len(current), TIME_DELTA))
+        elif timing == "timestamps":
+            # Time only passes between two consecutive running samples
+            previous_running = np.concatenate(([previous_timestamp is not None], running[:-1]))
+            previous_timestamps = np.concatenate(([previous_timestamp or 0], timestamp[:-1]))
+            consecutive = running & previous_running
+            time = util_sequential_sum(time, timestamp[consecutive] - previous_timestamps[consecutive])
+            previous_timestamp = timestamp[-1] if running[-1] else None
+
+    if timing == "samples":
+        time = moments.count * TIME_DELTA
+    return total_current, time, moments, clock.gaps
+
+
+@dataclass
+class SectionResult:
+    """Result of one section of a capture
+
+    The statistics are None unless the capture was analysed with statistics.
+    """
+
+    count: int
+    # Sum of the current of every sample (uA)
+    total_current: float
+    # ms
+    time: float
+    joules: float
+    variance: float = None
+    standard_deviation: float = None
+    peak_current: float = None
+    # STATISTICS_QUANTILES -> current (uA)
+    quantiles: dict = None
+
+    @property
+    def average_current(self) -> float:
+        return self.total_current / self.count if self.count else 0
+
+    @classmethod
+    def from_values(cls, values: list) -> "SectionResult":
+        """From the list of a section in the section results of SectionAccumulator.results"""
+        count, total_current, time, joules, *statistics = values
+        if not statistics:
+            return cls(count, total_current, time, joules)
+        variance, standard_deviation, peak_current, *quantiles = statistics
+        return cls(
+            count, total_current, time, joules, variance, standard_deviation, peak_current,
+            dict(zip(STATISTICS_QUANTILES, quantiles)),
+        )
+
+    def values(self) -> list:
+        values = [self.count, self.total_current, self.time, self.joules]
+        if self.quantiles is not None:
+            values += [self.variance, self.standard_deviation, self.peak_current, *self.quantiles.values()]
+        return values
+
+
+@dataclass
+class AnalysisResult:
+    """Results of every section of one capture, sections are in the order of SECTION_NAMES"""
+
+    label: str
+    sections: dict
+    # (sample, previous timestamp, timestamp) of every gap, only looked for with timing 'timestamps'
+    gaps: list = field(default_factory=list)
+    # The sleep threshold of this result in a sweep, SLEEP_THRESHOLD otherwise
+    sleep_threshold: float = SLEEP_THRESHOLD
+
+    def __getitem__(self, section: str) -> SectionResult:
+        return self.sections[section]
+
+    @classmethod
+    def from_section_results(cls, label: str, section_results: dict, sleep_threshold: float = SLEEP_THRESHOLD) -> "AnalysisResult":
+        return cls(
+            label,
+            {section: SectionResult.from_values(section_results[section]) for section in SECTION_NAMES},
+            [tuple(gap) for gap in section_results.get("gaps", [])],
+            sleep_threshold,
+        )
+
+    def section_results(self) -> dict:
+        return {section: result.values() for section, result in self.sections.items()}
+
+    def to_csv(self) -> str:
+        """The lines of this capture in a result file"""
+        return format_section_results(self.label, self.section_results())
+
+    def to_array(self):
+        """The result array of uAresults, as read by the plotters"""
+        return util_result_store([(self.label, self.section_results())])
+
+
+class Analyzer:
+    """Analyse captures from Python, e.g. a notebook or a batch driver, without the command line
+
+    The options are those of 'analyse'. One Analyzer analyses any number of captures in the
+    process it lives in, so imports and the pin tables are only set up once. A pin map, a dict
+    laid out like DEFAULT_PIN_MAP or the path to a TOML file, applies to the whole process.
+
+        analyzer = Analyzer(engine="mmap", statistics=True)
+        result = analyzer.analyse("captures/tls_10_256B.csv")
+        result["send"].joules
+    """
+
+    def __init__(
+        self,
+        engine: str = "numpy",
+        chunks: int = 1,
+        statistics: bool = False,
+        timing: str = "accumulate",
+        voltage: float = SUPPLY_VOLTAGE,
+        pin_map=None,
+        cache: str = None,
+        buffer_size: int = PIPELINE_BUFFER_SIZE,
+        queue_depth: int = PIPELINE_QUEUE_DEPTH,
+    ):
+        self.options = AnalysisOptions(
+            engine, chunks, statistics, timing=timing, voltage=voltage, buffer_size=buffer_size, queue_depth=queue_depth
+        )
+        if pin_map is not None:
+            set_pin_map(load_pin_map(pin_map) if isinstance(pin_map, (str, os.PathLike)) else pin_map)
+        self.cache_path = cache
+
+    def analyse(self, source, label: str = None) -> AnalysisResult:
+        """Analyse a capture, given as a path or as an open binary or text file
+
+        The label defaults to the file name without extensions.
+        """
+        if isinstance(source, (str, os.PathLike)):
+            result = self.analyse_files([os.fspath(source)])[0]
+            if label is not None:
+                result.label = label
+            return result
+        label = label or get_label_from_file_path(str(getattr(source, "name", "capture")))
+        return AnalysisResult.from_section_results(label, analyse_stream(source, self.options))
+
+    def analyse_files(self, paths: list, jobs: int = 1) -> list:
+        """Analyse the captures in, or pointed to by, paths with `jobs` worker processes, sorted by label"""
+        cache = ResultCache(self.cache_path) if self.cache_path else None
+        return [
+            AnalysisResult.from_section_results(get_label_from_file_path(file_path), section_results)
+            for file_path, section_results in analyse_files(util_find_files(paths), self.options, jobs, cache)
+        ]
+
+    def aggregate(self, paths: list, jobs: int = 1, resamples: int = 1000, confidence: float = 0.95) -> dict:
+        """Statistics of the repeated captures in, or pointed to by, paths, see aggregate_repeats"""
+        results = self.analyse_files(paths, jobs)
+        store = util_result_store([(result.label, result.section_results()) for result in results])
+        return aggregate_repeats(store, resamples, confidence)
+
+    def sweep(self, source, sleep_thresholds: list) -> list:
+        """Results of a capture path for every sleep threshold, from a single pass over it"""
+        options = AnalysisOptions(**{**self.options.__dict__, "sleep_thresholds": tuple(sleep_thresholds)})
+        label = get_label_from_file_path(os.fspath(source))
+        return [
+            AnalysisResult.from_section_results(label, section_results, threshold)
+            for threshold, section_results in zip(sleep_thresholds, analyse_file_with_engine(os.fspath(source), options))
+        ]
+
+
+def main(argv: list = None):
+    """The command line, a thin wrapper of the functions above"""
+    args = parse_arguments(argv)
+    with uAprofile.profile_run(args, "uAnalyser"):
+        if args.command == "sleep":
+            sleep_analysis(
+                args.path[0],
+                args.output,
+                args.engine,
+                args.timing or "timestamps",
+                util_pipeline_buffer_size(args),
+                args.queue_depth or PIPELINE_QUEUE_DEPTH,
+            )
+        elif args.command == "convert":
+            convert(args.path, args.jobs)
+        elif args.command == "pyramid":
+            pyramid(args.path, args.jobs)
+        elif args.command == "aggregate":
+            cache = None if args.no_cache or args.segments else ResultCache(args.cache)
+            aggregate(args.path, args.output, util_analysis_options(args), args.jobs, cache, args.resamples, args.confidence)
+        else:
+            MAIN(args)
+
 
 if __name__ == "__main__":
-    MAIN()
-    # sleep_analysis()
+    main()
@@ -1,37 +1,16 @@
 import argparse
+import itertools
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-
-parser = argparse.ArgumentParser(
-    description="Command line tool for plotting results from uAnalyser tool, authored by Ådne Karstad @aadnekar"
-)
-
-parser.add_argument(
-    "--path",
-    nargs="+",
-    required=False,
-    help="relative path to source file to analyse. Provide several path's to compare results.",
-)
-parser.add_argument(
-    "--output",
-    "-o",
-    type=str,
-    help="file path to output file",
-)
-args = parser.parse_args()
-
-if args.path:
-    SOURCE_FILE = args.path[0]
-else:
-    SOURCE_FILE = "./results.csv"
-    # SOURCE_FILE = "./final_results9.csv"
-if args.output:
-    RESULTS_DIR = args.output
-else:
-    RESULTS_DIR = "./plots"
-
-
-MILLI_VOLTAGE = 3.7 * 1000
+from uApyramid import Pyramid, util_pyramid_path
+from uAresults import load_results
+import uAprofile
+
+
+# Defaults without --path and --output
+SOURCE_FILE = "./results.csv"
+# SOURCE_FILE = "./final_results9.csv"
+RESULTS_DIR = "./plots"
 
 # COLORS = ["#E8A87C", "#C38D9E", "#E27D60", "#41B3A3"]
 COLORS = [
@@ -45,104 +24,51 @@ COLORS = [
     "#4d908e",
 ]
 
-# [pin, power, ms]
-main_dict = {"on": [], "off": []}
-startup_on = []
-startup_off = []
-simulated_activity_on = []
-simulated_activity_off = []
-system_activity_on = []
-system_activity_off = []
-sleep_on = []
-sleep_off = []
-
+# Result array of uAresults, one row per file and section
+results = None
 
-def from_current_to_mW(uA_current: float):
-    # Dette er watt = arbeid over tid
-    # milli * milli = mikro, derfor divdere med 1000 for å få mW
-    return round((from_uA_to_mA(uA_current) * MILLI_VOLTAGE) / 1000, 3)
+# Samples of a capture profile_plot parses at a time
+PROFILE_CHUNK_SIZE = 1000000
+# Only samples with this pin high are plotted
+PROFILE_PIN = 3
+PROFILE_DTYPE = np.dtype([("timestamp", np.float64), ("current", np.float64), ("pins", "S8")])
 
 
-def from_uA_to_mA(uA: float):
-    return uA / 1000
-
-
-def from_ms_to_s(ms: float):
-    return round(ms / 1000, 3)
+def from_ms_to_s(ms):
+    return np.round(ms / 1000, 3)
 
 
 def readfile(filename: str):
-    for index, line in enumerate(open(filename, "r")):
-        if index == 0:
-            continue
-
-        # Remove \n and split data
-        item_list = line[:-1].split(",")
-        for index, item in enumerate(item_list):
-            if index == 0:
-                item_list[index] = item[len("csvdata/") : -len(".csv")]
-            elif index == 1:
-                item_list[index] = str(item)
-            elif index == 2:
-                item_list[index] = from_current_to_mW(float(item))
-            elif index == 3:
-                item_list[index] = from_ms_to_s(float(item))
-        if "on" in item_list[0]:
-            main_dict["on"].append(item_list)
-        else:
-            main_dict["off"].append(item_list)
-
-
-def setup_section_data(tls="on"):
-    global simulated_activity_on, simulated_activity_off
-    global system_activity_on, system_activity_off
-    global startup_on, startup_off
-    global sleep_on, sleep_off
-
-    simulated_activity_on = [
-        p for p in [vals for vals in main_dict["on"]] if p[1] == "application"
-    ]
-    simulated_activity_off = [
-        p for p in [vals for vals in main_dict["off"]] if p[1] == "application"
+    """Load the rows 'csvdata/<on|off>_<payload>B_<iterations>I.csv,section,current (uA),time (ms)'"""
+    global results
+    with uAprofile.phase("read", filename, bytes=os.path.getsize(filename)):
+        results = load_results(filename)
+
+
+def util_select_sorted(tls: str, constant: str, section: str):
+    """Rows of a section with TLS on or off and constant in the label, sorted by the other label value"""
+    selected = results[
+        (results["protocol"] == tls)
+        & (results["section"] == section)
+        & (np.char.find(results["label"], constant) >= 0)
     ]
+    # The iterations when the payload is constant, otherwise the payload
+    key = selected["operations"] if "B" in constant else selected["payload"]
+    return selected[np.argsort(key, kind="stable")]
 
-    system_activity_on = [
-        p for p in [vals for vals in main_dict["on"]] if p[1] == "system"
-    ]
-    system_activity_off = [
-        p for p in [vals for vals in main_dict["off"]] if p[1] == "system"
-    ]
-
-    startup_on = [p for p in [vals for vals in main_dict["on"]] if p[1] == "startup"]
-    startup_off = [p for p in [vals for vals in main_dict["off"]] if p[1] == "startup"]
 
-    sleep_on = [p for p in [vals for vals in main_dict["on"]] if p[1] == "sleep"]
-    sleep_off = [p for p in [vals for vals in main_dict["off"]] if p[1] == "sleep"]
+def get_E_sorted_and_filtered_by(tls: str, constant: str, section: str):
+    # Integrated by uAnalyser at its --voltage. Results without an energy column get it from the
+    # average current and time at SUPPLY_VOLTAGE, see uAresults
+    return util_select_sorted(tls, constant, section)["joules"]
 
-    # pin5 = [p for p in [vals for vals in main_dict[tls]] if p[1] == "pin5"]
 
+def get_time_sorted_and_filtered_by(tls: str, constant: str, section: str):
+    return from_ms_to_s(util_select_sorted(tls, constant, section)["time"])
 
-def get_E_sorted_and_filtered_by(tls: str, constant: str, l: list):
-    return [
-        # elem[2] = mW
-        # elem[3] = s
-        # 10^3 * 10^3 = 10^6 ==> mJoule / 1000 => Joule
-        (elem[2] * elem[3]) / 1000
-        for elem in sorted(
-            l, key=lambda elems: get_label_value(tls, constant, elems[0])
-        )
-        if constant in elem[0]
-    ]
 
-
-def get_time_sorted_and_filtered_by(tls: str, constant: str, l: list):
-    return [
-        elem[3]
-        for elem in sorted(
-            l, key=lambda elems: get_label_value(tls, constant, elems[0])
-        )
-        if constant in elem[0]
-    ]
+def get_labels_sorted_and_filtered_by(tls: str, constant: str):
+    return [get_label(tls, constant, label) for label in util_select_sorted(tls, constant, "application")["label"]]
 
 
 def get_label(tls: str, constant: str, label: str):
@@ -152,45 +78,33 @@ def get_label(tls: str, constant: str, label: str):
         return label[len(f"{tls}_") : -len(f"_{constant}")]
 
 
-def get_label_value(tls: str, constant: str, label: str):
-    if "B" in constant:
-        return int(label[len(f"{tls}_{constant}_") : -len("I")])
-    else:
-        return int(label[len(f"{tls}_") : -len(f"B_{constant}")])
-
+def plot_E_grouped(constant: str, results_dir: str = RESULTS_DIR):
+    import matplotlib.pyplot as plt
 
-def plot_E_grouped(constant: str):
     tls_on = "on"
     tls_off = "off"
 
-    local_startup_on = get_E_sorted_and_filtered_by(tls_on, constant, startup_on)
-    local_startup_off = get_E_sorted_and_filtered_by(tls_off, constant, startup_off)
+    local_startup_on = get_E_sorted_and_filtered_by(tls_on, constant, "startup")
+    local_startup_off = get_E_sorted_and_filtered_by(tls_off, constant, "startup")
 
     local_simulated_activity_on = get_E_sorted_and_filtered_by(
-        tls_on, constant, simulated_activity_on
+        tls_on, constant, "application"
     )
     local_simulated_activity_off = get_E_sorted_and_filtered_by(
-        tls_off, constant, simulated_activity_off
+        tls_off, constant, "application"
     )
 
     local_system_activity_on = get_E_sorted_and_filtered_by(
-        tls_on, constant, system_activity_on
+        tls_on, constant, "system"
     )
     local_system_activity_off = get_E_sorted_and_filtered_by(
-        tls_off, constant, system_activity_on
+        tls_off, constant, "system"
     )
 
-    local_sleep_on = get_E_sorted_and_filtered_by(tls_on, constant, sleep_on)
-    local_sleep_off = get_E_sorted_and_filtered_by(tls_off, constant, sleep_off)
+    local_sleep_on = get_E_sorted_and_filtered_by(tls_on, constant, "sleep")
+    local_sleep_off = get_E_sorted_and_filtered_by(tls_off, constant, "sleep")
 
-    labels = [
-        get_label(tls_on, constant, elem[0])
-        for elem in sorted(
-            simulated_activity_on,
-            key=lambda elems: get_label_value(tls_on, constant, elems[0]),
-        )
-        if constant in elem[0]
-    ]
+    labels = get_labels_sorted_and_filtered_by(tls_on, constant)
     width = 0.75
     x = np.arange(len(labels)) * 2
 
@@ -286,45 +200,40 @@ def plot_E_grouped(constant: str):
     ax.legend(bbox_to_anchor=(0, 1, 1, 0), loc="lower left", mode="expand", ncol=2)
 
     plt.savefig(
-        f"{RESULTS_DIR}/grouped_{constant}.png",
+        f"{results_dir}/grouped_{constant}.png",
         transparent=True,
         orientation="portrait",
     )
 
 
-def plot_time_grouped(constant: str):
+def plot_time_grouped(constant: str, results_dir: str = RESULTS_DIR):
+    import matplotlib.pyplot as plt
+
     # Data wanted in the plot
     tls_on = "on"
     tls_off = "off"
 
-    local_startup_on = get_time_sorted_and_filtered_by(tls_on, constant, startup_on)
-    local_startup_off = get_time_sorted_and_filtered_by(tls_off, constant, startup_off)
+    local_startup_on = get_time_sorted_and_filtered_by(tls_on, constant, "startup")
+    local_startup_off = get_time_sorted_and_filtered_by(tls_off, constant, "startup")
 
     local_simulated_activity_on = get_time_sorted_and_filtered_by(
-        tls_on, constant, simulated_activity_on
+        tls_on, constant, "application"
     )
     local_simulated_activity_off = get_time_sorted_and_filtered_by(
-        tls_off, constant, simulated_activity_off
+        tls_off, constant, "application"
     )
 
     local_system_activity_on = get_time_sorted_and_filtered_by(
-        tls_on, constant, system_activity_on
+        tls_on, constant, "system"
     )
     local_system_activity_off = get_time_sorted_and_filtered_by(
-        tls_off, constant, system_activity_off
+        tls_off, constant, "system"
     )
 
-    local_sleep_on = get_time_sorted_and_filtered_by(tls_on, constant, sleep_on)
-    local_sleep_off = get_time_sorted_and_filtered_by(tls_off, constant, sleep_off)
+    local_sleep_on = get_time_sorted_and_filtered_by(tls_on, constant, "sleep")
+    local_sleep_off = get_time_sorted_and_filtered_by(tls_off, constant, "sleep")
 
-    labels = [
-        get_label(tls_on, constant, elem[0])
-        for elem in sorted(
-            simulated_activity_on,
-            key=lambda elems: get_label_value(tls_on, constant, elems[0]),
-        )
-        if constant in elem[0]
-    ]
+    labels = get_labels_sorted_and_filtered_by(tls_on, constant)
 
     # Startplotting
     width = 0.5
@@ -423,33 +332,35 @@ def plot_time_grouped(constant: str):
     ax.legend(bbox_to_anchor=(0, 1, 1, 0), loc="lower left", mode="expand", ncol=2)
 
     plt.savefig(
-        f"{RESULTS_DIR}/grouped_time_{constant}.png",
+        f"{results_dir}/grouped_time_{constant}.png",
         transparent=True,
         orientation="portrait",
     )
 
 
-def plot_normalised_Energy_consumption(index: int, constant: str):
+def plot_normalised_Energy_consumption(index: int, constant: str, results_dir: str = RESULTS_DIR):
+    import matplotlib.pyplot as plt
+
     tls_on = "on"
     tls_off = "off"
 
-    local_startup_on = get_E_sorted_and_filtered_by(tls_on, constant, startup_on)
-    local_startup_off = get_E_sorted_and_filtered_by(tls_off, constant, startup_off)
+    local_startup_on = get_E_sorted_and_filtered_by(tls_on, constant, "startup")
+    local_startup_off = get_E_sorted_and_filtered_by(tls_off, constant, "startup")
 
     local_simulated_on = get_E_sorted_and_filtered_by(
-        tls_on, constant, simulated_activity_on
+        tls_on, constant, "application"
     )
     local_simulated_off = get_E_sorted_and_filtered_by(
-        tls_off, constant, simulated_activity_off
+        tls_off, constant, "application"
     )
 
-    local_system_on = get_E_sorted_and_filtered_by(tls_on, constant, system_activity_on)
+    local_system_on = get_E_sorted_and_filtered_by(tls_on, constant, "system")
     local_system_off = get_E_sorted_and_filtered_by(
-        tls_off, constant, system_activity_on
+        tls_off, constant, "system"
     )
 
-    local_idle_on = get_E_sorted_and_filtered_by(tls_on, constant, sleep_on)
-    local_idle_off = get_E_sorted_and_filtered_by(tls_off, constant, sleep_off)
+    local_idle_on = get_E_sorted_and_filtered_by(tls_on, constant, "sleep")
+    local_idle_off = get_E_sorted_and_filtered_by(tls_off, constant, "sleep")
 
     normalized_on = [
         local_startup_on[index] / local_startup_on[index],
@@ -495,54 +406,191 @@ def plot_normalised_Energy_consumption(index: int, constant: str):
 
     ax.set_ylabel("Normalized Energy")
 
-    file_name_constant = [
-        get_label(tls_on, constant, elem[0])
-        for elem in sorted(
-            simulated_activity_on,
-            key=lambda elems: get_label_value(tls_on, constant, elems[0]),
-        )
-        if constant in elem[0]
-    ][index]
+    file_name_constant = get_labels_sorted_and_filtered_by(tls_on, constant)[index]
 
     plt.savefig(
-        f"{RESULTS_DIR}/normalized_{file_name_constant}.png",
+        f"{results_dir}/normalized_{file_name_constant}.png",
         transparent=True,
         orientation="portrait",
     )
 
 
-def profile_plot(filename: str):
-    time = []
-    current = []
+def util_line_timestamp(line: bytes) -> float:
+    return float(line.split(b",", 1)[0])
+
+
+def util_last_timestamp(file, search_size: int = 4096) -> float:
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(max(0, size - search_size))
+    return util_line_timestamp(file.read().rstrip(b"\n").rsplit(b"\n", 1)[-1])
+
+
+def util_seek_timestamp(file, timestamp: float) -> int:
+    """Offset of the first line with a timestamp at or after `timestamp`
+
+    Timestamps of a capture increase, so the line is found by bisecting byte offsets and
+    reading a single line at each, never the samples in between.
+    """
+    file.seek(0)
+    file.readline()
+    low = file.tell()
+    file.seek(0, os.SEEK_END)
+    high = file.tell()
+    while low < high:
+        middle = (low + high) // 2
+        # First line starting at or after middle
+        file.seek(middle - 1)
+        file.readline()
+        line_start = file.tell()
+        line = file.readline()
+        if line and line_start < high and util_line_timestamp(line) < timestamp:
+            low = file.tell()
+        else:
+            high = middle
+    return low
+
+
+def downsample_profile(filename: str, width: int, window: tuple = None):
+    """Minimum and maximum current of the samples with PROFILE_PIN high in `width` time buckets
+
+    The capture is read PROFILE_CHUNK_SIZE samples at a time and every chunk is reduced into
+    the buckets, so memory is bounded by the chunk and the width, not by the capture. Plotting
+    both extremes of every bucket keeps the envelope of current spikes that plotting every
+    n-th sample would miss. Buckets without samples are NaN.
+
+    Returns:
+        tuple: (bucket start times (ms), minimum currents, maximum currents)
+    """
+    minimum = np.full(width, np.inf)
+    maximum = np.full(width, -np.inf)
+    with open(filename, "rb") as file:
+        if window:
+            start, end = window
+            file.seek(util_seek_timestamp(file, start))
+        else:
+            end = util_last_timestamp(file)
+            file.seek(0)
+            file.readline()
+            offset = file.tell()
+            start = util_line_timestamp(file.readline())
+            file.seek(offset)
+        scale = width / ((end - start) or 1.0)
+
+        while True:
+            lines = list(itertools.islice(file, PROFILE_CHUNK_SIZE))
+            if not lines:
+                break
+            samples = np.loadtxt(lines, delimiter=",", usecols=(0, 1, 2), dtype=PROFILE_DTYPE, ndmin=1)
+            past_end = samples["timestamp"][-1] > end
+            pins = np.ascontiguousarray(samples["pins"], dtype="S8").view(np.uint8).reshape(-1, 8)
+            samples = samples[(pins[:, PROFILE_PIN] == ord("1")) & (samples["timestamp"] <= end)]
+
+            if len(samples):
+                bucket = np.minimum(((samples["timestamp"] - start) * scale).astype(np.int64), width - 1)
+                # Timestamps increase, so the samples of a bucket are adjacent
+                first = np.flatnonzero(np.diff(bucket, prepend=-1))
+                buckets = bucket[first]
+                minimum[buckets] = np.fmin(minimum[buckets], np.minimum.reduceat(samples["current"], first))
+                maximum[buckets] = np.fmax(maximum[buckets], np.maximum.reduceat(samples["current"], first))
+            if past_end:
+                break
+
+    empty = np.isinf(minimum)
+    minimum[empty] = np.nan
+    maximum[empty] = np.nan
+    return start + np.arange(width) / scale, minimum, maximum
+
+
+def pyramid_profile(filename: str, width: int, window: tuple = None):
+    """Minimum and maximum current from the pyramid of a capture, at most `width` rows of the finest level possible
+
+    Returns:
+        tuple: (row start times (ms), minimum currents, maximum currents)
+    """
+    pyramid = Pyramid(util_pyramid_path(filename))
+    start, end = window if window else (-np.inf, np.inf)
+    rows, _ = pyramid.window(start, end, width)
+    return rows["timestamp"], rows["minimum"], rows["maximum"]
+
+
+def profile_plot(filename: str, width: int = 2000, window: tuple = None, use_pyramid: bool = False):
+    import matplotlib.pyplot as plt
+
+    with uAprofile.phase("downsample", filename):
+        if use_pyramid:
+            time, minimum, maximum = pyramid_profile(filename, width, window)
+        else:
+            time, minimum, maximum = downsample_profile(filename, width, window)
+
+    fig, ax = plt.subplots(figsize=(4, 3))
+
+    # A vertical stroke from the minimum to the maximum of every bucket
+    ax.plot(np.repeat(time, 2), np.column_stack((minimum, maximum)).ravel())
 
-    for index, measure in enumerate(open(filename, "r")):
-        if index == 0:
-            continue
+    with uAprofile.phase("render", filename, rows=len(time)):
+        plt.savefig(f"./power_profile_plots/1.png")
 
-        measure = measure[0 : -len("\n")].split(",")
-        if measure[2][3] == "1":
-            time.append(float(measure[0]))
-            current.append(float(measure[1]))
 
-    fig, ax = plt.subplots(figsize=(4, 3))
+def parse_arguments(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Command line tool for plotting results from uAnalyser tool, authored by Ådne Karstad @aadnekar"
+    )
 
-    ax.plot(time, current)
+    parser.add_argument(
+        "--path",
+        nargs="+",
+        required=False,
+        help="relative path to source file to analyse. Provide several path's to compare results.",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        help="file path to output file",
+    )
+    parser.add_argument(
+        "--window",
+        nargs=2,
+        type=float,
+        metavar=("START", "END"),
+        help="time window (ms) of the capture to plot with --path, found by seeking instead of reading the samples before it.",
+    )
+    parser.add_argument(
+        "--width",
+        type=int,
+        default=2000,
+        help="number of time buckets of a power profile plot, the minimum and maximum current of each is plotted.",
+    )
+    parser.add_argument(
+        "--pyramid",
+        action="store_true",
+        help="plot the power profile from the pyramid written by 'uAnalyser.py pyramid' instead of the capture. "
+        "Every sample is plotted, not only those with pin 3 high.",
+    )
+    uAprofile.add_arguments(parser)
+    return parser.parse_args(argv)
 
-    plt.savefig(f"./power_profile_plots/1.png")
 
+def main(argv: list = None):
+    args = parse_arguments(argv)
+    with uAprofile.profile_run(args, "uAplotter"):
+        if args.path:
+            profile_plot(args.path[0], args.width, args.window, args.pyramid)
+            # print(SOURCE_FILE)
+        else:
+            results_dir = args.output or RESULTS_DIR
+            readfile(SOURCE_FILE)
+            for constant in ["1000I", "3000B"]:
+                with uAprofile.phase("render", constant):
+                    plot_E_grouped(constant, results_dir)
+                    plot_time_grouped(constant, results_dir)
 
-if __name__ == "__main__":
+            for constant in ["1000I", "3000B"]:
+                with uAprofile.phase("render normalised", constant):
+                    for index in range(3):
+                        plot_normalised_Energy_consumption(index=index, constant=constant, results_dir=results_dir)
 
-    if args.path:
-        profile_plot(SOURCE_FILE)
-        # print(SOURCE_FILE)
-    else:
-        readfile(SOURCE_FILE)
-        setup_section_data()
-        for constant in ["1000I", "3000B"]:
-            plot_E_grouped(constant)
-            plot_time_grouped(constant)
-
-        for constant in ["1000I", "3000B"]:
-            for index in range(3):
-                plot_normalised_Energy_consumption(index=index, constant=constant)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Profiling of uAnalyser, plotter and uAplotter, enabled by their --profile arguments. The tools
+time their phases, e.g. parsing, classification and writing of every file, and the wall time,
+rows and bytes per second, resident memory and allocations of every phase are reported when the
+tool exits, on the terminal and optionally as JSON so throughput can be tracked across releases.
+
+Profiling is off unless enable() is called, and then phase() and timed_samples() cost a
+function call per block of samples, so they stay in the code paths of the tools.
+"""
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ModuleNotFoundError:
+    # Windows, peak memory is not reported
+    resource = None
+
+# The profiler of this process, None while profiling is off
+PROFILER = None
+
+# Phase counters, the rates are calculated from them in the summary
+PHASE_FIELDS = ("calls", "seconds", "rows", "bytes", "allocated_blocks", "rss_delta_bytes")
+
+
+def util_maxrss_bytes(usage) -> int:
+    """Peak resident memory (bytes) of a resource usage, e.g. of getrusage or os.wait4"""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def util_peak_rss(who: int = None) -> int:
+    """Peak resident memory (bytes) of this process, or of its finished children"""
+    if resource is None:
+        return 0
+    return util_maxrss_bytes(resource.getrusage(resource.RUSAGE_SELF if who is None else who))
+
+
+def util_current_rss() -> int:
+    """Resident memory (bytes) of this process right now, 0 where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class Profiler:
+    """Counters of every (phase, file) of a run
+
+    A phase entered many times for the same file, e.g. once per block of samples, adds up to
+    a single entry. Allocated blocks are those of the Python allocator still allocated at the
+    end of a phase minus those at its start, so temporary allocations do not count. Likewise the
+    RSS delta is the resident memory at the end of a phase minus that at its start, and the RSS
+    of a phase is the largest resident memory at its end. The peak of the process is only known
+    for the whole run.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def _entry(self, name: str, file: str) -> dict:
+        key = (name, file)
+        if key not in self.phases:
+            self.phases[key] = {"phase": name, "file": file, **{field: 0 for field in PHASE_FIELDS}, "rss_bytes": 0}
+        return self.phases[key]
+
+    def add(
+        self,
+        name: str,
+        file: str = None,
+        seconds: float = 0.0,
+        rows: int = 0,
+        bytes: int = 0,
+        allocated_blocks: int = 0,
+        rss_start: int = None,
+    ):
+        """Add a call of a phase, rss_start is the resident memory when it started"""
+        rss = util_current_rss()
+        entry = self._entry(name, file)
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+        entry["rows"] += rows
+        entry["bytes"] += bytes
+        entry["allocated_blocks"] += allocated_blocks
+        entry["rss_delta_bytes"] += rss - (rss if rss_start is None else rss_start)
+        entry["rss_bytes"] = max(entry["rss_bytes"], rss)
+
+    @contextmanager
+    def phase(self, name: str, file: str = None, rows: int = 0, bytes: int = 0):
+        rss = util_current_rss()
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, file, time.perf_counter() - start, rows, bytes, sys.getallocatedblocks() - blocks, rss)
+
+    def merge(self, phases: list):
+        """Add the phases of another profiler, e.g. of a worker process"""
+        for phase in phases:
+            entry = self._entry(phase["phase"], phase["file"])
+            for field in PHASE_FIELDS:
+                entry[field] += phase[field]
+            entry["rss_bytes"] = max(entry["rss_bytes"], phase["rss_bytes"])
+
+    def summary(self, tool: str) -> dict:
+        phases = []
+        for entry in self.phases.values():
+            phase = dict(entry)
+            if phase["rows"]:
+                phase["rows_per_second"] = phase["rows"] / phase["seconds"] if phase["seconds"] else None
+            if phase["bytes"]:
+                phase["bytes_per_second"] = phase["bytes"] / phase["seconds"] if phase["seconds"] else None
+            phases.append(phase)
+        summary = {
+            "tool": tool,
+            "arguments": sys.argv[1:],
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "seconds": time.perf_counter() - self.start,
+            "cpu_seconds": time.process_time() - self.cpu_start,
+            "peak_rss_bytes": util_peak_rss(),
+            # Worker processes, once they have exited. Read before platform, which may run uname
+            "peak_rss_children_bytes": util_peak_rss(resource.RUSAGE_CHILDREN) if resource is not None else 0,
+            "phases": phases,
+        }
+        summary["python"] = platform.python_version()
+        summary["platform"] = platform.platform()
+        return summary
+
+
+def enable() -> Profiler:
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
+
+
+def phase(name: str, file: str = None, rows: int = 0, bytes: int = 0):
+    """Context manager timing a phase, doing nothing while profiling is off"""
+    if PROFILER is None:
+        return nullcontext()
+    return PROFILER.phase(name, file, rows, bytes)
+
+
+def timed_samples(samples, file: str, name: str = "parse"):
+    """Yield the (timestamp, current, pins) arrays of samples, timing how long each takes to produce
+
+    Reading and parsing happen inside the generator of the samples, so their time is the time
+    spent waiting on it. Returns samples itself while profiling is off.
+    """
+    if PROFILER is None:
+        return samples
+    return util_timed_samples(samples, file, name)
+
+
+def util_timed_samples(samples, file: str, name: str):
+    samples = iter(samples)
+    while True:
+        rss = util_current_rss()
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        try:
+            arrays = next(samples)
+        except StopIteration:
+            return
+        PROFILER.add(name, file, time.perf_counter() - start, len(arrays[0]), 0, sys.getallocatedblocks() - blocks, rss)
+        yield arrays
+
+
+class ProfiledCall:
+    """Calls a function in a worker process with a profiler of its own, returning (result, phases)"""
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args, **kwargs):
+        profiler = enable()
+        return self.function(*args, **kwargs), list(profiler.phases.values())
+
+
+def in_worker(function):
+    """The function to submit to a worker process, pass what it returns to collect()
+
+    With profiling on, the phases of the worker are sent back with the result of the function.
+    """
+    return function if PROFILER is None else ProfiledCall(function)
+
+
+def collect(value):
+    """The result of a function submitted through in_worker, adding the phases of its worker to this process"""
+    if PROFILER is None:
+        return value
+    result, phases = value
+    PROFILER.merge(phases)
+    return result
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="report the wall time, rows and bytes per second, resident memory and allocated blocks of every phase of every "
+        "file when the run ends, e.g. parsing, classification and writing, and the peak memory of the run.",
+    )
+    parser.add_argument(
+        "--profile-json",
+        type=str,
+        metavar="PATH",
+        help="also write the --profile report to PATH as JSON. Implies --profile.",
+    )
+    parser.add_argument(
+        "--cprofile",
+        type=str,
+        metavar="PATH",
+        help="write a cProfile dump of the main process to PATH, for pstats or snakeviz. Implies --profile.",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        type=int,
+        metavar="N",
+        help="trace the memory allocations of the main process and report its traced peak and the N lines holding the "
+        "most memory when the run ends. Implies --profile.",
+    )
+
+
+def util_format_rate(value, unit: str) -> str:
+    return f", {value:.0f} {unit}/s" if value else ""
+
+
+def format_summary(summary: dict) -> str:
+    lines = [f"Profile of {summary['tool']}: {summary['seconds']:.3f} s, {summary['cpu_seconds']:.3f} s CPU, "
+             f"peak RSS {summary['peak_rss_bytes'] / 2**20:.0f} MiB (workers {summary['peak_rss_children_bytes'] / 2**20:.0f} MiB)"]
+    for phase in summary["phases"]:
+        lines.append(
+            f"{phase['phase']}" + (f" {phase['file']}" if phase["file"] else "")
+            + f": {phase['seconds']:.3f} s in {phase['calls']} calls"
+            + (f", {phase['rows']} rows" if phase["rows"] else "")
+            + util_format_rate(phase.get("rows_per_second"), "rows")
+            + util_format_rate(phase.get("bytes_per_second"), "bytes")
+            + f", {phase['allocated_blocks']} blocks allocated, RSS {phase['rss_bytes'] / 2**20:.0f} MiB "
+            + f"({phase['rss_delta_bytes'] / 2**20:+.0f} MiB)"
+        )
+    for allocation in summary.get("tracemalloc", []):
+        lines.append(f"{allocation['location']}: {allocation['size_bytes'] / 2**10:.1f} KiB in {allocation['count']} blocks")
+    return "\n".join(lines)
+
+
+@contextmanager
+def profile_run(args, tool: str):
+    """Profile the run of a tool as requested by the arguments of add_arguments"""
+    if not (args.profile or args.profile_json or args.cprofile or args.tracemalloc):
+        yield
+        return
+
+    profiler = enable()
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+    if args.cprofile:
+        import cProfile
+        code_profile = cProfile.Profile()
+        code_profile.enable()
+    try:
+        yield
+    finally:
+        if args.cprofile:
+            code_profile.disable()
+            code_profile.dump_stats(args.cprofile)
+        summary = profiler.summary(tool)
+        if args.tracemalloc:
+            statistics = tracemalloc.take_snapshot().statistics("lineno")[: args.tracemalloc]
+            summary["tracemalloc_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            summary["tracemalloc"] = [
+                {"location": str(statistic.traceback), "size_bytes": statistic.size, "count": statistic.count}
+                for statistic in statistics
+            ]
+            tracemalloc.stop()
+        print(format_summary(summary))
+        if args.profile_json:
+            with open(args.profile_json, "w") as profile_file:
+                json.dump(summary, profile_file, indent=2)
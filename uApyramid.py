@@ -0,0 +1,166 @@
+"""
+Multi-resolution aggregate pyramid of a capture, written by 'uAnalyser.py pyramid' next to the
+capture and read by uAplotter. Every level aggregates a fixed number of samples per row into
+the minimum, maximum, mean and sum of the current and the dominant section, so any time window
+of a capture is fetched at a suitable resolution from a memory-mapped file without parsing it.
+"""
+
+import bisect
+import os
+import struct
+import tempfile
+import numpy as np
+
+PYRAMID_EXTENSION = ".uapyr"
+PYRAMID_MAGIC = b"uAPYR001"
+# Samples aggregated per row of every level, finest first
+PYRAMID_FACTORS = (10, 100, 1000, 10000)
+# magic, number of samples, number of levels, then the factor and number of rows of every level
+PYRAMID_HEADER = struct.Struct(f"<8sQQ{len(PYRAMID_FACTORS)}Q{len(PYRAMID_FACTORS)}Q")
+# Size reserved for the header, the levels follow it one after the other
+PYRAMID_HEADER_SIZE = 128
+
+# Section of rows where most samples are not of a running application. The other values are
+# those of uAnalyser's SECTION
+PYRAMID_NOT_RUNNING = 255
+# Number of section values counted when finding the dominant section of a row
+PYRAMID_SECTION_VALUES = 256
+
+PYRAMID_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("minimum", "<f4"),
+    ("maximum", "<f4"),
+    ("mean", "<f4"),
+    ("sum", "<f8"),
+    ("count", "<u4"),
+    ("section", "u1"),
+])
+
+
+def util_pyramid_path(file_path: str) -> str:
+    return os.path.splitext(file_path)[0] + PYRAMID_EXTENSION
+
+
+def util_aggregate(factor: int, timestamp, current, sections):
+    """One row per `factor` samples, the last row holds the samples left over"""
+    starts = np.arange(0, len(current), factor)
+    rows = np.empty(len(starts), dtype=PYRAMID_DTYPE)
+    rows["timestamp"] = timestamp[starts]
+    rows["minimum"] = np.minimum.reduceat(current, starts)
+    rows["maximum"] = np.maximum.reduceat(current, starts)
+    rows["sum"] = np.add.reduceat(current, starts)
+    rows["count"] = np.diff(np.append(starts, len(current)))
+    rows["mean"] = rows["sum"] / rows["count"]
+    # Sections are counted by their index among the few values present, in increasing order so ties
+    # still go to the lowest section value
+    present = np.flatnonzero(np.bincount(sections, minlength=PYRAMID_SECTION_VALUES))
+    codes = np.zeros(PYRAMID_SECTION_VALUES, dtype=np.int64)
+    codes[present] = np.arange(len(present))
+    row_of_sample = np.arange(len(current)) // factor
+    section_counts = np.bincount(
+        row_of_sample * len(present) + codes[sections], minlength=len(starts) * len(present)
+    ).reshape(len(starts), len(present))
+    rows["section"] = present[section_counts.argmax(axis=1)] if len(present) else 0
+    return rows
+
+
+class PyramidBuilder:
+    """Builds the levels of a pyramid one chunk of samples at a time
+
+    Every level keeps the samples of its unfinished row until the next chunk completes it, and
+    writes finished rows to a temporary file, so memory is bounded by the chunk size and the
+    largest factor rather than the capture.
+    """
+
+    def __init__(self, factors: tuple = PYRAMID_FACTORS):
+        self.factors = factors
+        self.samples = 0
+        self.pending = [(np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)) for _ in factors]
+        self.files = [tempfile.TemporaryFile() for _ in factors]
+        self.rows = [0] * len(factors)
+
+    def _write(self, level: int, rows):
+        self.files[level].write(rows.tobytes())
+        self.rows[level] += len(rows)
+
+    def add_samples(self, timestamp, current, sections):
+        """Add a chunk of samples, sections holds the section value of every sample
+
+        Args:
+            timestamp (np.ndarray): timestamp of each sample (ms)
+            current (np.ndarray): current of each sample (uA)
+            sections (np.ndarray): SECTION value of each sample, PYRAMID_NOT_RUNNING outside the application
+        """
+        self.samples += len(current)
+        for level, factor in enumerate(self.factors):
+            pending_timestamp, pending_current, pending_sections = self.pending[level]
+            level_timestamp = np.concatenate((pending_timestamp, timestamp))
+            level_current = np.concatenate((pending_current, current))
+            level_sections = np.concatenate((pending_sections, sections))
+            complete = len(level_current) // factor * factor
+            if complete:
+                self._write(level, util_aggregate(factor, level_timestamp[:complete], level_current[:complete], level_sections[:complete]))
+            self.pending[level] = (level_timestamp[complete:], level_current[complete:], level_sections[complete:])
+
+    def save(self, file_path: str):
+        """Write the header and every level to file_path, the unfinished rows included"""
+        for level, factor in enumerate(self.factors):
+            pending_timestamp, pending_current, pending_sections = self.pending[level]
+            if len(pending_current):
+                self._write(level, util_aggregate(factor, pending_timestamp, pending_current, pending_sections))
+
+        temporary_path = file_path + ".tmp"
+        with open(temporary_path, "wb") as pyramid_file:
+            pyramid_file.write(
+                PYRAMID_HEADER.pack(PYRAMID_MAGIC, self.samples, len(self.factors), *self.factors, *self.rows).ljust(
+                    PYRAMID_HEADER_SIZE, b"\0"
+                )
+            )
+            for level_file in self.files:
+                level_file.seek(0)
+                while True:
+                    block = level_file.read(1 << 20)
+                    if not block:
+                        break
+                    pyramid_file.write(block)
+                level_file.close()
+        os.replace(temporary_path, file_path)
+
+
+class Pyramid:
+    """Memory-mapped levels of a pyramid file, only the rows of fetched windows are read"""
+
+    def __init__(self, file_path: str):
+        with open(file_path, "rb") as pyramid_file:
+            header = PYRAMID_HEADER.unpack(pyramid_file.read(PYRAMID_HEADER.size))
+        magic, self.samples, number_of_levels = header[:3]
+        if magic != PYRAMID_MAGIC or number_of_levels != len(PYRAMID_FACTORS):
+            raise ValueError(f"{file_path} is not a pyramid file")
+        self.factors = header[3 : 3 + number_of_levels]
+        rows = header[3 + number_of_levels :]
+
+        self.levels = []
+        offset = PYRAMID_HEADER_SIZE
+        for level_rows in rows:
+            if level_rows:
+                self.levels.append(np.memmap(file_path, dtype=PYRAMID_DTYPE, mode="r", offset=offset, shape=(level_rows,)))
+            else:
+                self.levels.append(np.empty(0, dtype=PYRAMID_DTYPE))
+            offset += level_rows * PYRAMID_DTYPE.itemsize
+
+    def window(self, start: float, end: float, points: int):
+        """Rows from start to end (ms) of the finest level with at most `points` rows there
+
+        The coarsest level is used when even it has more rows in the window.
+
+        Returns:
+            (np.ndarray, int): rows of PYRAMID_DTYPE and the number of samples per row
+        """
+        for factor, level in zip(self.factors, self.levels):
+            # Bisecting the memory-mapped column reads a handful of rows instead of all of them.
+            # A row starting before start still covers samples in the window
+            timestamps = level["timestamp"]
+            first = max(bisect.bisect_right(timestamps, start) - 1, 0)
+            last = bisect.bisect_right(timestamps, end)
+            if last - first <= points or factor == self.factors[-1]:
+                return level[first:last], factor
@@ -0,0 +1,223 @@
+"""
+Results of uAnalyser as a typed column store, shared by plotter and uAplotter. Every row is
+one section of one analysed file, indexed by the protocol, number of operations and payload
+size parsed from its label, so selections are array operations instead of loops over dicts.
+"""
+
+import os
+import numpy as np
+from uAstats import bootstrap_mean_interval
+
+# Supply voltage of the device (V) the energy is calculated with, by uAnalyser unless --voltage is
+# given and here for results without an energy column
+SUPPLY_VOLTAGE = 3.7
+
+""" Defines sorting order for sorting values and labels by protocol"""
+PROTOCOL_SORTING_ORDER = {"no_tls": 1, "no_tls_e2e": 2, "tls": 3, "tls_e2e": 4}
+
+RESULT_DTYPE = np.dtype([
+    ("label", "U64"),
+    ("protocol", "U16"),
+    ("operations", np.int64),
+    ("payload", np.int64),
+    ("section", "U16"),
+    ("count", np.int64),
+    ("average_current", np.float64),
+    ("total_current", np.float64),
+    ("time", np.float64),
+    ("joules", np.float64),
+])
+
+# Fields of a row aggregated by aggregate_repeats, and the statistics it returns
+AGGREGATE_FIELDS = ("count", "average_current", "total_current", "time", "joules")
+REPEAT_STATISTICS = ("mean", "median", "min", "max", "ci_low", "ci_high")
+
+
+def parse_label(label: str):
+    """Split a label into protocol, number of operations and payload size (bytes)
+
+    Handles the labels of uAnalyser, e.g. 'no_tls_10_256B', and of the older captures read by
+    uAplotter, e.g. 'on_3000B_1000I'. Parts that are missing are returned as 0.
+    """
+    protocol = []
+    operations = 0
+    payload = 0
+    for part in label.split("_"):
+        if part[:-1].isdigit() and part[-1] == "B":
+            payload = int(part[:-1])
+        elif part[:-1].isdigit() and part[-1] == "I":
+            operations = int(part[:-1])
+        elif part.isdigit():
+            operations = int(part)
+        else:
+            protocol.append(part)
+    return "_".join(protocol), operations, payload
+
+
+def label_sort_key(label: str):
+    """Sort key of a label: number of operations, payload size and protocol, then the label itself
+
+    Labels of a protocol missing from PROTOCOL_SORTING_ORDER, e.g. 'custom', are sorted after all
+    others, the same way among themselves.
+    """
+    protocol, operations, payload = parse_label(label)
+    return (protocol not in PROTOCOL_SORTING_ORDER, operations, payload, PROTOCOL_SORTING_ORDER.get(protocol, 0), label)
+
+
+def label_order(labels) -> np.ndarray:
+    """Indices that sort labels by label_sort_key, equal labels keeping their order"""
+    unique_labels, label_index = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+    rank = np.empty(len(unique_labels), dtype=np.int64)
+    rank[sorted(range(len(unique_labels)), key=lambda index: label_sort_key(unique_labels[index]))] = np.arange(len(unique_labels))
+    return np.argsort(rank[label_index.ravel()], kind="stable")
+
+
+def make_results(labels, sections, count, average_current, total_current, time, joules):
+    """Build a sorted result array from columns, parsing every distinct label once"""
+    labels = np.asarray(labels, dtype=RESULT_DTYPE["label"])
+    results = np.empty(len(labels), dtype=RESULT_DTYPE)
+    results["label"] = labels
+    results["section"] = sections
+    results["count"] = count
+    results["average_current"] = average_current
+    results["total_current"] = total_current
+    results["time"] = time
+    results["joules"] = joules
+
+    unique_labels, label_index = np.unique(labels, return_inverse=True)
+    parsed = [parse_label(label) for label in unique_labels]
+    results["protocol"] = np.array([protocol for protocol, _, _ in parsed], dtype=RESULT_DTYPE["protocol"])[label_index]
+    results["operations"] = np.array([operations for _, operations, _ in parsed], dtype=np.int64)[label_index]
+    results["payload"] = np.array([payload for _, _, payload in parsed], dtype=np.int64)[label_index]
+    return sort_results(results)
+
+
+def sort_results(results):
+    """Order rows by label_sort_key, keeping the order of the sections"""
+    return results[label_order(results["label"])]
+
+
+def util_read_columns(file_path: str):
+    # All fields are read as strings in one call, the header line is skipped
+    columns = np.loadtxt(file_path, delimiter=",", skiprows=1, dtype=str, ndmin=2)
+    return np.char.strip(columns).T
+
+
+def aggregate_repeats(results, resamples: int = 1000, confidence: float = 0.95, seed: int = 0) -> dict:
+    """Statistics of repeated results, rows with equal label and section are repeats of one another
+
+    Every field of AGGREGATE_FIELDS is aggregated on its own across the repeats of a row, all
+    rows at once, e.g. the average current of 'mean' is the mean of the average currents. The
+    numbers of samples of 'mean', 'median' and the bounds of the bootstrap confidence interval
+    of the mean are rounded to whole samples. Configurations may have different numbers of
+    repeats, a single repeat is its own statistic.
+
+    Returns:
+        dict: statistic of REPEAT_STATISTICS -> result array, one row per label and section
+    """
+    if not len(results):
+        return {statistic: np.empty(0, dtype=RESULT_DTYPE) for statistic in REPEAT_STATISTICS}
+
+    keys = np.char.add(np.char.add(results["label"], ","), results["section"])
+    _, first, group = np.unique(keys, return_index=True, return_inverse=True)
+    group = group.ravel()
+    repeats = np.bincount(group)
+
+    # Repeat number of every row among the rows of its label and section
+    order = np.argsort(group, kind="stable")
+    repeat = np.empty(len(results), dtype=np.int64)
+    repeat[order] = np.arange(len(results)) - np.searchsorted(group[order], group[order])
+
+    # repeat x (label, section) x field, NaN past the repeats of a label and section
+    values = np.full((repeats.max(), len(first), len(AGGREGATE_FIELDS)), np.nan)
+    for column, field in enumerate(AGGREGATE_FIELDS):
+        values[repeat, group, column] = results[field]
+
+    lower, upper = bootstrap_mean_interval(
+        values.reshape(len(values), -1), np.repeat(repeats, len(AGGREGATE_FIELDS)), resamples, confidence, seed
+    )
+    statistics = {
+        "mean": np.nanmean(values, axis=0),
+        "median": np.nanmedian(values, axis=0),
+        "min": np.nanmin(values, axis=0),
+        "max": np.nanmax(values, axis=0),
+        "ci_low": lower.reshape(len(first), -1),
+        "ci_high": upper.reshape(len(first), -1),
+    }
+
+    # In the order the labels and sections first appear in results
+    by_first = np.argsort(first)
+    labels, sections = results["label"][first][by_first], results["section"][first][by_first]
+    aggregated = {}
+    for statistic in REPEAT_STATISTICS:
+        count, average_current, total_current, time, joules = statistics[statistic][by_first].T
+        aggregated[statistic] = make_results(
+            labels, sections, np.rint(count).astype(np.int64), average_current, total_current, time, joules
+        )
+    return aggregated
+
+
+def read_results_csv(file_path: str, voltage: float = SUPPLY_VOLTAGE):
+    """Read a result file of uAnalyser into a result array
+
+    Columns after the energy, e.g. those of --statistics, are ignored. Results without an
+    energy column get it from the average current and time at the given voltage. Files of
+    the older 'file,section,average current (uA),time (ms)' layout are read as well, with
+    the label taken from the file name and a count and total current of 0.
+    """
+    columns = util_read_columns(file_path)
+    if not columns.size:
+        return np.empty(0, dtype=RESULT_DTYPE)
+
+    if len(columns) == 4:
+        files, sections, average_current, time = columns
+        labels = [os.path.splitext(os.path.basename(file))[0] for file in files]
+        count = total_current = 0
+        average_current, time = average_current.astype(np.float64), time.astype(np.float64)
+    else:
+        labels, sections, count, average_current, total_current, time = columns[:6]
+        count = count.astype(np.float64).astype(np.int64)
+        average_current, total_current, time = (
+            average_current.astype(np.float64), total_current.astype(np.float64), time.astype(np.float64)
+        )
+
+    if len(columns) >= 7:
+        joules = columns[6].astype(np.float64)
+    else:
+        # uA * ms * V = nJ
+        joules = average_current * time * voltage / 1e9
+    return make_results(labels, sections, count, average_current, total_current, time, joules)
+
+
+def save_results(file_path: str, results):
+    np.save(file_path, results)
+
+
+def load_results(file_path: str, voltage: float = SUPPLY_VOLTAGE):
+    """Load results from a column store written by save_results, or from a result file"""
+    if file_path.endswith(".npy"):
+        return np.load(file_path)
+    return read_results_csv(file_path, voltage)
+
+
+def select(results, section: str = None, protocol: str = None, operations: int = None, payload: int = None):
+    """Rows matching every given value, in the order of sort_results"""
+    mask = np.ones(len(results), dtype=bool)
+    for field, value in (("section", section), ("protocol", protocol), ("operations", operations), ("payload", payload)):
+        if value is not None:
+            mask &= results[field] == value
+    return results[mask]
+
+
+def to_dictionary(results) -> dict:
+    """The nested layout of older plotter code, label -> section -> [count, average current, total current, time, joules]"""
+    dictionary = {}
+    for row in results:
+        dictionary.setdefault(str(row["label"]), {})[str(row["section"])] = [
+            float(row["count"]),
+            float(row["average_current"]),
+            float(row["total_current"]),
+            float(row["time"]),
+            float(row["joules"]),
+        ]
+    return dictionary
@@ -0,0 +1,201 @@
+"""
+Streaming statistics used by uAnalyser. Everything is computed in a single pass with
+constant memory, and partial results of separate chunks can be merged.
+"""
+
+from math import sqrt
+import numpy as np
+
+
+class RunningMoments:
+    """Count, mean, central moments up to the fourth, minimum and maximum of a stream of values
+
+    Values are added one at a time with the online update of Welford and Terriberry, or an
+    array at a time by merging the moments of the array with the pairwise formulas of
+    Pébay (2008). Neither keeps the values, nor accumulates large sums of squares that lose
+    precision like the textbook sum(x**2) - n * mean**2.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.M3 = 0.0
+        self.M4 = 0.0
+        self.minimum = float("inf")
+        self.maximum = float("-inf")
+
+    def add(self, value: float):
+        value = float(value)
+        previous_count = self.count
+        self.count += 1
+        delta = value - self.mean
+        delta_n = delta / self.count
+        delta_n2 = delta_n * delta_n
+        term = delta * delta_n * previous_count
+
+        self.mean += delta_n
+        self.M4 += term * delta_n2 * (self.count * self.count - 3 * self.count + 3) + 6 * delta_n2 * self.M2 - 4 * delta_n * self.M3
+        self.M3 += term * delta_n * (self.count - 2) - 3 * delta_n * self.M2
+        self.M2 += term
+
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+
+    def add_array(self, values):
+        if not len(values):
+            return
+        batch = RunningMoments()
+        batch.count = len(values)
+        batch.mean = float(np.mean(values))
+        deviation = values - batch.mean
+        squared_deviation = deviation * deviation
+        batch.M2 = float(np.sum(squared_deviation))
+        batch.M3 = float(np.dot(squared_deviation, deviation))
+        batch.M4 = float(np.dot(squared_deviation, squared_deviation))
+        batch.minimum = float(np.min(values))
+        batch.maximum = float(np.max(values))
+        self.merge(batch)
+
+    def merge(self, other: "RunningMoments"):
+        if not other.count:
+            return
+        if not self.count:
+            self.__dict__.update(other.__dict__)
+            return
+
+        count_a, count_b = self.count, other.count
+        count = count_a + count_b
+        delta = other.mean - self.mean
+        delta2 = delta * delta
+
+        M2 = self.M2 + other.M2 + delta2 * count_a * count_b / count
+        M3 = (
+            self.M3 + other.M3
+            + delta * delta2 * count_a * count_b * (count_a - count_b) / count**2
+            + 3 * delta * (count_a * other.M2 - count_b * self.M2) / count
+        )
+        M4 = (
+            self.M4 + other.M4
+            + delta2 * delta2 * count_a * count_b * (count_a**2 - count_a * count_b + count_b**2) / count**3
+            + 6 * delta2 * (count_a**2 * other.M2 + count_b**2 * self.M2) / count**2
+            + 4 * delta * (count_a * other.M3 - count_b * self.M3) / count
+        )
+
+        self.count = count
+        self.mean += delta * count_b / count
+        self.M2, self.M3, self.M4 = M2, M3, M4
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def variance(self) -> float:
+        """Population variance, the squared deviation divided by the number of values"""
+        return self.M2 / self.count if self.count else 0.0
+
+    @property
+    def standard_deviation(self) -> float:
+        return sqrt(self.variance)
+
+    @property
+    def skewness(self) -> float:
+        return sqrt(self.count) * self.M3 / self.M2**1.5 if self.M2 else 0.0
+
+    @property
+    def kurtosis(self) -> float:
+        """Excess kurtosis, 0 for a normal distribution"""
+        return self.count * self.M4 / (self.M2 * self.M2) - 3 if self.M2 else 0.0
+
+
+class QuantileSketch:
+    """Quantiles of a stream of non-negative values with a bounded relative error
+
+    Values are counted in logarithmically spaced buckets, like DDSketch. Every value in bucket k
+    lies in (gamma**(k-1), gamma**k], so answering with 2 * gamma**k / (gamma + 1) is within
+    relative_accuracy of any value in the bucket. The buckets span minimum_value to
+    maximum_value and smaller or larger values are counted in the outermost buckets, so memory
+    is fixed no matter how many values are added. Sketches with equal parameters are merged by
+    adding their counts.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, minimum_value: float = 1e-3, maximum_value: float = 1e7):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.offset = int(np.ceil(np.log(minimum_value) / self.log_gamma))
+        size = int(np.ceil(np.log(maximum_value) / self.log_gamma)) - self.offset + 1
+        self.counts = np.zeros(size, dtype=np.int64)
+        self.zero_count = 0
+        self.count = 0
+
+    def _bucket(self, values):
+        index = np.ceil(np.log(values) / self.log_gamma).astype(np.int64) - self.offset
+        return np.clip(index, 0, len(self.counts) - 1)
+
+    def add(self, value: float):
+        self.count += 1
+        if value > 0:
+            self.counts[self._bucket(value)] += 1
+        else:
+            self.zero_count += 1
+
+    def add_array(self, values):
+        positive = values[values > 0]
+        self.count += len(values)
+        self.zero_count += len(values) - len(positive)
+        if len(positive):
+            self.counts += np.bincount(self._bucket(positive), minlength=len(self.counts))
+
+    def merge(self, other: "QuantileSketch"):
+        if other.gamma != self.gamma or other.offset != self.offset or len(other.counts) != len(self.counts):
+            raise ValueError("Only sketches with equal parameters can be merged")
+        self.counts += other.counts
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        """Estimate of the value with rank q * (count - 1) among the added values, 0 <= q <= 1"""
+        if not self.count:
+            return 0.0
+        rank = int(q * (self.count - 1)) - self.zero_count
+        if rank < 0:
+            return 0.0
+        bucket = int(np.searchsorted(np.cumsum(self.counts), rank, side="right"))
+        return float(2 * self.gamma ** (bucket + self.offset) / (self.gamma + 1))
+
+
+# Most values bootstrap_mean_interval draws at a time, resamples are drawn in batches below it
+BOOTSTRAP_BATCH_SIZE = 4000000
+
+
+def bootstrap_mean_interval(values, counts, resamples: int = 1000, confidence: float = 0.95, seed: int = 0):
+    """Percentile bootstrap confidence interval of the mean of every column of values
+
+    The repeats of a column are its first counts[column] rows, the rows after them are
+    ignored. A resample draws as many rows with replacement from the repeats of every column,
+    all columns at once, and the interval spans the middle `confidence` of the means of the
+    resamples. The same seed gives the same interval.
+
+    Returns:
+        (np.ndarray, np.ndarray): lower and upper bound of every column
+    """
+    rng = np.random.default_rng(seed)
+    repeats, columns = values.shape
+    counts = np.asarray(counts)
+    valid = np.arange(repeats)[:, None] < counts
+    column_index = np.arange(columns)
+    batch = max(1, BOOTSTRAP_BATCH_SIZE // (repeats * columns))
+
+    means = np.empty((resamples, columns))
+    for start in range(0, resamples, batch):
+        size = min(batch, resamples - start)
+        # Row of every drawn value, scaled into the repeats of its column
+        rows = (rng.random((size, repeats, columns)) * counts).astype(np.int64)
+        drawn = np.where(valid, values[rows, column_index], 0.0)
+        means[start : start + size] = drawn.sum(axis=1) / counts
+
+    tail = (1 - confidence) / 2 * 100
+    lower, upper = np.percentile(means, [tail, 100 - tail], axis=0)
+    return lower, upper